@@ -1,13 +1,17 @@
 from raco import expression
 from raco import scheme
-from raco.utility import Printable, real_str
+from raco.utility import (MemoizingMeta, Printable, PropertyCache,
+                          TrackedList, UndoLog, iter_postorder,
+                          iter_preorder, real_str)
 
-from abc import ABCMeta, abstractmethod
+from abc import abstractmethod
+import collections
 import copy
 import operator
 import math
 from raco.expression import StateVar
 from functools import reduce
+from raco.relation_key import RelationKey
 from raco.representation import RepresentationProperties
 
 
@@ -39,10 +43,28 @@ class SchemaError(Exception):
     pass
 
 
+class OperatorMeta(MemoizingMeta):
+
+    """Metaclass of operators: caches the derived properties and the
+    structural hash defined by each class."""
+
+    memoized = ('scheme', 'num_tuples', 'partitioning', '__hash__')
+    children_method = 'children'
+
+
 class Operator(Printable):
 
-    """Operator base class"""
-    __metaclass__ = ABCMeta
+    """Operator base class.
+
+    The properties memoized by OperatorMeta are cached until an operator or
+    expression is modified, either by assigning an attribute or by changing
+    a list held by an attribute, e.g., op.args or an Apply's emitters, in
+    place: lists are stored as TrackedLists."""
+    __metaclass__ = OperatorMeta
+    # The common fields of operators are slots. Other attributes are kept in
+    # a __dict__ that is created on first use.
+    __slots__ = ('bound', 'cleanup', 'alias', '_trace', '_property_cache',
+                 '__dict__')
 
     def __init__(self):
         self.bound = None
@@ -64,11 +86,8 @@ class Operator(Printable):
         """Return the scheme of the tuples output by this operator."""
 
     def walk(self):
-        """Return an iterator over the tree of operators."""
-        yield self
-        for c in self.children():
-            for x in c.walk():
-                yield x
+        """Return an iterator over the tree of operators, in preorder."""
+        return iter_preorder(self, _children)
 
     @abstractmethod
     def num_tuples(self):
@@ -83,19 +102,15 @@ class Operator(Printable):
     def postorder(self, f):
         """Postorder traversal, applying a function to each operator.  The
         function returns an iterator"""
-        for c in self.children():
-            for x in c.postorder(f):
+        for op in iter_postorder(self, _children):
+            for x in f(op):
                 yield x
-        for x in f(self):
-            yield x
 
     def preorder(self, f):
         """Preorder traversal, applying a function to each operator.  The
         function returns an iterator"""
-        for x in f(self):
-            yield x
-        for c in self.children():
-            for x in c.preorder(f):
+        for op in iter_preorder(self, _children):
+            for x in f(op):
                 yield x
 
     def collectParents(self, parent_map=None):
@@ -103,20 +118,53 @@ class Operator(Printable):
         optimization"""
         if parent_map is None:
             parent_map = {}
-        for c in self.children():
-            parent_map.setdefault(c, []).append(self)
-            c.collectParents(parent_map)
+        stack = [(c, self) for c in reversed(self.children())]
+        while stack:
+            op, parent = stack.pop()
+            parent_map.setdefault(op, []).append(parent)
+            stack.extend((c, op) for c in reversed(op.children()))
 
     def __copy__(self):
         raise RuntimeError("Shallow copy not supported for operators")
 
+    def __getstate__(self):
+        return PropertyCache.getstate(self)
+
+    def __setattr__(self, key, value):
+        # Operators are modified in place by rules; a modification may
+        # change the properties of the operator and of its ancestors
+        if hasattr(self, '_property_cache') or hasattr(self, key):
+            PropertyCache.invalidate()
+        if UndoLog.active is not None:
+            UndoLog.record_attribute(self, key)
+        if type(value) is list:
+            value = TrackedList(value)
+        super(Operator, self).__setattr__(key, value)
+
+    def __delattr__(self, key):
+        PropertyCache.invalidate()
+        if UndoLog.active is not None:
+            UndoLog.record_attribute(self, key)
+        super(Operator, self).__delattr__(key)
+
     def __eq__(self, other):
         return self.__class__ == other.__class__
 
     def __str__(self):
-        if len(self.children()) > 0:
-            return "%s%s" % (self.shortStr(), real_str(self.children()))
-        return self.shortStr()
+        # Build the strings of the descendants first, so that deep plans do
+        # not exhaust the recursion limit. Operators that override __str__
+        # print their own subtrees.
+        strs = {}
+        for op in iter_postorder(self, _str_children, distinct=True):
+            if not _prints_children(op):
+                strs[id(op)] = str(op)
+            elif op.children():
+                strs[id(op)] = "%s[%s]" % (
+                    op.shortStr(),
+                    ','.join(strs[id(c)] for c in op.children()))
+            else:
+                strs[id(op)] = op.shortStr()
+        return strs[id(self)]
 
     def __hash__(self):
         h = str(self.__class__).__hash__()
@@ -163,18 +211,21 @@ class Operator(Printable):
         if graph is None:
             graph = {'nodes': list(), 'edges': list()}
 
-        # Cycle detection - continue, but don't re-add this node to the graph
-        if id(self) in [id(n) for n in graph['nodes']]:
-            return graph
-
-        # Add this node to the graph
-        graph['nodes'].append(self)
-        # Add all edges
-        graph['edges'].extend([(x, self) for x in self.children()])
-        for x in self.children():
-            # Recursively add children and edges to the graph. This mutates
+        seen = set(id(n) for n in graph['nodes'])
+        stack = [self]
+        while stack:
+            op = stack.pop()
+            # Cycle detection - continue, but don't re-add this node to the
             # graph
-            x.collectGraph(graph)
+            if id(op) in seen:
+                continue
+            seen.add(id(op))
+
+            # Add this node to the graph
+            graph['nodes'].append(op)
+            # Add all edges
+            graph['edges'].extend([(x, op) for x in op.children()])
+            stack.extend(reversed(op.children()))
 
         # Return the graph
         return graph
@@ -185,9 +236,26 @@ class Operator(Printable):
         return self.scheme().resolve(ref)
 
 
+def _children(op):
+    return op.children()
+
+
+def _prints_children(op):
+    """Does op print its children with Operator.__str__?"""
+    method = getattr(type(op), '__str__')
+    return getattr(method, 'im_func', None) is Operator.__str__.im_func
+
+
+def _str_children(op):
+    if not _prints_children(op):
+        return []
+    return op.children()
+
+
 class ZeroaryOperator(Operator):
 
     """Operator with no arguments"""
+    __slots__ = ()
 
     def __init__(self):
         Operator.__init__(self)
@@ -217,6 +285,7 @@ class ZeroaryOperator(Operator):
 class UnaryOperator(Operator):
 
     """Operator with one argument"""
+    __slots__ = ('input',)
 
     def __init__(self, input):
         self.input = input
@@ -254,6 +323,7 @@ class UnaryOperator(Operator):
 class BinaryOperator(Operator):
 
     """Operator with two arguments"""
+    __slots__ = ('left', 'right')
 
     def __init__(self, left, right):
         self.left = left
@@ -293,6 +363,7 @@ class BinaryOperator(Operator):
 class NaryOperator(Operator):
 
     """Operator with N arguments.  e.g., multi-way joins in one step."""
+    __slots__ = ('args',)
 
     def __init__(self, args=None):
         Operator.__init__(self)
@@ -306,6 +377,9 @@ class NaryOperator(Operator):
         """Add a child operator to the end of the child argument list."""
         self.args.append(op)
 
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ and self.args == other.args
+
     def children(self):
         return self.args
 
@@ -504,24 +578,56 @@ class CompositeBinaryOperator(BinaryOperator):
         return expression.EQ(expression.UnnamedAttributeRef(col0),
                              expression.UnnamedAttributeRef(col1))
 
+    def equijoin_pairs(self):
+        """Return the (left column, right column) pairs, relative to the
+        combined scheme, that the condition of this operator equates."""
+        return []
+
     def partitioning(self):
         """ The schemas are mutually exclusive
         so conjunction of the partition functions"""
-
-        # TODO: being conservative, just take one side because
-        # TODO: we don't support conjuncs in partition info
-        if self.left.partitioning().hash_partitioned != frozenset():
-            return RepresentationProperties(
-                hash_partitioned=self.left.partitioning().hash_partitioned)
-        elif self.right.partitioning().hash_partitioned != frozenset():
-            return RepresentationProperties(
-                hash_partitioned=self.right.partitioning().hash_partitioned)
-        elif self.left.partitioning().broadcasted and (
-                self.right.partitioning().broadcasted):
+        left = self.left.partitioning()
+        right = self.right.partitioning()
+        right_scheme = self.right.scheme()
+        offset = len(self.left.scheme())
+
+        def shift(key):
+            return frozenset(
+                expression.UnnamedAttributeRef(
+                    ref.get_position(right_scheme) + offset)
+                for ref in key)
+
+        left_hashes = left.hash_partitionings()
+        right_hashes = frozenset(shift(k) for k in right.hash_partitionings())
+
+        if left.hash_partitioned != frozenset():
+            hash_partitioned = left.hash_partitioned
+        elif right.hash_partitioned != frozenset():
+            hash_partitioned = shift(right.hash_partitioned)
+        elif left.broadcasted and right.broadcasted:
             return RepresentationProperties(broadcasted=True)
         else:
             return RepresentationProperties()
 
+        # A left and a right hash key hold together if the condition equates
+        # them column by column: matching tuples were on the same worker.
+        pairs = [(expression.UnnamedAttributeRef(l),
+                  expression.UnnamedAttributeRef(r))
+                 for l, r in self.equijoin_pairs()]
+        for left_key in left_hashes:
+            matched = [(l, r) for l, r in pairs if l in left_key]
+            if (len(matched) == len(left_key) and
+                    frozenset(l for l, _ in matched) == left_key and
+                    frozenset(r for _, r in matched) in right_hashes):
+                return RepresentationProperties(
+                    hash_partitioned=hash_partitioned,
+                    equivalent_hashes=left_hashes | right_hashes)
+
+        return RepresentationProperties(
+            hash_partitioned=hash_partitioned,
+            equivalent_hashes=(left_hashes if left.hash_partitioned
+                               else right_hashes))
+
     def scheme(self):
         """Return the scheme of the result."""
         return self.left.scheme() + self.right.scheme()
@@ -566,6 +672,21 @@ class Join(CompositeBinaryOperator):
         # this is black magic
         return int(self.left.num_tuples() * self.right.num_tuples() / 10)
 
+    def equijoin_pairs(self):
+        offset = len(self.left.scheme())
+        combined = self.left.scheme() + self.right.scheme()
+        pairs = []
+        for conjunc in expression.extract_conjuncs(self.condition):
+            if not (isinstance(conjunc, expression.EQ) and
+                    isinstance(conjunc.left, expression.AttributeRef) and
+                    isinstance(conjunc.right, expression.AttributeRef)):
+                continue
+            first, second = sorted((conjunc.left.get_position(combined),
+                                    conjunc.right.get_position(combined)))
+            if first < offset <= second:
+                pairs.append((first, second))
+        return pairs
+
     def copy(self, other):
         """deep copy"""
         self.condition = other.condition
@@ -618,31 +739,53 @@ def resolve_attribute_name(user_name, scheme, sexpr, index):
 
 def project_partitioning(columnlist, input_partitioning):
     """Return the partitioning for a simple projection that supports
-    duplicates, swapping, and removal"""
-
-    if input_partitioning.hash_partitioned <= frozenset(columnlist):
-        # Translate to new schema.
-
-        # In general, Apply can make hash partitioning into a disjunction
-        # for example, Apply(b=a, c=a)
-        #     b or c could be the partition attribute but not both together
-        # We are conservative: just pick the first
-        newrefs = {}
-        for newi, old in [(newi, old)
-                          for newi, old in enumerate(columnlist)
-                          if old in input_partitioning.hash_partitioned]:
-            # keep only the first instance of input column
-            if old not in newrefs:
-                newrefs[old] = newi
-
-        return RepresentationProperties(
-            hash_partitioned=frozenset(
-                expression.UnnamedAttributeRef(i)
-                for i in newrefs.values()),
-            broadcasted=input_partitioning.broadcasted)
-    else:
-        return RepresentationProperties(
-            broadcasted=input_partitioning.broadcasted)
+    duplicates, swapping, and removal. Entries of columnlist that are not
+    input columns (e.g., computed columns) may be None."""
+
+    # In general, Apply can make hash partitioning into a disjunction
+    # for example, Apply(b=a, c=a)
+    #     b or c could be the partition attribute but not both together
+    # We are conservative: just pick the first instance of each input column
+    newrefs = {}
+    for newi, old in enumerate(columnlist):
+        if old is not None and old not in newrefs:
+            newrefs[old] = expression.UnnamedAttributeRef(newi)
+
+    def translate(refs):
+        if not all(ref in newrefs for ref in refs):
+            return None
+        return frozenset(newrefs[ref] for ref in refs)
+
+    hash_partitioned = frozenset()
+    equivalent_hashes = []
+    if input_partitioning.hash_partitioned:
+        # Translate to new schema, keeping the reported key if possible
+        keys = [frozenset(input_partitioning.hash_partitioned)] + sorted(
+            input_partitioning.equivalent_hashes,
+            key=lambda k: sorted(str(ref) for ref in k))
+        translated = [t for t in (translate(k) for k in keys)
+                      if t is not None]
+        if translated:
+            hash_partitioned = translated[0]
+            equivalent_hashes = translated[1:]
+
+    # keep the longest prefix of the sort order that is still present
+    sort_order = []
+    for ref, ascending in input_partitioning.sorted or ():
+        if ref not in newrefs:
+            break
+        sort_order.append((newrefs[ref], ascending))
+
+    grouped = None
+    if input_partitioning.grouped is not None:
+        grouped = translate(input_partitioning.grouped)
+
+    return RepresentationProperties(
+        hash_partitioned=hash_partitioned,
+        sorted=sort_order or None,
+        grouped=grouped,
+        broadcasted=input_partitioning.broadcasted,
+        equivalent_hashes=equivalent_hashes)
 
 
 class Apply(UnaryOperator):
@@ -689,9 +832,10 @@ class Apply(UnaryOperator):
 
         # find the emitters $i = Identity($k)
         simple_equals = [expr
+                         if isinstance(expr, expression.UnnamedAttributeRef)
+                         else None
                          for expr
-                         in self.get_unnamed_emit_exprs()
-                         if isinstance(expr, expression.UnnamedAttributeRef)]
+                         in self.get_unnamed_emit_exprs()]
 
         return project_partitioning(simple_equals, self.input.partitioning())
 
@@ -979,11 +1123,19 @@ class GroupBy(UnaryOperator):
         return self.input.num_tuples()
 
     def partitioning(self):
+        # the grouping columns come first in the output
+        input_scheme = self.input.scheme()
+        group_fields = [expression.toUnnamed(ref, input_scheme)
+                        if isinstance(ref, expression.AttributeRef) else None
+                        for ref in self.grouping_list]
         ip = self.input.partitioning()
-        if ip.hash_partitioned <= frozenset(self.grouping_list):
-            return ip
-        else:
-            return RepresentationProperties()
+        if not (ip.hash_partitioned and group_fields):
+            return RepresentationProperties(broadcasted=ip.broadcasted)
+        op = project_partitioning(group_fields, ip)
+        # hash aggregation does not preserve the order of the tuples
+        return RepresentationProperties(
+            hash_partitioned=op.hash_partitioned,
+            equivalent_hashes=op.equivalent_hashes)
 
     def shortStr(self):
         return "%s(%s; %s)" % (self.opname(),
@@ -1062,8 +1214,18 @@ class OrderBy(UnaryOperator):
         return self.input.num_tuples()
 
     def partitioning(self):
-        # TODO set sorted
-        return RepresentationProperties()
+        """Sorting is local to each worker, so the input stays in place"""
+        ip = self.input.partitioning()
+        input_scheme = self.input.scheme()
+        sort_order = [(expression.toUnnamed(col, input_scheme)
+                       if isinstance(col, expression.AttributeRef)
+                       else expression.UnnamedAttributeRef(col), asc)
+                      for col, asc in zip(self.sort_columns, self.ascending)]
+        return RepresentationProperties(
+            hash_partitioned=ip.hash_partitioned,
+            sorted=sort_order,
+            broadcasted=ip.broadcasted,
+            equivalent_hashes=ip.equivalent_hashes)
 
     def shortStr(self):
         ascend_string = ['+' if a else '-' for a in self.ascending]
@@ -1114,6 +1276,8 @@ class ProjectingJoin(Join):
     def partitioning(self):
         """Partitioning of a Join followed by a Project"""
         joinp = super(ProjectingJoin, self).partitioning()
+        if self.output_columns is None:
+            return joinp
 
         return project_partitioning(self.output_columns, joinp)
 
@@ -1833,26 +1997,456 @@ class DoWhile(NaryOperator):
 def inline_operator(dest_op, var, target_op):
     """Convert two operator trees into one by inlining.
 
+    Every reference to the variable is replaced by the same target_op
+    instance, so the result is a DAG if the variable is read more than once.
+    Operators that are already shared in dest_op are rewritten only once.
+
     :param dest_op: The Operator that is the inline destination
     :param var: The variable name (String) to replace.
     :param target_op: The operation to replace.
     """
-    # Wrap the bool in a list so we pass a pointer that does not change
-    # (the list) into the function.
-    has_inlined = [False]
+    rewritten = {}
 
     def rewrite_node(node):
         if isinstance(node, ScanTemp) and node.name == var:
-            if has_inlined[0]:
-                return copy.deepcopy(target_op)
-            has_inlined[0] = True
             return target_op
-        else:
-            return node.apply(rewrite_node)
+        if id(node) not in rewritten:
+            rewritten[id(node)] = node.apply(rewrite_node)
+        return rewritten[id(node)]
 
     return rewrite_node(dest_op)
 
 
+def unshare(op):
+    """Convert an operator DAG into a tree.
+
+    An operator that is reachable along more than one path is deep-copied
+    for each of its occurrences after the first. Algebras whose plans cannot
+    share subplans unshare the optimized plan, see Algebra.finalize; for a
+    chain of n statements that each read the previous variable twice, the
+    tree has 2 ** n leaves.
+
+    :param op: The root Operator of the DAG
+    :returns: The root Operator of the equivalent tree
+    """
+    seen = set()
+
+    def visit(node):
+        if id(node) in seen:
+            node = copy.deepcopy(node)
+        seen.add(id(node))
+        return node
+
+    return transform(op, pre=visit)
+
+
+# Operators that are never merged by intern: statements, which have effects,
+# and operators whose result may differ between two evaluations
+_UNMERGEABLE = (Store, StoreTemp, AppendTemp, Sink, Dump, Parallel,
+                Sequence, DoWhile, Fixpoint, State, SampleScan)
+
+# Operator fields that do not determine the result of an operator, or that
+# hold its children
+_STRUCTURE_FIELDS = frozenset(['bound', 'cleanup', '_trace', 'input',
+                               'left', 'right', 'args'])
+
+
+def intern(op):
+    """Merge the structurally identical subplans of a plan, so that each is
+    optimized and evaluated once.
+
+    Each operator of a group of equal operators, i.e., operators of the same
+    class with equal fields, schemes and children, is replaced by the first
+    one. Statements are not merged, nor are operators with a random result.
+    The statements of a Sequence or DoWhile are interned separately, since
+    a scan may read different data in each of them; the statements of a
+    Parallel block are independent and are interned together.
+
+    :param op: The root Operator of the plan, which is modified in place
+    :returns: The root Operator of the plan
+    """
+    # Each group of statements interned together
+    scopes = []
+    stack = [op]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (Sequence, Parallel, DoWhile)):
+            statements = [c for c in node.children()
+                          if not isinstance(c, (Sequence, Parallel, DoWhile))]
+            if isinstance(node, Parallel):
+                scopes.append(statements)
+            else:
+                scopes.extend([s] for s in statements)
+            stack.extend(c for c in node.children()
+                         if isinstance(c, (Sequence, Parallel, DoWhile)))
+        else:
+            scopes.append([node])
+
+    # id(operator) -> (operator, the operator that replaces it)
+    canonical = {}
+
+    def unvisited(node):
+        return [c for c in node.children() if id(c) not in canonical]
+
+    for statements in scopes:
+        # structural key -> operator
+        table = {}
+        for statement in statements:
+            for node in iter_postorder(statement, unvisited, distinct=True):
+                if id(node) in canonical:
+                    continue
+                children = [canonical[id(c)][1] for c in node.children()]
+                key = _intern_key(node, children)
+                if key is not None:
+                    canonical[id(node)] = (node, table.setdefault(key, node))
+                else:
+                    canonical[id(node)] = (node, node)
+
+    # The keys are computed first: relinking invalidates the cached schemes
+    # and hashes they use.
+    for node, replacement in canonical.values():
+        if node is replacement and any(
+                canonical[id(c)][1] is not c for c in node.children()):
+            node.apply(lambda c: canonical[id(c)][1])
+    return op
+
+
+def _intern_key(op, children):
+    """Return a hashable key of op that is equal for equal operators, or
+    None if op must not be merged."""
+    if isinstance(op, _UNMERGEABLE):
+        return None
+    try:
+        op_scheme = op.scheme()
+    except Exception:
+        # the scheme of some operators is only defined once their inputs
+        # are rewritten
+        return None
+
+    fields = []
+    state, slots = PropertyCache.getstate(op)
+    for name, value in sorted((state or {}).items() +
+                              (slots or {}).items()):
+        if name in _STRUCTURE_FIELDS or (name == 'alias' and value is op):
+            continue
+        key = _value_key(value)
+        if key is None:
+            return None
+        fields.append((name, key))
+    return (type(op), tuple(fields), tuple(op_scheme.get_names()),
+            tuple(op_scheme.get_types()), tuple(id(c) for c in children))
+
+
+def _value_key(value):
+    """A hashable key of an operator field, or None if there is none."""
+    if value is None or isinstance(value, (basestring, bool, int, long,
+                                           float)):
+        # 1 == 1.0 == True, but they are different values
+        return type(value), value
+    elif isinstance(value, expression.Expression):
+        if any(isinstance(e, expression.RANDOM) for e in value.walk()):
+            return None
+        # expression equality ignores the names in debug_info
+        return value, str(value)
+    elif isinstance(value, scheme.Scheme):
+        return tuple(value.get_names()), tuple(value.get_types())
+    elif isinstance(value, RelationKey):
+        return RelationKey, str(value)
+    elif isinstance(value, RepresentationProperties):
+        return value
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        keys = [_value_key(v) for v in value]
+        if any(k is None for k in keys):
+            return None
+        if isinstance(value, (set, frozenset)):
+            return frozenset(keys)
+        return type(value) is tuple, tuple(keys)
+    elif isinstance(value, dict):
+        keys = _value_key(sorted(value.items()))
+        return keys and ('dict', keys)
+    return None
+
+
+def _shallow_copy(op):
+    """Copy op and its expressions, but not its children."""
+    return copy.deepcopy(op, {id(c): c for c in op.children()})
+
+
+def _contents(value):
+    """Iterate over the expressions and lists of an operator field, without
+    descending into operators."""
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, Operator):
+            continue
+        if isinstance(value, expression.Expression):
+            yield value
+            state, slots = PropertyCache.getstate(value)
+            stack.extend((state or {}).values())
+            stack.extend((slots or {}).values())
+        elif isinstance(value, list):
+            yield value
+            stack.extend(value)
+        elif isinstance(value, tuple):
+            stack.extend(value)
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+
+
+def _fields(op):
+    """Iterate over the names and values of the fields of op."""
+    state, slots = PropertyCache.getstate(op)
+    for items in (state, slots):
+        for name, value in (items or {}).items():
+            if name not in _STRUCTURE_FIELDS:
+                yield name, value
+
+
+def rewrite_shared(op, rewrite, bottom_up=True):
+    """Apply rewrite to each operator of a plan that may share subplans, like
+    transform(op, post=rewrite), or pre=rewrite if not bottom_up, but to an
+    operator reachable along several paths only once.
+
+    Rules modify the operators they are fired on in place, and possibly
+    operators below them. That is safe for the operators below that are
+    reachable only through the one being rewritten: all its parents get the
+    result. The others are shared with other parts of the plan, so they are
+    copied on write. The modifications made by rewrite are recorded in an
+    UndoLog. If they include a shared operator, or an expression or list it
+    holds, they are undone, the shared operators that were modified are
+    replaced by copies on the paths to them from the operator being
+    rewritten, and rewrite is applied again. An expression or list that a
+    modified operator takes from a shared one is copied as well.
+
+    :param op: The root Operator of the plan
+    :param rewrite: A function from an Operator to its replacement
+    :returns: A pair of the root Operator of the rewritten plan and the
+    number of operators that were copied on write
+    """
+    return _SharedRewrite(op, rewrite).run(bottom_up)
+
+
+class _SharedRewrite(object):
+
+    """The state of one rewrite_shared pass over a plan."""
+
+    def __init__(self, root, rewrite):
+        self.root = root
+        self.rewrite = rewrite
+        self.copies = 0
+
+        references = collections.Counter()
+        for node in iter_postorder(root, _children, distinct=True):
+            for c in node.children():
+                references[id(c)] += 1
+        self.shared = any(n > 1 for n in references.values())
+        if not self.shared:
+            return
+
+        # Operators are partitioned into regions: a shared operator, or the
+        # root, and the operators below it that are reachable only through
+        # it. id(operator) -> (operator, the top of its region)
+        self.region = {id(root): (root, root)}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for c in node.children():
+                if id(c) not in self.region:
+                    top = c if references[id(c)] > 1 else \
+                        self.region[id(node)][1]
+                    self.region[id(c)] = (c, top)
+                    stack.append(c)
+
+        # id(expression or list) -> (it, the operator that holds it). An
+        # expression held by operators of different regions is copied.
+        self.owner = {}
+        for node, top in self.region.values():
+            for name, value in _fields(node):
+                if self._own(node, value, top):
+                    setattr(node, name, self._copy(value))
+                    self._own(node, getattr(node, name), None)
+
+    def run(self, bottom_up):
+        fire = self.fire if self.shared else self.rewrite
+        if bottom_up:
+            root = transform(self.root, post=fire, shared=True)
+        else:
+            root = transform(self.root, pre=fire, shared=True)
+        return root, self.copies
+
+    def _top(self, op):
+        return self.region.get(id(op), (None, None))[1]
+
+    def _protected(self, op, top):
+        """Is op shared with operators outside the region top?"""
+        other = self._top(op)
+        return other is not None and other is not top
+
+    def fire(self, node):
+        top = self._top(node) or node
+        while True:
+            log = UndoLog()
+            with log:
+                result = self.rewrite(node)
+            modified = {}
+            for obj, _, _ in log.entries:
+                if not isinstance(obj, Operator):
+                    obj = self.owner.get(id(obj), (None, None))[1]
+                if obj is not None and obj is not node and \
+                        self._protected(obj, top):
+                    modified[id(obj)] = obj
+            if not modified:
+                break
+            log.undo()
+            self._privatize(node, top, modified)
+        self._adopt(result, top, log)
+        return result
+
+    def _privatize(self, node, top, modified):
+        """Replace the operators in modified by copies that belong to the
+        region top, along with the operators on the paths from node to
+        them."""
+        on_path = set()
+        for op in iter_postorder(node, _children, distinct=True):
+            if id(op) in modified or any(id(c) in on_path
+                                         for c in op.children()):
+                on_path.add(id(op))
+
+        stack = [node]
+        while stack:
+            def copy_child(child):
+                if id(child) not in on_path:
+                    return child
+                child = _shallow_copy(child)
+                self.copies += 1
+                self.region[id(child)] = (child, top)
+                for _, value in _fields(child):
+                    self._own(child, value, None)
+                stack.append(child)
+                return child
+            stack.pop().apply(copy_child)
+
+    def _adopt(self, result, top, log):
+        """Add the operators, expressions and lists made by a rewrite to the
+        region top."""
+        stack = [result]
+        while stack:
+            op = stack.pop()
+            if id(op) not in self.region:
+                self.region[id(op)] = (op, top)
+                stack.extend(op.children())
+
+        for obj, name, _ in log.entries:
+            if isinstance(obj, Operator):
+                if name in _STRUCTURE_FIELDS or not hasattr(obj, name):
+                    continue
+                if self._own(obj, getattr(obj, name), top):
+                    setattr(obj, name, self._copy(getattr(obj, name)))
+                    self._own(obj, getattr(obj, name), None)
+                continue
+            owner = self.owner.get(id(obj), (None, None))[1]
+            if owner is None:
+                continue
+            if name is None:
+                if self._own(owner, obj, top):
+                    list.__setitem__(obj, slice(None), self._copy(list(obj)))
+                    self._own(owner, obj, None)
+            elif hasattr(obj, name):
+                if self._own(owner, getattr(obj, name), top):
+                    setattr(obj, name, self._copy(getattr(obj, name)))
+                    self._own(owner, getattr(obj, name), None)
+
+    def _own(self, op, value, top):
+        """Record that op holds the expressions and lists in value. If top is
+        not None, check first whether a shared operator outside the region
+        top holds one of them, and if so return True without recording."""
+        contents = list(_contents(value))
+        if top is not None:
+            for c in contents:
+                owner = self.owner.get(id(c), (None, None))[1]
+                if owner is not None and owner is not op and \
+                        self._protected(owner, top):
+                    return True
+        for c in contents:
+            self.owner[id(c)] = (c, op)
+        return False
+
+    @staticmethod
+    def _copy(value):
+        """Deep copy value, except for the operators it holds."""
+        operators = {}
+        stack = [value]
+        while stack:
+            v = stack.pop()
+            if isinstance(v, Operator):
+                operators[id(v)] = v
+            elif isinstance(v, (list, tuple)):
+                stack.extend(v)
+            elif isinstance(v, dict):
+                stack.extend(v.values())
+        return copy.deepcopy(value, operators)
+
+
+def transform(op, pre=None, post=None, shared=False):
+    """Rewrite an operator tree. Equivalent to the recursion
+
+        def visit(node):
+            if pre is not None:
+                node = pre(node)
+            node.apply(visit)
+            if post is not None:
+                node = post(node)
+            return node
+
+    but uses an explicit stack, so that deep plans do not exhaust the
+    recursion limit. The children of an operator are visited in order and
+    then passed to its apply method all at once.
+
+    :param op: The root Operator of the tree
+    :param pre: Function applied to each operator before its children
+    :param post: Function applied to each operator after its children
+    :param shared: If True, an operator that is reachable along several
+    paths of a DAG is rewritten only once, and all its parents get the
+    result; otherwise it is rewritten once per path.
+    :returns: The root Operator of the rewritten tree
+    """
+    # id(operator) -> (operator, result), for shared
+    done = {}
+
+    def enter(orig):
+        node = pre(orig) if pre is not None else orig
+        return orig, node, iter(list(node.children())), {}
+
+    stack = [enter(op)]
+    while True:
+        orig, node, children, results = stack[-1]
+        child = next(children, None)
+        if child is not None:
+            if id(child) in done:
+                results.setdefault(id(child), []).append(done[id(child)][1])
+            else:
+                stack.append(enter(child))
+            continue
+        stack.pop()
+
+        def take(child, results=results):
+            pending = results.get(id(child))
+            if pending:
+                return pending.pop(0)
+            # apply passed something other than the children
+            return transform(child, pre, post, shared)
+
+        node.apply(take)
+        if post is not None:
+            node = post(node)
+        if shared:
+            done[id(orig)] = (orig, node)
+        if not stack:
+            return node
+        stack[-1][3].setdefault(id(orig), []).append(node)
+
+
 def convertcondition(condition, left_len, combined_scheme):
     """Convert an equijoin condition to a pair of column lists.
        The positions in the column lists are relative to the
@@ -1,6 +1,7 @@
 from abc import ABCMeta, abstractmethod
 
 import logging
+from raco import algebra
 from raco.expression.visitor import ExpressionVisitor
 
 LOG = logging.getLogger(__name__)
@@ -13,6 +14,18 @@ class Algebra(object):
     def opt_rules(self, **kwargs):
         raise NotImplementedError("{op}.opt_rules()".format(op=type(self)))
 
+    def cache_key(self, rel_keys):
+        """Return a string identifying the configuration of this algebra, for
+        caching the plans compiled for it, or None if they must not be
+        cached. rel_keys are the relations referenced by the program."""
+        return None
+
+    def finalize(self, plan):
+        """Adapt an optimized plan, in which operators may be shared by
+        several parents, for this algebra. By default, each shared operator
+        is copied, since code generation expects a tree."""
+        return algebra.unshare(plan)
+
 
 class Language(object):
     __metaclass__ = ABCMeta
@@ -0,0 +1,167 @@
+"""Encode tuples in Myria's packed binary format, for
+MyriaConnection.upload_file(..., binary=True).
+
+Each tuple is written as its values one after the other, without padding.
+Numbers and booleans are written as fixed-width values (big-endian unless
+little_endian is set), and strings as their length in bytes, a 4 byte int,
+followed by their UTF-8 encoding. Uploading this format saves formatting
+text on the client and parsing it on the server.
+
+Values that do not fit their column, e.g. 2 ** 31 in an INT_TYPE column or
+2.5 in a LONG_TYPE column, raise ValueError instead of being wrapped or
+truncated.
+"""
+
+from itertools import chain, islice, izip
+import struct
+import warnings
+
+import raco.types as types
+
+__all__ = ['encode', 'encode_columns', 'iter_encode', 'iter_encode_columns']
+
+# struct codes of the fixed-width types; strings have a variable width
+_CODES = {
+    types.LONG_TYPE: 'q',
+    types.INT_TYPE: 'i',
+    types.DOUBLE_TYPE: 'd',
+    types.FLOAT_TYPE: 'f',
+    types.BOOLEAN_TYPE: '?',
+}
+
+# numpy codes of the fixed-width types
+_NUMPY_CODES = {'q': 'i8', 'i': 'i4', 'd': 'f8', 'f': 'f4', '?': 'b1'}
+
+
+def _codes(scheme):
+    """Return the struct code of each column, None for strings."""
+    codes = []
+    for name, _type in scheme.attributes:
+        if _type == types.STRING_TYPE:
+            codes.append(None)
+        elif _type in _CODES:
+            codes.append(_CODES[_type])
+        else:
+            raise ValueError('Column {} of type {} cannot be encoded'.format(
+                name, _type))
+    return codes
+
+
+def _pack(fmt, values):
+    """struct.pack, raising ValueError where struct would only warn about a
+    value that it truncates."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+            return struct.pack(fmt, *values)
+        except (struct.error, DeprecationWarning, RuntimeWarning) as e:
+            raise ValueError('Cannot encode value: {}'.format(e))
+
+
+def _batches(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_encode(scheme, tuples, little_endian=False, batch_size=8192):
+    """Encode tuples; yield one string of bytes per batch_size tuples.
+
+    :param scheme: the raco.scheme.Scheme of the tuples
+    :param tuples: an iterable of tuples
+    :param little_endian: write numbers in little-endian byte order
+    """
+    codes = _codes(scheme)
+    order = '<' if little_endian else '>'
+    width = len(codes)
+
+    if None not in codes:
+        # every tuple has the same layout: pack a whole batch at once
+        row = ''.join(codes)
+        for batch in _batches(tuples, batch_size):
+            if any(len(t) != width for t in batch):
+                raise ValueError('Expected tuples of {} values'.format(width))
+            yield _pack(order + row * len(batch), chain.from_iterable(batch))
+        return
+
+    for batch in _batches(tuples, batch_size):
+        fmt = [order]
+        values = []
+        for t in batch:
+            if len(t) != width:
+                raise ValueError('Expected tuples of {} values'.format(width))
+            for code, value in izip(codes, t):
+                if code is None:
+                    if isinstance(value, unicode):
+                        value = value.encode('utf-8')
+                    fmt.append('i%ds' % len(value))
+                    values.append(len(value))
+                else:
+                    fmt.append(code)
+                values.append(value)
+        yield _pack(''.join(fmt), values)
+
+
+def iter_encode_columns(scheme, columns, little_endian=False,
+                        batch_size=65536):
+    """Encode tuples given as one sequence of values per column, e.g. NumPy
+    arrays; yield one string of bytes per batch_size tuples.
+
+    If NumPy is available and no column is a string, each batch is encoded
+    with a single array copy. Integer columns are range-checked first, since
+    NumPy would wrap values that do not fit.
+    """
+    codes = _codes(scheme)
+    if len(columns) != len(codes):
+        raise ValueError('Expected {} columns'.format(len(codes)))
+    length = len(columns[0]) if columns else 0
+    if any(len(c) != length for c in columns):
+        raise ValueError('Columns have different lengths')
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is None or None in codes:
+        for chunk in iter_encode(scheme, izip(*columns), little_endian,
+                                 batch_size):
+            yield chunk
+        return
+
+    order = '<' if little_endian else '>'
+    dtype = np.dtype([('f%d' % i, order + _NUMPY_CODES[code])
+                      for i, code in enumerate(codes)])
+    for start in xrange(0, length, batch_size):
+        end = min(start + batch_size, length)
+        rows = np.empty(end - start, dtype=dtype)
+        for i, column in enumerate(columns):
+            values = np.asarray(column[start:end])
+            if codes[i] in 'iq':
+                _check_integers(np, values, dtype[i], scheme.getName(i))
+            rows['f%d' % i] = values
+        yield rows.tostring()
+
+
+def _check_integers(np, values, dtype, name):
+    if not len(values):
+        return
+    if values.dtype.kind not in 'iub':
+        raise ValueError('Column {} holds non-integer values of type {}'
+                         .format(name, values.dtype))
+    info = np.iinfo(dtype)
+    # compare as Python ints: NumPy compares uint64 and int64 as floats
+    if int(values.min()) < info.min or int(values.max()) > info.max:
+        raise ValueError('Column {} holds values outside of [{}, {}]'
+                         .format(name, info.min, info.max))
+
+
+def encode(scheme, tuples, little_endian=False):
+    """Return the encoding of tuples as one string of bytes."""
+    return ''.join(iter_encode(scheme, tuples, little_endian))
+
+
+def encode_columns(scheme, columns, little_endian=False):
+    """Return the encoding of columns as one string of bytes."""
+    return ''.join(iter_encode_columns(scheme, columns, little_endian))
@@ -1,4 +1,10 @@
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
 from raco.catalog import Catalog
+from raco.relation_key import RelationKey
 import raco.scheme as scheme
 from raco.representation import RepresentationProperties
 from raco.expression import UnnamedAttributeRef as AttIndex
@@ -7,21 +13,134 @@ from .errors import MyriaError
 
 
 class MyriaCatalog(Catalog):
+    """A catalog backed by the REST interface of a Myria coordinator.
+
+    Dataset descriptors and the number of alive workers are cached, so that
+    the scheme, cardinality and partitioning of a relation cost one request.
+    Cached entries are reused for ttl seconds, and never expire during a
+    compiling() block, which the MyriaL statement processor enters while it
+    evaluates and compiles a program. Relations written by queries and
+    uploads made through the catalog's connection are invalidated; call
+    invalidate after changing a relation by other means.
+    """
 
-    def __init__(self, connection):
+    def __init__(self, connection, ttl=30, max_workers=8, clock=time.time):
+        """
+        :param connection: a raco.backends.myria.connection.MyriaConnection
+        :param ttl: seconds cached metadata is reused for, 0 to disable
+        :param max_workers: number of concurrent requests made by prefetch
+        :param clock: returns the current time in seconds
+        """
         self.connection = connection
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.clock = clock
+        # map from relation key to (fetch time, dataset descriptor)
+        self._datasets = {}
+        # (fetch time, list of alive workers)
+        self._workers = None
+        self._lock = threading.Lock()
+        # time at which the outermost compiling() block began
+        self._compile_start = None
+        if connection:
+            connection.add_relation_listener(self._relations_changed)
 
-    def get_scheme(self, rel_key):
-        relation_args = {
+    def _relations_changed(self, relation_keys):
+        for key in relation_keys or [None]:
+            try:
+                self.invalidate(RelationKey(key['userName'],
+                                            key['programName'],
+                                            key['relationName']))
+            except (KeyError, TypeError):
+                # unknown relations; forget everything
+                self.invalidate()
+
+    def _fresh(self, entry):
+        if entry is None:
+            return False
+        fetched, _ = entry
+        if self._compile_start is not None:
+            # everything fetched within ttl of the compilation start is kept
+            # until the compilation ends
+            return fetched + self.ttl >= self._compile_start
+        return fetched + self.ttl > self.clock()
+
+    @contextmanager
+    def compiling(self):
+        """Use each dataset descriptor fetched in the block for the whole
+        block, so that one compilation sees consistent metadata."""
+        outermost = self._compile_start is None
+        if outermost:
+            self._compile_start = self.clock()
+        try:
+            yield self
+        finally:
+            if outermost:
+                self._compile_start = None
+
+    def invalidate(self, rel_key=None):
+        """Forget the cached metadata of rel_key, or of everything."""
+        with self._lock:
+            if rel_key is None:
+                self._datasets.clear()
+                self._workers = None
+            else:
+                self._datasets.pop(rel_key, None)
+
+    @staticmethod
+    def _relation_args(rel_key):
+        return {
             'userName': rel_key.user,
             'programName': rel_key.program,
             'relationName': rel_key.relation
         }
+
+    def _dataset(self, rel_key):
+        """Return the dataset descriptor of rel_key; raise MyriaError if
+        the coordinator does not know it."""
+        with self._lock:
+            entry = self._datasets.get(rel_key)
+            if self._fresh(entry):
+                return entry[1]
+        fetched = self.clock()
+        dataset_info = self.connection.dataset(self._relation_args(rel_key))
+        with self._lock:
+            self._datasets[rel_key] = (fetched, dataset_info)
+        return dataset_info
+
+    def prefetch(self, rel_keys):
+        """Fetch the dataset descriptors of rel_keys concurrently."""
+        if not self.connection:
+            return
+        with self._lock:
+            missing = [key for key in set(rel_keys)
+                       if not self._fresh(self._datasets.get(key))]
+        if not missing:
+            return
+
+        def fetch(rel_key):
+            try:
+                self._dataset(rel_key)
+            except MyriaError:
+                # reported when the relation is used
+                pass
+
+        if len(missing) == 1 or self.max_workers <= 1:
+            map(fetch, missing)
+            return
+        pool = ThreadPool(min(self.max_workers, len(missing)))
+        try:
+            pool.map(fetch, missing)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_scheme(self, rel_key):
         if not self.connection:
             raise RuntimeError(
                 "no schema for relation %s because no connection" % rel_key)
         try:
-            dataset_info = self.connection.dataset(relation_args)
+            dataset_info = self._dataset(rel_key)
         except MyriaError:
             raise ValueError('No relation {} in the catalog'.format(rel_key))
         schema = dataset_info['schema']
@@ -30,19 +149,20 @@ class MyriaCatalog(Catalog):
     def get_num_servers(self):
         if not self.connection:
             raise RuntimeError("no connection.")
-        return len(self.connection.workers_alive())
+        with self._lock:
+            entry = self._workers
+        if not self._fresh(entry):
+            entry = (self.clock(), self.connection.workers_alive())
+            with self._lock:
+                self._workers = entry
+        return len(entry[1])
 
     def num_tuples(self, rel_key):
-        relation_args = {
-            'userName': rel_key.user,
-            'programName': rel_key.program,
-            'relationName': rel_key.relation
-        }
         if not self.connection:
             raise RuntimeError(
                 "no cardinality of %s because no connection" % rel_key)
         try:
-            dataset_info = self.connection.dataset(relation_args)
+            dataset_info = self._dataset(rel_key)
         except MyriaError:
             raise ValueError(rel_key)
         num_tuples = dataset_info['numTuples']
@@ -54,16 +174,11 @@ class MyriaCatalog(Catalog):
         return DEFAULT_CARDINALITY
 
     def partitioning(self, rel_key):
-        relation_args = {
-            'userName': rel_key.user,
-            'programName': rel_key.program,
-            'relationName': rel_key.relation
-        }
         if not self.connection:
             raise RuntimeError(
                 "no schema for relation %s because no connection" % rel_key)
         try:
-            dataset_info = self.connection.dataset(relation_args)
+            dataset_info = self._dataset(rel_key)
         except MyriaError:
             raise ValueError('No relation {} in the catalog'.format(rel_key))
         distribute_function = dataset_info['howDistributed']['df']
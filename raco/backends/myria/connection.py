@@ -4,6 +4,7 @@ import json
 import csv
 from time import sleep
 import logging
+import tempfile
 import urllib
 from urlparse import urlparse, ParseResult
 from .errors import MyriaError
@@ -22,6 +23,76 @@ POST = 'POST'
 # Enable or configure logging
 logging.basicConfig(level=logging.WARN)
 
+# statuses of queries that will not change anymore
+_FINISHED = frozenset(['SUCCESS', 'ERROR', 'KILLED'])
+
+
+def _parse_string(s):
+    return s.decode('utf-8')
+
+
+def _parse_boolean(s):
+    return s.lower() in ('true', '1')
+
+
+# Functions that convert CSV values of each Myria type
+_PARSERS = {
+    'LONG_TYPE': int,
+    'INT_TYPE': int,
+    'DOUBLE_TYPE': float,
+    'FLOAT_TYPE': float,
+    'BOOLEAN_TYPE': _parse_boolean,
+    'STRING_TYPE': _parse_string,
+}
+
+_DELIMITERS = {'csv': ',', 'tsv': '\t'}
+
+
+def _iter_lines(chunks):
+    """Split a stream of chunks into lines, keeping the line endings so that
+    the csv module can read quoted values that span lines."""
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).splitlines(True)
+        pending = lines.pop() if lines and not lines[-1].endswith('\n') \
+            else ''
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _iter_json_array(chunks):
+    """Incrementally decode the values of a JSON array from a stream of
+    chunks."""
+    decoder = json.JSONDecoder()
+    buf, pos = '', 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise MyriaError('Expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the value continues in the next chunk
+                break
+            pos = end
+            yield value
+    raise MyriaError('Truncated JSON array')
+
 
 class MyriaConnection(object):
     """Contains a connection the Myria REST server."""
@@ -95,6 +166,38 @@ class MyriaConnection(object):
         self._session = requests.Session()
         self._session.headers.update(self._DEFAULT_HEADERS)
         self.execution_url = execution_url
+        self._relation_listeners = []
+        # map from query id to the relations its submitted plan stores
+        self._pending_stores = {}
+
+    def add_relation_listener(self, callback):
+        """Call callback(relation_keys) after a query or an upload through
+        this connection may have changed relations. relation_keys is a list
+        of relation key dicts, or None if any relation may have changed."""
+        self._relation_listeners.append(callback)
+
+    def _relations_changed(self, relation_keys):
+        if relation_keys == []:
+            return
+        for callback in self._relation_listeners:
+            callback(relation_keys)
+
+    @staticmethod
+    def stored_relations(query):
+        """Return the relation keys of the relations a Myria physical plan
+        stores to."""
+        keys = []
+        stack = [query]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, dict):
+                if value.get('opType') == 'DbInsert' and \
+                        'relationKey' in value:
+                    keys.append(value['relationKey'])
+                stack.extend(value.values())
+            elif isinstance(value, list):
+                stack.extend(value)
+        return keys
 
     def _finish_async_request(self, method, url, body=None, accept=JSON):
         headers = {
@@ -225,6 +328,77 @@ class MyriaConnection(object):
                                       relation_key['relationName']),
                               params={'format': 'json'})
 
+    def iter_dataset(self, relation_key, schema=None, data_format='csv',
+                     chunk_size=65536):
+        """Download the data in the dataset as a stream of typed tuples.
+
+        The response is read and parsed chunk by chunk, so memory use does
+        not grow with the size of the dataset.
+
+        Args:
+            relation_key: relation to be downloaded.
+            schema: the schema of the relation, either a raco Scheme (e.g.,
+                from MyriaCatalog.get_scheme) or a Myria schema struct. If
+                None, it is requested from Myria.
+            data_format: 'csv', 'tsv' or 'json'.
+            chunk_size: number of bytes read from the response at a time.
+        """
+        if schema is None:
+            schema = self.dataset(relation_key)['schema']
+        if hasattr(schema, 'get_types'):
+            names, types = schema.get_names(), schema.get_types()
+        else:
+            names, types = schema['columnNames'], schema['columnTypes']
+        parsers = [_PARSERS.get(t, _parse_string) for t in types]
+
+        chunks = self._iter_dataset_chunks(relation_key, data_format,
+                                           chunk_size)
+        if data_format == 'json':
+            # values are already typed
+            for row in _iter_json_array(chunks):
+                yield tuple(row[n] for n in names)
+            return
+        if data_format not in _DELIMITERS:
+            raise ValueError('unsupported format {}'.format(data_format))
+
+        reader = csv.reader(_iter_lines(chunks),
+                            delimiter=_DELIMITERS[data_format])
+        header = [n.encode('utf-8') if isinstance(n, unicode) else n
+                  for n in names]
+        for i, row in enumerate(reader):
+            if i == 0 and row == header:
+                # the header
+                continue
+            yield tuple(p(v) for p, v in zip(parsers, row))
+
+    def download_dataset_to_file(self, relation_key, fp, data_format='csv',
+                                 chunk_size=65536):
+        """Write the data in the dataset to the open file fp, chunk by
+        chunk, and return the number of bytes written."""
+        written = 0
+        for chunk in self._iter_dataset_chunks(relation_key, data_format,
+                                               chunk_size):
+            fp.write(chunk)
+            written += len(chunk)
+        return written
+
+    def _iter_dataset_chunks(self, relation_key, data_format, chunk_size):
+        url = (self._url_start +
+               '/dataset/user-{}/program-{}/relation-{}/data'.format(
+                   relation_key['userName'],
+                   relation_key['programName'],
+                   relation_key['relationName']))
+        r = self._session.get(url, params={'format': data_format},
+                              stream=True)
+        try:
+            if r.status_code != 200:
+                raise MyriaError(r)
+            for chunk in r.iter_content(chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            r.close()
+
     @staticmethod
     def _ensure_schema(schema):
         return {'columnTypes': schema['columnTypes'],
@@ -259,7 +433,9 @@ class MyriaConnection(object):
                 'schema': self._ensure_schema(schema),
                 'source': source}
 
-        return self._make_request(POST, '/dataset', json.dumps(body))
+        ret = self._make_request(POST, '/dataset', json.dumps(body))
+        self._relations_changed([body['relationKey']])
+        return ret
 
     def execute_program(self, program, language="MyriaL", server=None):
         """Execute the program in the specified language on Myria, polling
@@ -282,6 +458,8 @@ class MyriaConnection(object):
         while True:
             r = requests.get(query_uri)
             if r.status_code == 200:
+                # the program may have stored to any relation
+                self._relations_changed(None)
                 return r.json()
             elif r.status_code == 202:
                 # Sleep 100 ms before re-checking the status
@@ -313,7 +491,28 @@ class MyriaConnection(object):
         """
 
         body = json.dumps(query)
-        return self._wrap_post('/query', data=body)
+        status = self._wrap_post('/query', data=body)
+        self._query_submitted(query, status)
+        return status
+
+    def _query_submitted(self, query, status):
+        """Record that query was submitted and has the given status: the
+        relations it stores to change now, and again when it finishes."""
+        stored = self.stored_relations(query)
+        self._relations_changed(stored)
+        if stored and status.get('queryId') is not None and \
+                status.get('status') not in _FINISHED:
+            self._pending_stores[int(status['queryId'])] = stored
+
+    def _query_status(self, status):
+        """Report the relations stored by a query once its status shows
+        that it finished. Return status."""
+        if status.get('status') in _FINISHED and \
+                status.get('queryId') is not None:
+            stored = self._pending_stores.pop(int(status['queryId']), None)
+            if stored:
+                self._relations_changed(stored)
+        return status
 
     def execute_query(self, query):
         """Submit the query to Myria, and poll its status until it finishes.
@@ -323,7 +522,9 @@ class MyriaConnection(object):
         """
 
         body = json.dumps(query)
-        return self._finish_async_request(POST, '/query', body)
+        status = self._finish_async_request(POST, '/query', body)
+        self._relations_changed(self.stored_relations(query))
+        return status
 
     def validate_query(self, query):
         """Submit the query to Myria for validation only.
@@ -343,7 +544,19 @@ class MyriaConnection(object):
         """
 
         resource_path = '/query/query-%d' % int(query_id)
-        return self._make_request(GET, resource_path)
+        return self._query_status(self._make_request(GET, resource_path))
+
+    def kill_query(self, query_id):
+        """Kill a submitted query.
+
+        Args:
+            query_id: the id of a submitted query
+        """
+
+        resource_path = '/query/query-%d' % int(query_id)
+        r = self._session.delete(self._url_start + resource_path)
+        if r.status_code not in [200, 202, 204]:
+            raise MyriaError(r)
 
     def get_query_plan(self, query_id, subquery_id):
         """Get the saved execution plan for a submitted query.
@@ -437,6 +650,35 @@ class MyriaConnection(object):
                                get_request=True)
         return r.json()
 
+    def upload_tuples(self, relation_key, scheme, tuples, overwrite=None,
+                      little_endian=False, columns=False):
+        """Upload tuples to Myria in the packed binary format.
+
+        The tuples are encoded into a temporary file that is then streamed
+        to Myria, so that the upload does not have to fit in memory.
+
+        Args:
+            relation_key: relation to be created.
+            scheme: the raco.scheme.Scheme of the tuples.
+            tuples: an iterable of tuples or, if columns is True, a sequence
+                of columns (e.g. NumPy arrays).
+            overwrite: optional boolean indicating that an existing relation
+                should be overwritten. Myria default is False.
+            little_endian: encode numbers in little-endian byte order.
+        """
+        from .binary import iter_encode, iter_encode_columns
+
+        encode = iter_encode_columns if columns else iter_encode
+        schema = {'columnNames': scheme.get_names(),
+                  'columnTypes': scheme.get_types()}
+        with tempfile.TemporaryFile() as data:
+            for chunk in encode(scheme, tuples, little_endian):
+                data.write(chunk)
+            data.seek(0)
+            return self.upload_file(relation_key, schema, data,
+                                    overwrite=overwrite, binary=True,
+                                    is_little_endian=little_endian)
+
     def upload_file(self, relation_key, schema, data, overwrite=None,
                     delimiter=None, binary=None, is_little_endian=None):
         """Upload a file in a streaming manner to Myria.
@@ -475,4 +717,5 @@ class MyriaConnection(object):
         if r.status_code not in (200, 201):
             raise MyriaError('Error %d: %s'
                              % (r.status_code, r.text))
+        self._relations_changed([relation_key])
         return r.json()
@@ -10,3 +10,11 @@ class MyriaError(Exception):
             Exception.__init__(self, msg)
         else:
             Exception.__init__(self, err)
+
+
+class MyriaQueryError(MyriaError):
+    """A submitted query failed, was killed or timed out. status is the last
+    query status struct received from Myria, if any."""
+    def __init__(self, msg, status=None):
+        MyriaError.__init__(self, msg)
+        self.status = status
@@ -1,6 +1,8 @@
+import copy
 import itertools
 import logging
-from collections import defaultdict, deque
+import math
+from collections import defaultdict
 from functools import reduce
 from operator import mul
 
@@ -18,15 +20,15 @@ from raco.expression import UnnamedAttributeRef
 from raco.expression import WORKERID, COUNTALL
 from raco.representation import RepresentationProperties
 from raco.rules import distributed_group_by, check_partition_equality
+from raco.utility import iter_postorder, iter_preorder
 
 LOGGER = logging.getLogger(__name__)
 
 
 def scheme_to_schema(s):
     if s:
-        names, descrs = zip(*s.asdict.items())
-        names = ["%s" % n for n in names]
-        types_ = [r[1] for r in descrs]
+        names = ["%s" % n for n in s.get_names()]
+        types_ = s.get_types()
     else:
         names = []
         types_ = []
@@ -98,11 +100,11 @@ def compile_expr(op, child_scheme, state_scheme):
             }
         }
     elif isinstance(op, expression.SUBSTR):
-        children = []
-        op.operands[1] = expression.CAST(types.INT_TYPE, op.operands[1])
-        op.operands[2] = expression.CAST(types.INT_TYPE, op.operands[2])
-        for operand in op.operands:
-            children.append(compile_expr(operand, child_scheme, state_scheme))
+        operands = [op.operands[0],
+                    expression.CAST(types.INT_TYPE, op.operands[1]),
+                    expression.CAST(types.INT_TYPE, op.operands[2])]
+        children = [compile_expr(operand, child_scheme, state_scheme)
+                    for operand in operands]
         return {
             'type': op.opname(),
             'children': children
@@ -878,7 +880,7 @@ class MyriaHyperCubeShuffleProducer(algebra.UnaryOperator, MyriaOperator):
         return MyriaHyperCubeShuffle(
             self.input,
             self.hashed_columns,
-            self.mapped_hc_dims,
+            self.mapped_hc_dimensions,
             self.hyper_cube_dimensions,
             self.cell_partition).partitioning()
 
@@ -1157,19 +1159,47 @@ class BreakSplit(rules.Rule):
 class CollectBeforeLimit(rules.Rule):
 
     """Similar to a decomposable GroupBy, rewrite Limit as
-    Limit[Collect[Limit]]"""
+    Limit[Collect[Limit]], and a top-k query Limit[OrderBy] as
+    Limit[OrderBy[Collect[Limit[OrderBy]]]], so that each worker sends at
+    most count tuples to the collector"""
+
+    @staticmethod
+    def local_limit(count, op):
+        """Limit op on each worker. The Limits below UnionAlls and Applies
+        that return at least as many tuples as this one, e.g., those added
+        by PushLimit, can be evaluated on each worker as well."""
+        def localize(op):
+            if isinstance(op, algebra.UnionAll):
+                op.args = [localize(arg) for arg in op.args]
+            elif isinstance(op, algebra.Apply):
+                op.input = localize(op.input)
+            elif (op.__class__ == algebra.Limit and op.count >= count and
+                  not isinstance(op.input, algebra.OrderBy)):
+                return MyriaLimit(op.count, localize(op.input))
+            return op
+
+        return MyriaLimit(count, localize(op))
 
     def fire(self, exp):
-        if exp.__class__ == algebra.Limit:
-            return MyriaLimit(exp.count,
-                              algebra.Collect(
-                                  MyriaLimit(exp.count, exp.input)))
+        if exp.__class__ != algebra.Limit:
+            return exp
 
-        return exp
+        if isinstance(exp.input, algebra.OrderBy):
+            order = exp.input
+            local = self.local_limit(exp.count, algebra.OrderBy(
+                order.input, list(order.sort_columns), list(order.ascending)))
+            return MyriaLimit(exp.count, algebra.OrderBy(
+                algebra.Collect(local), order.sort_columns, order.ascending))
+
+        return MyriaLimit(exp.count,
+                          algebra.Collect(
+                              self.local_limit(exp.count, exp.input)))
 
 
 class ShuffleBeforeSetop(rules.Rule):
 
+    bottom_up = True
+
     def fire(self, exp):
         if not isinstance(exp, (algebra.Difference, algebra.Intersection)):
             return exp
@@ -1194,6 +1224,8 @@ class ShuffleBeforeSetop(rules.Rule):
 
 class ShuffleBeforeJoin(rules.Rule):
 
+    bottom_up = True
+
     def fire(self, expr):
         # If not a join, who cares?
         if not isinstance(expr, algebra.Join):
@@ -1212,10 +1244,14 @@ class ShuffleBeforeJoin(rules.Rule):
         right_cols = [expression.UnnamedAttributeRef(i)
                       for i in right_cols]
 
+        # An input joined with an explicitly broadcast input can stay where
+        # it is, e.g., the skewed input of a SkewAwareShuffleBeforeJoin plan
         if check_partition_equality(expr.left, left_cols):
             new_left = expr.left
         elif expr.left.partitioning().broadcasted:
             new_left = expr.left
+        elif isinstance(expr.right, algebra.Broadcast):
+            new_left = expr.left
         else:
             new_left = algebra.Shuffle(expr.left, left_cols)
 
@@ -1223,6 +1259,8 @@ class ShuffleBeforeJoin(rules.Rule):
             new_right = expr.right
         elif expr.right.partitioning().broadcasted:
             new_right = expr.right
+        elif isinstance(expr.left, algebra.Broadcast):
+            new_right = expr.right
         else:
             new_right = algebra.Shuffle(expr.right, right_cols)
 
@@ -1237,6 +1275,306 @@ class ShuffleBeforeJoin(rules.Rule):
         return "Join => Shuffle(Join)"
 
 
+class BroadcastBeforeJoin(rules.Rule):
+
+    """Broadcast the small input of a join and leave the large input in place
+    when that moves fewer bytes than hash partitioning both inputs.
+
+    Hash partitioning sends every tuple of each input that is not already
+    partitioned on the join columns once. Broadcasting sends every tuple of
+    the small input to each server. The broadcast is chosen when its cost is
+    at most threshold times the cost of the shuffles, so a threshold of 0
+    disables it.
+    """
+
+    def __init__(self, catalog, threshold=1.0):
+        assert isinstance(catalog, Catalog)
+        self.catalog = catalog
+        self.threshold = threshold
+        super(BroadcastBeforeJoin, self).__init__()
+
+    @staticmethod
+    def num_bytes(op):
+        """Estimated size of the output of op, in bytes"""
+        width = sum(types.TYPE_SIZES.get(typ, 8)
+                    for typ in op.scheme().get_types())
+        return float(op.num_tuples()) * width
+
+    def fire(self, expr):
+        if not isinstance(expr, algebra.ProjectingJoin):
+            return expr
+
+        # skip joins whose inputs have already been placed
+        exchanges = (algebra.Shuffle, algebra.HyperCubeShuffle,
+                     algebra.Broadcast, algebra.Collect)
+        for child in (expr.left, expr.right):
+            if (isinstance(child, exchanges) or
+                    child.partitioning().broadcasted):
+                return expr
+
+        # with a single server, neither plan moves any data
+        num_servers = self.catalog.get_num_servers()
+        if num_servers <= 1:
+            return expr
+
+        try:
+            left_cols, right_cols = \
+                convertcondition(expr.condition,
+                                 len(expr.left.scheme()),
+                                 expr.left.scheme() + expr.right.scheme())
+            left_bytes = self.num_bytes(expr.left)
+            right_bytes = self.num_bytes(expr.right)
+        except NotImplementedError:
+            return expr
+
+        shuffle_bytes = 0.0
+        if not check_partition_equality(
+                expr.left, [UnnamedAttributeRef(i) for i in left_cols]):
+            shuffle_bytes += left_bytes
+        if not check_partition_equality(
+                expr.right, [UnnamedAttributeRef(i) for i in right_cols]):
+            shuffle_bytes += right_bytes
+
+        broadcast_bytes = min(left_bytes, right_bytes) * num_servers
+        if broadcast_bytes > self.threshold * shuffle_bytes:
+            return expr
+
+        if left_bytes < right_bytes:
+            expr.left = algebra.Broadcast(expr.left)
+        else:
+            expr.right = algebra.Broadcast(expr.right)
+        return expr
+
+    def __str__(self):
+        return "Join => Join(Broadcast) if cheaper than Join(Shuffle)"
+
+
+def duplicate_factor(catalog, op):
+    """Estimate the ratio of tuples to distinct tuples in the output of op,
+    or return None if it is unknown. The numbers of distinct tuples of the
+    scanned relations are looked up in the catalog.
+    """
+    if isinstance(op, algebra.Scan):
+        distinct = catalog.num_distinct_tuples(op.relation_key)
+        if not distinct:
+            return None
+        return max(1.0, float(op.num_tuples()) / distinct)
+    elif isinstance(op, (algebra.Distinct, algebra.GroupBy)):
+        return 1.0
+    elif isinstance(op, (algebra.Select, algebra.Shuffle,
+                         algebra.HyperCubeShuffle, algebra.Broadcast,
+                         algebra.Collect)):
+        return duplicate_factor(catalog, op.input)
+    elif isinstance(op, algebra.Apply):
+        # a permutation of the columns keeps the duplicates, but a
+        # projection adds an unknown number of them
+        positions = [e.get_position(op.input.scheme())
+                     for _, e in op.emitters
+                     if isinstance(e, expression.AttributeRef)]
+        if (len(positions) == len(op.emitters) and
+                sorted(positions) == range(len(op.input.scheme()))):
+            return duplicate_factor(catalog, op.input)
+        return None
+    elif isinstance(op, algebra.UnionAll):
+        factors = [duplicate_factor(catalog, arg) for arg in op.args]
+        if any(f is None for f in factors):
+            return None
+        # assumes that the inputs do not share tuples
+        distinct = sum(arg.num_tuples() / f
+                       for arg, f in zip(op.args, factors))
+        if not distinct:
+            return None
+        return max(1.0, sum(arg.num_tuples() for arg in op.args) / distinct)
+    return None
+
+
+def column_heavy_hitters(catalog, op, column):
+    """Return the heavy hitters of a column of op, as a dict from value to
+    number of occurrences. The column is traced through the operators that
+    preserve its values back to a scanned relation, whose heavy hitters are
+    looked up in the catalog. An empty dict means none are known.
+    """
+    while True:
+        if isinstance(op, algebra.Scan):
+            return catalog.heavy_hitters(op.relation_key, column) or {}
+        elif isinstance(op, (algebra.Select, algebra.Shuffle,
+                             algebra.HyperCubeShuffle, algebra.Broadcast,
+                             algebra.Collect)):
+            op = op.input
+        elif isinstance(op, algebra.Apply):
+            emitter = op.emitters[column][1]
+            if not isinstance(emitter, expression.AttributeRef):
+                return {}
+            column = emitter.get_position(op.input.scheme())
+            op = op.input
+        elif isinstance(op, algebra.ProjectingJoin):
+            if op.output_columns is not None:
+                column = op.output_columns[column].position
+            left_len = len(op.left.scheme())
+            if column < left_len:
+                op = op.left
+            else:
+                op, column = op.right, column - left_len
+        else:
+            return {}
+
+
+class DistinctBeforeShuffle(rules.Rule):
+
+    """Eliminate duplicates on each worker before the input of an operator
+    that returns distinct tuples, i.e., a Distinct or a set operation, is
+    shuffled, so that copies of a tuple are not sent over the network.
+
+    The local pass pays off only if there are enough duplicates: it is
+    added, or the one added by DecomposeGroupBy is kept, unless the
+    estimated ratio of tuples to distinct tuples of the input is below the
+    threshold. Must run after the shuffle logic and distributed_group_by.
+    """
+
+    def __init__(self, catalog=None, threshold=1.25):
+        self.catalog = catalog
+        self.threshold = threshold
+        super(DistinctBeforeShuffle, self).__init__()
+
+    def pays_off(self, op):
+        if self.catalog is None:
+            return True
+        factor = duplicate_factor(self.catalog, op)
+        return factor is None or factor >= self.threshold
+
+    def local_distinct(self, op):
+        """Return the input op of a deduplicating operator, changed to
+        eliminate duplicates before the shuffle if it pays off"""
+        if not isinstance(op, algebra.Shuffle):
+            return op
+
+        if isinstance(op.input, algebra.Distinct):
+            if not self.pays_off(op.input.input):
+                op.input = op.input.input
+        elif self.pays_off(op.input):
+            op.input = algebra.Distinct(op.input)
+        return op
+
+    def fire(self, exp):
+        if isinstance(exp, algebra.Distinct):
+            exp.input = self.local_distinct(exp.input)
+        elif isinstance(exp, (algebra.Union, algebra.Difference,
+                              algebra.Intersection)):
+            exp.left = self.local_distinct(exp.left)
+            exp.right = self.local_distinct(exp.right)
+        return exp
+
+    def __str__(self):
+        return "Distinct(Shuffle(X)) => Distinct(Shuffle(Distinct(X)))"
+
+
+class SkewAwareShuffleBeforeJoin(rules.Rule):
+
+    """Split a join on a key with heavy hitters into two joins. Tuples whose
+    key is not a heavy hitter are hash partitioned as usual. Tuples whose key
+    is a heavy hitter stay where they are on the skewed side and are matched
+    with a broadcast of the corresponding tuples of the other side.
+
+    Must run before ShuffleBeforeJoin, which then leaves both joins alone.
+    """
+
+    def __init__(self, catalog):
+        assert isinstance(catalog, Catalog)
+        self.catalog = catalog
+        super(SkewAwareShuffleBeforeJoin, self).__init__()
+
+    @staticmethod
+    def literal(value):
+        if isinstance(value, basestring):
+            return expression.StringLiteral(value)
+        return expression.NumericLiteral(value)
+
+    @staticmethod
+    def in_values(column, values):
+        """Predicate that the column equals one of the values"""
+        return reduce(expression.OR,
+                      [expression.EQ(UnnamedAttributeRef(column),
+                                     SkewAwareShuffleBeforeJoin.literal(v))
+                       for v in values])
+
+    @staticmethod
+    def not_in_values(column, values):
+        """Predicate that the column equals none of the values"""
+        return reduce(expression.AND,
+                      [expression.NEQ(UnnamedAttributeRef(column),
+                                      SkewAwareShuffleBeforeJoin.literal(v))
+                       for v in values])
+
+    def fire(self, expr):
+        if not isinstance(expr, algebra.ProjectingJoin):
+            return expr
+
+        # skip joins whose inputs have already been placed
+        exchanges = (algebra.Shuffle, algebra.HyperCubeShuffle,
+                     algebra.Broadcast, algebra.Collect)
+        for child in (expr.left, expr.right):
+            if (isinstance(child, exchanges) or
+                    child.partitioning().broadcasted):
+                return expr
+
+        try:
+            left_cols, right_cols = \
+                convertcondition(expr.condition,
+                                 len(expr.left.scheme()),
+                                 expr.left.scheme() + expr.right.scheme())
+        except NotImplementedError:
+            return expr
+        left_shuffle = [UnnamedAttributeRef(i) for i in left_cols]
+        right_shuffle = [UnnamedAttributeRef(i) for i in right_cols]
+        left_placed = check_partition_equality(expr.left, left_shuffle)
+        right_placed = check_partition_equality(expr.right, right_shuffle)
+        if left_placed and right_placed:
+            return expr
+
+        # split on the first join key that has heavy hitters
+        for left_col, right_col in zip(left_cols, right_cols):
+            left_heavy = column_heavy_hitters(
+                self.catalog, expr.left, left_col)
+            right_heavy = column_heavy_hitters(
+                self.catalog, expr.right, right_col)
+            if left_heavy or right_heavy:
+                break
+        else:
+            return expr
+
+        values = sorted(set(left_heavy) | set(right_heavy))
+        # the side with the most heavy tuples stays in place
+        keep_left = sum(left_heavy.values()) >= sum(right_heavy.values())
+
+        def light(child, col, shuffle, placed):
+            child = algebra.Select(self.not_in_values(col, values), child)
+            if placed:
+                return child
+            return algebra.Shuffle(child, shuffle)
+
+        def heavy(child, col, keep):
+            child = algebra.Select(self.in_values(col, values), child)
+            if keep:
+                return child
+            return algebra.Broadcast(child)
+
+        left, right = expr.left, expr.right
+        light_join = algebra.ProjectingJoin(
+            expr.condition,
+            light(left, left_col, left_shuffle, left_placed),
+            light(right, right_col, right_shuffle, right_placed),
+            expr.output_columns)
+        heavy_join = algebra.ProjectingJoin(
+            copy.deepcopy(expr.condition),
+            heavy(copy.deepcopy(left), left_col, keep_left),
+            heavy(copy.deepcopy(right), right_col, not keep_left),
+            copy.deepcopy(expr.output_columns))
+        return algebra.UnionAll([light_join, heavy_join])
+
+    def __str__(self):
+        return "Join => UnionAll(Join(Shuffle), Join(Broadcast))"
+
+
 class HCShuffleBeforeNaryJoin(rules.Rule):
 
     def __init__(self, catalog):
@@ -1263,8 +1601,14 @@ class HCShuffleBeforeNaryJoin(rules.Rule):
         return r_index
 
     @staticmethod
-    def workload(dim_sizes, child_sizes, r_index):
-        """Compute the workload given a hyper cube size assignment"""
+    def workload(dim_sizes, child_sizes, r_index, child_skews=None):
+        """Compute the workload given a hyper cube size assignment
+
+        child_skews, if given, holds for each child a dict from column index
+        to the number of occurrences of the most frequent value of the
+        column. All of those tuples hash to the same slice of the column's
+        dimension, so the dimension does not divide their load.
+        """
         load = 0.0
         for i, size in enumerate(child_sizes):
             # compute subcube sizes
@@ -1273,49 +1617,164 @@ class HCShuffleBeforeNaryJoin(rules.Rule):
                 if index != -1:
                     scale = scale * dim_sizes[index]
             # add load per server by child i
-            load += float(child_sizes[i]) / float(scale)
+            child_load = float(child_sizes[i]) / float(scale)
+            if child_skews:
+                for col, heavy in child_skews[i].items():
+                    index = r_index[i][col]
+                    if index != -1:
+                        child_load = max(
+                            child_load,
+                            float(min(heavy, size)) * dim_sizes[index] /
+                            float(scale))
+            load += child_load
         return load
 
+    @staticmethod
+    def relaxed_dim_size(num_server, child_sizes, r_index, num_dims,
+                         max_iterations=1000):
+        """Solve the continuous relaxation of the share problem.
+
+        Shares may be any real number >= 1. In log space the workload is a
+        convex function of the log-shares, and the constraint that the
+        product of shares is at most num_server is a linear one, so projected
+        gradient descent converges to the optimum.
+
+        Keyword arguments:
+        num_server -- number of servers, this bounds the product of shares.
+        child_sizes -- cardinality of each child.
+        r_index -- reversed index of join conditions.
+        num_dims -- number of hyper cube dimensions.
+        """
+        bound = math.log(num_server)
+        # as in workload, a dimension counts once per column mapped to it
+        child_dims = [[d for d in dims if d != -1] for dims in r_index]
+        log_sizes = [math.log(max(size, 1)) for size in child_sizes]
+
+        def loads(x):
+            return [math.exp(c - sum(x[d] for d in dims))
+                    for c, dims in zip(log_sizes, child_dims)]
+
+        def project(v):
+            """Euclidean projection on {x >= 0, sum(x) <= bound}"""
+            clipped = [max(vi, 0.0) for vi in v]
+            if sum(clipped) <= bound:
+                return clipped
+            ordered = sorted(v, reverse=True)
+            theta = ordered[0] - bound
+            total = 0.0
+            for j, u in enumerate(ordered):
+                total += u
+                t = (total - bound) / (j + 1)
+                if u - t > 0:
+                    theta = t
+            return [max(vi - theta, 0.0) for vi in v]
+
+        x = [bound / num_dims] * num_dims
+        step = 1.0
+        for _ in range(max_iterations):
+            child_loads = loads(x)
+            load = sum(child_loads)
+            # gradient of the workload, normalized by the workload itself
+            grad = [0.0] * num_dims
+            for child_load, dims in zip(child_loads, child_dims):
+                for d in dims:
+                    grad[d] -= child_load / load
+            while True:
+                y = project([xi - step * gi for xi, gi in zip(x, grad)])
+                if sum(loads(y)) <= load or step < 1e-12:
+                    break
+                step /= 2
+            if max(abs(yi - xi) for xi, yi in zip(x, y)) < 1e-9:
+                break
+            x = y
+            step = min(step * 2, 1e3)
+        return [math.exp(xi) for xi in x]
+
     @staticmethod
     def get_hyper_cube_dim_size(num_server, child_sizes,
-                                conditions, r_index):
-        """Find the optimal hyper cube dimension sizes using BFS.
+                                conditions, r_index, child_skews=None):
+        """Find the hyper cube dimension sizes that minimize the workload.
+
+        Solve the continuous relaxation of the problem, round the resulting
+        shares down and improve them by local search: repeatedly move to the
+        best neighbouring assignment (one share incremented, decremented, or
+        one incremented and another decremented) whose product is at most
+        num_server. Ties are broken in favor of a smaller maximum share.
 
         Keyword arguments:
         num_server -- number of servers, this sets upper bound of HC cells.
         child_sizes -- cardinality of each child.
-        child_schemes -- schemes of children.
         conditions -- join conditions.
         r_index -- reversed index of join conditions.
+        child_skews -- heavy hitter counts of each child, see workload.
         """
-        # Helper function: compute the product.
+        this = HCShuffleBeforeNaryJoin
+        num_dims = len(conditions)
+        if num_dims == 0:
+            return (), this.workload((), child_sizes, r_index, child_skews)
+
         def product(array):
             return reduce(mul, array, 1)
-        # Use BFS to find the best possible assignment.
-        this = HCShuffleBeforeNaryJoin
-        visited = set()
-        toVisit = deque()
-        toVisit.append(tuple([1 for _ in conditions]))
-        min_work_load = None
-        opt_dim_sizes = [0] * len(conditions)
-        while len(toVisit) > 0:
-            dim_sizes = toVisit.pop()
-            workload = this.workload(dim_sizes, child_sizes, r_index)
-            if ((workload < min_work_load) or (
-                workload == min_work_load and max(dim_sizes) < max(
-                    opt_dim_sizes)) or (min_work_load is None)):
-                min_work_load = this.workload(
-                    dim_sizes, child_sizes, r_index)
-                opt_dim_sizes = dim_sizes
-            visited.add(dim_sizes)
-            for i, d in enumerate(dim_sizes):
-                new_dim_sizes = (dim_sizes[0:i] +
-                                 tuple([dim_sizes[i] + 1]) +
-                                 dim_sizes[i + 1:])
-                if (product(new_dim_sizes) <= num_server and
-                        new_dim_sizes not in visited):
-                    toVisit.append(new_dim_sizes)
-        return opt_dim_sizes, min_work_load
+
+        def cost(dim_sizes):
+            return this.workload(dim_sizes, child_sizes, r_index,
+                                 child_skews)
+
+        def better(load, dim_sizes, best_load, best_dim_sizes):
+            if load < best_load * (1 - 1e-12):
+                return True
+            return (load <= best_load * (1 + 1e-12) and
+                    max(dim_sizes) < max(best_dim_sizes))
+
+        relaxed = this.relaxed_dim_size(
+            num_server, child_sizes, r_index, num_dims)
+        dim_sizes = [max(1, int(math.floor(r + 1e-9))) for r in relaxed]
+        while product(dim_sizes) > num_server:
+            dim_sizes[dim_sizes.index(max(dim_sizes))] -= 1
+        dim_sizes = tuple(dim_sizes)
+        min_work_load = cost(dim_sizes)
+
+        def moves(dim_sizes):
+            """Assignments that scale one share, or trade between two"""
+            for i in range(num_dims):
+                for new_i in (dim_sizes[i] + 1, dim_sizes[i] - 1,
+                              dim_sizes[i] * 2, dim_sizes[i] // 2):
+                    yield dim_sizes[:i] + (new_i,) + dim_sizes[i + 1:]
+                for j in range(num_dims):
+                    if i == j:
+                        continue
+                    for new_i, new_j in (
+                            (dim_sizes[i] + 1, dim_sizes[j] - 1),
+                            (dim_sizes[i] * 2, dim_sizes[j] // 2)):
+                        candidate = list(dim_sizes)
+                        candidate[i], candidate[j] = new_i, new_j
+                        yield tuple(candidate)
+
+        def neighbours(dim_sizes):
+            """Moves, each also followed by growing one share as much as
+            num_server allows, so that servers left idle are put to use"""
+            for candidate in moves(dim_sizes):
+                if min(candidate) < 1:
+                    continue
+                yield candidate
+                for j in range(num_dims):
+                    rest = product(candidate) // candidate[j]
+                    grown = max(1, num_server // rest)
+                    if grown != candidate[j]:
+                        yield candidate[:j] + (grown,) + candidate[j + 1:]
+
+        while True:
+            best = None
+            for candidate in neighbours(dim_sizes):
+                if product(candidate) > num_server:
+                    continue
+                load = cost(candidate)
+                if best is None or better(load, candidate, *best):
+                    best = (load, candidate)
+            if best is None or not better(best[0], best[1],
+                                          min_work_load, dim_sizes):
+                return dim_sizes, min_work_load
+            min_work_load, dim_sizes = best
 
     @staticmethod
     def coord_to_worker_id(coordinate, dim_sizes):
@@ -1351,15 +1810,27 @@ class HCShuffleBeforeNaryJoin(rules.Rule):
         # find which dims in hyper cube this relation is involved
         hashed_dims = [r_index[child_idx][col] for col in hashed_columns]
         assert -1 not in hashed_dims
-        # group by cell according to their projection on subcube voxel
-        cell_partition = defaultdict(list)
-        coor_ranges = [list(range(d)) for d in dim_sizes]
-        for coordinate in itertools.product(*coor_ranges):
-            # project a hypercube cell to a subcube voxel
-            voxel = [coordinate[dim] for dim in hashed_dims]
-            cell_partition[tuple(voxel)].append(
-                this.coord_to_worker_id(coordinate, dim_sizes))
-        return [wid for vox, wid in sorted(cell_partition.items())]
+        # a dimension hashed by several columns only contributes once;
+        # voxels are ordered by the first occurrence of each dimension
+        hashed_dims = sorted(set(hashed_dims), key=hashed_dims.index)
+        free_dims = [d for d in range(len(dim_sizes)) if d not in hashed_dims]
+        # worker id offset of one step along each dimension (row major)
+        strides = [reduce(mul, dim_sizes[k + 1:], 1)
+                   for k in range(len(dim_sizes))]
+
+        def offsets(dims):
+            """Sorted worker id offsets of all coordinates along dims"""
+            result = [0]
+            for d in dims:
+                result = [o + c * strides[d]
+                          for o in result for c in range(dim_sizes[d])]
+            return result
+
+        # the cells of a voxel are its base worker id plus the offsets of
+        # every coordinate along the dimensions this child is not hashed on
+        cell_offsets = sorted(offsets(free_dims))
+        return [[base + o for o in cell_offsets]
+                for base in offsets(hashed_dims)]
 
     def fire(self, expr):
         def add_hyper_shuffle():
@@ -1377,9 +1848,18 @@ class HCShuffleBeforeNaryJoin(rules.Rule):
             child_sizes = [child.num_tuples() for child in expr.children()]
             # get reversed index of join conditions
             r_index = this.reversed_index(child_schemes, conditions)
+            # get the most frequent value count of skewed join columns
+            child_skews = []
+            for child_idx, child in enumerate(expr.children()):
+                skews = {}
+                for col, index in enumerate(r_index[child_idx]):
+                    heavy = column_heavy_hitters(self.catalog, child, col)
+                    if index != -1 and heavy:
+                        skews[col] = max(heavy.values())
+                child_skews.append(skews)
             # compute optimal dimension sizes
             (dim_sizes, workload) = this.get_hyper_cube_dim_size(
-                num_server, child_sizes, conditions, r_index)
+                num_server, child_sizes, conditions, r_index, child_skews)
             # specify HyperCube shuffle to each child
             new_children = []
             for child_idx, child in enumerate(expr.children()):
@@ -1423,21 +1903,21 @@ class OrderByBeforeNaryJoin(rules.Rule):
         # if not NaryJoin, who cares?
         if not isinstance(expr, algebra.NaryJoin):
             return expr
-        ordered_child = sum(
-            [1 for child in expr.children()
-             if isinstance(child, algebra.OrderBy)])
-
-        # already applied
-        if ordered_child == len(expr.children()):
-            return expr
-        elif ordered_child > 0:
-            raise Exception("children are partially ordered? ")
-
         new_children = []
         for child in expr.children():
+            # already applied
+            if isinstance(child, algebra.OrderBy):
+                new_children.append(child)
+                continue
             # check: this rule must be applied after shuffle
             assert isinstance(child, algebra.HyperCubeShuffle)
             ascending = [True] * len(child.hashed_columns)
+            sort_order = [(UnnamedAttributeRef(col), True)
+                          for col in child.hashed_columns]
+            # no need to sort a child that arrives sorted
+            if child.partitioning().is_sorted(sort_order):
+                new_children.append(child)
+                continue
             new_children.append(
                 algebra.OrderBy(
                     child, child.hashed_columns, ascending))
@@ -1784,17 +2264,44 @@ class MyriaAlgebra(Algebra):
         MyriaSingleton
     )
 
+    def cache_key(self, rel_keys):
+        # the cost-based rules consult the catalog, when there is one
+        catalog = getattr(self, 'catalog', None)
+        if catalog is not None:
+            fingerprint = getattr(catalog, 'fingerprint', None)
+            if fingerprint is None:
+                return None
+            catalog = fingerprint(rel_keys)
+        return repr((type(self).__name__, catalog))
+
+    def finalize(self, plan):
+        return share_subplans(plan)
+
 
 class FlattenUnionAll(rules.Rule):
 
     @staticmethod
     def collect_children(op):
-        if isinstance(op, algebra.UnionAll):
-            children = []
-            for child in op.args:
-                children += FlattenUnionAll.collect_children(child)
-            return children
-        return [op]
+        # A UnionAll that occurs more than once, e.g., in a chain of
+        # statements that each read the previous variable twice, is kept, so
+        # that the plan does not grow exponentially.
+        occurrences = defaultdict(int)
+        unions = [op]
+        while unions:
+            for child in unions.pop().args:
+                occurrences[id(child)] += 1
+                if isinstance(child, algebra.UnionAll) and \
+                        occurrences[id(child)] == 1:
+                    unions.append(child)
+
+        def union_children(node):
+            if isinstance(node, algebra.UnionAll) and (
+                    node is op or occurrences[id(node)] == 1):
+                return node.args
+            return []
+
+        return [node for node in iter_preorder(op, union_children)
+                if not union_children(node)]
 
     def fire(self, op):
         if not isinstance(op, algebra.UnionAll):
@@ -1809,7 +2316,19 @@ class MyriaLeftDeepTreeAlgebra(MyriaAlgebra):
 
     """Myria physical algebra using left deep tree pipeline and 1-D shuffle"""
 
+    def __init__(self, catalog=None):
+        self.catalog = catalog
+
     def opt_rules(self, **kwargs):
+        # catalog aware shuffle rules, only used when there is a catalog
+        cost_based_shuffle_logic = []
+        if self.catalog is not None:
+            cost_based_shuffle_logic = [
+                BroadcastBeforeJoin(
+                    self.catalog,
+                    kwargs.get('broadcast_join_threshold', 1.0)),
+                SkewAwareShuffleBeforeJoin(self.catalog)]
+
         opt_grps_sequence = [
             rules.remove_trivial_sequences,
             [
@@ -1820,12 +2339,19 @@ class MyriaLeftDeepTreeAlgebra(MyriaAlgebra):
                 rules.DedupGroupBy(),
             ],
             rules.push_select,
+            [rules.InferJoinPredicates(), rules.MergeSelects()],
+            [rules.CommonSubexpressionElimination()],
             rules.push_project,
+            [rules.EagerAggregation(MyriaGroupBy)],
             rules.push_apply,
+            rules.push_limit,
+            cost_based_shuffle_logic,
             left_deep_tree_shuffle_logic,
             [PushSelectThroughShuffle()],
             rules.push_select,
             distributed_group_by(MyriaGroupBy),
+            [DistinctBeforeShuffle(
+                self.catalog, kwargs.get('local_distinct_threshold', 1.25))],
             [rules.PushApply()],
             [LogicalSampleToDistributedSample()],
             [FlattenUnionAll()],
@@ -1877,6 +2403,11 @@ class MyriaHyperCubeAlgebra(MyriaAlgebra):
             HCShuffleBeforeNaryJoin(self.catalog),
             OrderByBeforeNaryJoin(),
         ]
+        # binary joins that were not merged
+        cost_based_shuffle_logic = [
+            BroadcastBeforeJoin(
+                self.catalog, kwargs.get('broadcast_join_threshold', 1.0)),
+            SkewAwareShuffleBeforeJoin(self.catalog)]
 
         opt_grps_sequence = [
             rules.remove_trivial_sequences,
@@ -1888,13 +2419,19 @@ class MyriaHyperCubeAlgebra(MyriaAlgebra):
                 rules.DedupGroupBy(),
             ],
             rules.push_select,
+            [rules.InferJoinPredicates(), rules.MergeSelects()],
+            [rules.CommonSubexpressionElimination()],
             rules.push_project,
             merge_to_nary_join,
             rules.push_apply,
+            rules.push_limit,
+            cost_based_shuffle_logic,
             left_deep_tree_shuffle_logic,
             [PushSelectThroughShuffle()],
             rules.push_select,
             distributed_group_by(MyriaGroupBy),
+            [DistinctBeforeShuffle(
+                self.catalog, kwargs.get('local_distinct_threshold', 1.25))],
             [rules.DeDupBroadcastInputs()],
             hyper_cube_shuffle_logic
         ]
@@ -1953,14 +2490,101 @@ def ensure_store_temp(label, op):
     return MyriaStoreTemp(input=op, name=label)
 
 
-def compile_fragment(frag_root):
-    """Given a root operator, produce a SubQueryEncoding."""
+def share_subplans(plan):
+    """Make a plan in which an operator may have several parents executable
+    by Myria.
+
+    Within a SubQuery, i.e., a Parallel block or a single statement, a
+    shared operator computes its result once: a MyriaSplitProducer sends it
+    to a MyriaSplitConsumer in each parent. Fragments of different
+    SubQueries are not connected, so an operator that several SubQueries use
+    is copied for each. Shared leaves, such as scans, and shared
+    MyriaSplitConsumers are copied instead.
+    """
+    # id(operator) -> operator, for the SubQueries handled so far
+    used = {}
+
+    def subquery(statements):
+        def copy_used(op):
+            if id(op) in used:
+                return copy.deepcopy(op)
+            return op
+        block = algebra.transform(algebra.Parallel(statements),
+                                  pre=copy_used, shared=True)
+
+        def references():
+            """Return the operators of the SubQuery, and the number of
+            references to each."""
+            nodes = list(iter_postorder(block, lambda op: op.children(),
+                                        distinct=True))
+            counts = defaultdict(int)
+            for op in nodes:
+                for child in op.children():
+                    counts[id(child)] += 1
+            return nodes, counts
+
+        # Copy the shared operators that are cheap to copy
+        nodes, counts = references()
+        referenced = set()
+
+        def copy_cheap(child):
+            if counts[id(child)] > 1 and id(child) in referenced:
+                if isinstance(child, algebra.ZeroaryOperator):
+                    return copy.deepcopy(child)
+                if isinstance(child, MyriaSplitConsumer):
+                    return copy.deepcopy(child, {id(child.input): child.input})
+            referenced.add(id(child))
+            return child
+
+        for op in nodes:
+            op.apply(copy_cheap)
+
+        # Split the output of the other shared operators
+        nodes, counts = references()
+        producers = {}
+
+        def split(child):
+            if counts[id(child)] < 2 or isinstance(child, MyriaSplitProducer):
+                return child
+            if id(child) not in producers:
+                producers[id(child)] = MyriaSplitProducer(child)
+            return MyriaSplitConsumer(producers[id(child)])
+
+        for op in nodes:
+            op.apply(split)
+        for op in nodes + producers.values():
+            used[id(op)] = op
+        return list(block.args)
+
+    def visit(op):
+        if isinstance(op, algebra.Parallel):
+            op.args = subquery(op.args)
+        elif isinstance(op, (algebra.Sequence, algebra.DoWhile)):
+            op.args = [visit(c) for c in op.args]
+        else:
+            op = subquery([op])[0]
+        return op
+
+    return visit(plan)
+
+
+def compile_fragment(frag_root, op_ids=None, compiled=None):
+    """Given a root operator, produce a SubQueryEncoding.
+
+    op_ids maps the id() of each operator to its opId. Fragments compiled
+    into the same SubQuery must share it, so that their opIds are unique,
+    and the set compiled of the id()s of the roots of the fragments compiled
+    so far, so that the fragment of a MyriaSplitProducer with several
+    consumers is compiled once.
+    """
 
     # A dictionary mapping each object to a unique, object-dependent id.
     # Since we want this to be truly unique for each object instance, even if
     # two objects are equal, we use id(obj) as the key.
-    opid_factory = OpIdFactory()
-    op_ids = defaultdict(opid_factory.getter())
+    if op_ids is None:
+        op_ids = defaultdict(OpIdFactory().getter())
+    if compiled is None:
+        compiled = set()
 
     def one_fragment(rootOp):
         """Given an operator that is the root of a query fragment/plan, extract
@@ -2003,6 +2627,9 @@ def compile_fragment(frag_root):
         while len(queue) > 0:
             # Get the next fragment root
             rootOp = queue.pop(0)
+            if id(rootOp) in compiled:
+                continue
+            compiled.add(id(rootOp))
             # .. recursively learn the entire fragment, and any newly
             # discovered roots.
             (op_frag, op_queue) = one_fragment(rootOp)
@@ -2042,7 +2669,10 @@ def compile_plan(plan_op):
         plan_op = algebra.Parallel([plan_op])
 
     if isinstance(plan_op, algebra.Parallel):
-        frag_list = [compile_fragment(op) for op in plan_op.children()]
+        op_ids = defaultdict(OpIdFactory().getter())
+        compiled = set()
+        frag_list = [compile_fragment(op, op_ids, compiled)
+                     for op in plan_op.children()]
         return {"type": "SubQuery",
                 "fragments": list(itertools.chain(*frag_list))}
 
@@ -0,0 +1,363 @@
+"""Run many Myria queries concurrently.
+
+MyriaConnection.execute_query submits one query and polls its status until
+it finishes. A QueryManager submits queries and returns a QueryFuture for
+each one; a single background thread polls all of the queries in flight,
+backing off while a query's status does not change and fetching the status
+of many queries with one request. A query whose status cannot be fetched
+is polled again with the same backoff, and fails only after several polls
+in a row fail. Queries can be cancelled and given a timeout, after which
+they are killed.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from .connection import GET, POST
+from .errors import MyriaError, MyriaQueryError
+
+__all__ = ['QueryManager', 'QueryFuture']
+
+LOG = logging.getLogger(__name__)
+
+SUCCESS = 'SUCCESS'
+# statuses of queries that will not change anymore
+FAILED = frozenset(['ERROR', 'KILLED'])
+
+
+class QueryFuture(object):
+    """The eventual status of a query submitted through a QueryManager."""
+
+    def __init__(self, manager, plan, timeout=None):
+        self.manager = manager
+        self.plan = plan
+        # the id given to the query by Myria, once submitted
+        self.query_id = None
+        # the URL of the query's status, from the submission's Location
+        self.url = None
+        # the last query status struct received from Myria
+        self.status = None
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = manager.clock() + timeout
+        self._interval = manager.poll_interval
+        self._next_poll = manager.clock()
+        # number of polls in a row that failed
+        self._failures = 0
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._cancelled = False
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def done(self):
+        """Return True if the query finished, failed or was cancelled."""
+        return self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """Kill the query. Return False if it had already finished."""
+        return self.manager.cancel(self)
+
+    def result(self, timeout=None):
+        """Return the final status struct of the query, waiting at most
+        timeout seconds for it to finish. Raise MyriaQueryError if the
+        query failed, was cancelled or timed out."""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the error the query failed with, or None."""
+        if not self._done.wait(timeout):
+            raise MyriaError('Timed out waiting for query {}'.format(
+                self.query_id))
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once the query is done."""
+        with self._callbacks_lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, exception=None, cancelled=False):
+        with self._callbacks_lock:
+            if self.done():
+                return False
+            self._result = result
+            self._exception = exception
+            self._cancelled = cancelled
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                LOG.exception('exception in query callback')
+        return True
+
+    def __repr__(self):
+        return '{}(query_id={!r}, status={!r})'.format(
+            type(self).__name__, self.query_id,
+            self.status and self.status.get('status'))
+
+
+class QueryManager(object):
+    """Submit queries through a MyriaConnection and poll them together.
+
+    The manager uses the connection's session, so all requests share its
+    connection pool. Use it as a context manager, or call shutdown, to stop
+    the polling thread.
+    """
+
+    def __init__(self, connection, poll_interval=0.1, max_poll_interval=5.0,
+                 backoff=1.5, batch_size=4, max_poll_failures=5,
+                 clock=time.time):
+        """
+        :param connection: a raco.backends.myria.connection.MyriaConnection
+        :param poll_interval: seconds between the first polls of a query
+        :param max_poll_interval: longest time between two polls of a query
+        :param backoff: factor the interval grows by while the status of a
+        query does not change
+        :param batch_size: poll the statuses of at least this many queries
+        with one request, if their ids are less than 2 * batch_size apart
+        :param max_poll_failures: a query fails once this many polls of its
+        status in a row fail
+        :param clock: returns the current time in seconds
+        """
+        assert poll_interval > 0 and backoff >= 1 and max_poll_failures > 0
+        self.connection = connection
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max(poll_interval, max_poll_interval)
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.max_poll_failures = max_poll_failures
+        self.clock = clock
+        # map from query id to the QueryFuture of an unfinished query
+        self._in_flight = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, plan, timeout=None):
+        """Submit a physical plan and return its QueryFuture.
+
+        :param plan: a Myria physical plan as a Python object
+        :param timeout: kill the query if it runs longer than this many
+        seconds
+        """
+        if self._closed:
+            raise RuntimeError('QueryManager is shut down')
+        future = QueryFuture(self, plan, timeout)
+        try:
+            # the response to the submission is the first query status,
+            # and its Location the URL to poll
+            response = self.connection._make_request(
+                POST, '/query', json.dumps(plan), get_request=True)
+            status = response.json()
+            future.query_id = int(status['queryId'])
+            future.url = response.headers.get('Location') or status.get('url')
+            self.connection._query_submitted(plan, status)
+        except Exception as e:
+            future._finish(exception=MyriaQueryError(
+                'Unable to submit query: {}'.format(e)))
+            return future
+        if self._update(future, status):
+            with self._cond:
+                self._in_flight[future.query_id] = future
+                self._start()
+                self._cond.notify()
+        return future
+
+    def submit_all(self, plans, timeout=None):
+        """Submit physical plans; return their QueryFutures in order."""
+        return [self.submit(plan, timeout) for plan in plans]
+
+    def wait(self, futures, timeout=None):
+        """Wait until all futures are done, for at most timeout seconds.
+        Return the list of futures that are done."""
+        deadline = None if timeout is None else self.clock() + timeout
+        for future in futures:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - self.clock())
+            if not future._done.wait(remaining):
+                break
+        return [future for future in futures if future.done()]
+
+    def cancel(self, future, reason='cancelled'):
+        """Kill the query of future. Return False if it already finished."""
+        with self._cond:
+            self._in_flight.pop(future.query_id, None)
+        if future.done():
+            return False
+        if future.query_id is not None:
+            try:
+                self.connection.kill_query(future.query_id)
+            except MyriaError as e:
+                LOG.warning('unable to kill query %s: %s', future.query_id, e)
+        return future._finish(exception=MyriaQueryError(
+            'Query {} was {}'.format(future.query_id, reason),
+            future.status), cancelled=reason == 'cancelled')
+
+    def shutdown(self, cancel=False):
+        """Stop polling, after the queries in flight finish unless cancel
+        is True."""
+        if cancel:
+            with self._cond:
+                in_flight = self._in_flight.values()
+            for future in in_flight:
+                self.cancel(future)
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name='myria-query-manager')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _update(self, future, status):
+        """Record a new status of a query. Return True if it is still
+        running, and schedule its next poll."""
+        previous = future.status and future.status.get('status')
+        future.status = status
+        future._failures = 0
+        # lets the connection report the relations a finished query stored
+        self.connection._query_status(status)
+        state = status.get('status')
+        if state == SUCCESS:
+            future._finish(result=status)
+            return False
+        if state in FAILED:
+            future._finish(exception=MyriaQueryError(
+                'Query {} finished with status {}: {}'.format(
+                    future.query_id, state, status.get('message')),
+                status))
+            return False
+        if state == previous:
+            self._back_off(future)
+        else:
+            future._interval = self.poll_interval
+            future._next_poll = self.clock() + future._interval
+        return True
+
+    def _back_off(self, future):
+        future._interval = min(future._interval * self.backoff,
+                               self.max_poll_interval)
+        future._next_poll = self.clock() + future._interval
+
+    def _failed_poll(self, future, error):
+        """Record that the status of a query could not be fetched. Return
+        True if it will be polled again."""
+        future._failures += 1
+        if future._failures < self.max_poll_failures:
+            LOG.warning('unable to poll query %s (attempt %d of %d): %s',
+                        future.query_id, future._failures,
+                        self.max_poll_failures, error)
+            self._back_off(future)
+            return True
+        future._finish(exception=MyriaQueryError(
+            'Unable to poll query {} {} times in a row: {}'.format(
+                future.query_id, future._failures, error), future.status))
+        return False
+
+    def _get_status(self, future):
+        if future.url is None:
+            return self.connection.get_query_status(future.query_id)
+        return self.connection._make_request(GET, future.url)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._in_flight and not self._closed:
+                    self._cond.wait()
+                if not self._in_flight:
+                    return
+                now = self.clock()
+                futures = self._in_flight.values()
+                expired = [f for f in futures
+                           if f.deadline is not None and f.deadline <= now]
+                due = [f for f in futures
+                       if f._next_poll <= now and f not in expired]
+                if due:
+                    # poll queries that are nearly due along with them, so
+                    # that their statuses can be fetched together
+                    due = [f for f in futures if f not in expired and
+                           f._next_poll - f._interval / 2 <= now]
+                if not expired and not due:
+                    wake = [f._next_poll for f in futures]
+                    wake.extend(f.deadline for f in futures
+                                if f.deadline is not None)
+                    self._cond.wait(max(0, min(wake) - now))
+                    continue
+
+            for future in expired:
+                self.cancel(future, reason='timed out')
+            if due:
+                self._poll(due)
+
+    def _windows(self, ids):
+        """Group sorted query ids into windows of at most 2 * batch_size
+        consecutive ids. Return the (lowest, highest) ids of the windows that
+        hold at least batch_size of the ids."""
+        span = 2 * self.batch_size
+        windows = []
+        start = 0
+        for end in range(1, len(ids) + 1):
+            if end < len(ids) and ids[end] - ids[start] < span:
+                continue
+            if end - start >= self.batch_size:
+                windows.append((ids[start], ids[end - 1]))
+            start = end
+        return windows
+
+    def _poll(self, futures):
+        statuses = {}
+        ids = sorted(f.query_id for f in futures)
+        # a batch returns the status of every query in its range, from any
+        # user, so only dense ranges of ids are fetched together
+        for low, high in self._windows(ids):
+            try:
+                batch = self.connection.queries(max_id=high,
+                                                limit=high - low + 1)
+                statuses.update((int(s['queryId']), s)
+                                for s in batch.get('results', []))
+            except Exception as e:
+                LOG.warning('unable to fetch query statuses: %s', e)
+
+        for future in futures:
+            status = statuses.get(future.query_id)
+            if status is None:
+                try:
+                    status = self._get_status(future)
+                except Exception as e:
+                    with self._cond:
+                        if not future.done() and \
+                                not self._failed_poll(future, e):
+                            self._in_flight.pop(future.query_id, None)
+                    continue
+            with self._cond:
+                if future.done():
+                    continue
+                if not self._update(future, status):
+                    self._in_flight.pop(future.query_id, None)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from httmock import urlmatch, HTTMock
+import struct
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from raco.backends.myria import binary
+from raco.backends.myria.connection import MyriaConnection
+from raco.scheme import Scheme
+import raco.types as types
+
+
+class TestBinary(unittest.TestCase):
+
+    numbers = Scheme([('id', types.LONG_TYPE), ('x', types.DOUBLE_TYPE),
+                      ('ok', types.BOOLEAN_TYPE)])
+    mixed = Scheme([('id', types.LONG_TYPE), ('name', types.STRING_TYPE),
+                    ('ok', types.BOOLEAN_TYPE)])
+
+    def test_fixed_width(self):
+        tuples = [(-i, i / 2.0, i % 2 == 0) for i in range(10)]
+        expected = ''.join(struct.pack('>qd?', *t) for t in tuples)
+        self.assertEqual(binary.encode(self.numbers, tuples), expected)
+        # batches are split at tuple boundaries
+        chunks = list(binary.iter_encode(self.numbers, tuples, batch_size=3))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(''.join(chunks), expected)
+
+        expected = ''.join(struct.pack('<qd?', *t) for t in tuples)
+        self.assertEqual(binary.encode(self.numbers, tuples, True), expected)
+
+    def test_strings(self):
+        tuples = [(1, 'Bill', True), (2, u'Zoë', False), (3, '', True)]
+        expected = (struct.pack('>qi4s?', 1, 4, 'Bill', True) +
+                    struct.pack('>qi4s?', 2, 4, 'Zo\xc3\xab', False) +
+                    struct.pack('>qi?', 3, 0, True))
+        self.assertEqual(binary.encode(self.mixed, tuples), expected)
+        chunks = binary.iter_encode(self.mixed, tuples, batch_size=2)
+        self.assertEqual(''.join(chunks), expected)
+
+    def test_columns(self):
+        columns = [[1, 2, 3], ['a', 'bc', u'é'], [True, False, True]]
+        self.assertEqual(binary.encode_columns(self.mixed, columns),
+                         binary.encode(self.mixed, zip(*columns)))
+        columns = [range(5), [0.5] * 5, [True] * 5]
+        self.assertEqual(binary.encode_columns(self.numbers, columns),
+                         binary.encode(self.numbers, zip(*columns)))
+
+    @unittest.skipIf(np is None, 'NumPy is not installed')
+    def test_numpy_columns(self):
+        columns = [np.arange(-5, 5), np.linspace(0, 1, 10),
+                   np.arange(10) % 3 == 0]
+        tuples = zip(*[c.tolist() for c in columns])
+        for little_endian in (False, True):
+            chunks = list(binary.iter_encode_columns(
+                self.numbers, columns, little_endian, batch_size=4))
+            self.assertEqual(len(chunks), 3)
+            self.assertEqual(''.join(chunks),
+                             binary.encode(self.numbers, tuples,
+                                           little_endian))
+
+        big = np.array([2 ** 63 - 1, 2 ** 63], dtype=np.uint64)
+        self.assertRaises(ValueError, binary.encode_columns, self.numbers,
+                          [big, columns[1][:2], columns[2][:2]])
+        self.assertRaises(ValueError, binary.encode_columns, self.numbers,
+                          [columns[1], columns[1], columns[2]])
+
+    def test_out_of_range(self):
+        # INT_TYPE columns are stored as LONG_TYPE
+        ints = Scheme([('x', types.INT_TYPE)])
+        self.assertEqual(binary.encode(ints, [(2 ** 31,)]),
+                         struct.pack('>q', 2 ** 31))
+        for scheme, t in ((self.numbers, (2 ** 63, 0.5, True)),
+                          (self.numbers, (2.5, 0.5, True)),
+                          (self.mixed, (-2 ** 63 - 1, 'a', True)),
+                          (self.mixed, (2.5, 'a', True))):
+            self.assertRaises(ValueError, binary.encode, scheme, [t])
+            self.assertRaises(ValueError, binary.encode_columns, scheme,
+                              [[v] for v in t])
+
+    def test_invalid(self):
+        dates = Scheme([('d', types.DATETIME_TYPE)])
+        self.assertRaises(ValueError, binary.encode, dates, [])
+        self.assertRaises(ValueError, binary.encode, self.mixed, [(1, 'a')])
+        self.assertRaises(ValueError, binary.encode_columns, self.mixed,
+                          [[1], ['a'], []])
+
+    def test_upload(self):
+        requests = []
+
+        @urlmatch(netloc=r'localhost:12345', path='/dataset')
+        def upload_mock(url, request):
+            requests.append(request.body.read())
+            return {'status_code': 201, 'content': '{}'}
+
+        connection = MyriaConnection(hostname='localhost', port=12345)
+        tuples = [(i, 'name%d' % i, True) for i in range(1000)]
+        relation = {'userName': 'public', 'programName': 'adhoc',
+                    'relationName': 'Names'}
+        with HTTMock(upload_mock):
+            connection.upload_tuples(relation, self.mixed, tuples,
+                                     little_endian=True)
+        body = requests[0]
+        self.assertIn(binary.encode(self.mixed, tuples, True), body)
+        self.assertIn('"STRING_TYPE"', body)
+        self.assertIn('name="binary"', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+from httmock import urlmatch, HTTMock
+import json
+import unittest
+
+from raco.backends.myria.connection import MyriaConnection
+from raco.backends.myria.catalog import MyriaCatalog
+from raco.relation_key import RelationKey
+import raco.myrial.interpreter as interpreter
+import raco.myrial.parser as myrialparser
+
+
+class CountingMock(object):
+    """A stub coordinator that counts the requests it receives."""
+
+    def __init__(self):
+        self.requests = []
+        self.query_status = 'RUNNING'
+
+    def handle(self, url, request):
+        self.requests.append(url.path)
+        if url.path in ('/query', '/query/query-7'):
+            status = {'queryId': 7, 'status': self.query_status}
+            return {'status_code': 202, 'content': json.dumps(status),
+                    'headers': {'Location': 'http://localhost:12345'
+                                            '/query/query-7'}}
+        if url.path == '/workers/alive':
+            return {'status_code': 200, 'content': json.dumps([1, 2])}
+        if 'relation-Missing' in url.path:
+            return {'status_code': 404, 'content': 'no such relation'}
+        dataset_info = {
+            'schema': {
+                'columnNames': [u'name', u'pages'],
+                'columnTypes': ['STRING_TYPE', 'LONG_TYPE']
+            },
+            'howDistributed': {
+                'df': {'type': 'Hash', 'indexes': [1]},
+                'workers': None
+            },
+            'numTuples': 50
+        }
+        return {'status_code': 200, 'content': dataset_info}
+
+    def count(self, what=''):
+        return len([p for p in self.requests if what in p])
+
+
+class Clock(object):
+    def __init__(self, step=0):
+        self.now = 1000.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+class TestMyriaCatalog(unittest.TestCase):
+
+    books = RelationKey('Brandon', 'Demo', 'MoreBooks')
+
+    def setUp(self):
+        self.mock = CountingMock()
+        self.clock = Clock()
+        self.catalog = MyriaCatalog(
+            MyriaConnection(hostname='localhost', port=12345),
+            ttl=10, clock=self.clock)
+
+    def stub(self):
+        return HTTMock(urlmatch(netloc=r'localhost:12345')(self.mock.handle))
+
+    def test_one_request_per_relation(self):
+        with self.stub():
+            self.assertEqual(len(self.catalog.get_scheme(self.books)), 2)
+            self.assertEqual(self.catalog.num_tuples(self.books), 50)
+            self.assertTrue(
+                self.catalog.partitioning(self.books).hash_partitioned)
+            self.assertEqual(self.catalog.get_num_servers(), 2)
+            self.assertEqual(self.catalog.get_num_servers(), 2)
+        self.assertEqual(self.mock.count('/dataset'), 1)
+        self.assertEqual(self.mock.count('/workers'), 1)
+
+    def test_ttl_and_invalidate(self):
+        with self.stub():
+            self.catalog.num_tuples(self.books)
+            self.clock.now += 5
+            self.catalog.num_tuples(self.books)
+            self.assertEqual(self.mock.count(), 1)
+
+            self.clock.now += 10
+            self.catalog.num_tuples(self.books)
+            self.assertEqual(self.mock.count(), 2)
+
+            self.catalog.invalidate(self.books)
+            self.catalog.num_tuples(self.books)
+            self.assertEqual(self.mock.count(), 3)
+
+            # entries do not expire within a compilation
+            with self.catalog.compiling():
+                self.clock.now += 100
+                self.catalog.num_tuples(self.books)
+                self.assertEqual(self.mock.count(), 3)
+            self.catalog.num_tuples(self.books)
+            self.assertEqual(self.mock.count(), 4)
+
+    def test_missing_relation(self):
+        missing = RelationKey('Brandon', 'Demo', 'Missing')
+        with self.stub():
+            self.catalog.prefetch([missing])
+            with self.assertRaises(ValueError):
+                self.catalog.get_scheme(missing)
+
+    def test_prefetch_program(self):
+        program = """
+            books = scan(Brandon:Demo:MoreBooks);
+            pages = scan(Brandon:Demo:Pages);
+            out = [from books, pages where books.pages = pages.pages
+                   emit books.name];
+            store(out, Brandon:Demo:Out);
+            """
+        statements = myrialparser.Parser().parse(program)
+        with self.stub():
+            processor = interpreter.StatementProcessor(self.catalog, True)
+            processor.evaluate(statements)
+            processor.get_physical_plan()
+        # one request per relation the program reads
+        self.assertEqual(self.mock.count('/dataset'), 2)
+        self.assertEqual(self.mock.count('relation-Pages'), 1)
+
+        # metadata does not expire while a program is evaluated, or while
+        # it is compiled, even if every lookup takes longer than the ttl
+        self.clock.step = 100
+        self.catalog.invalidate()
+        with self.stub():
+            processor = interpreter.StatementProcessor(self.catalog, True)
+            processor.evaluate(statements)
+            self.assertEqual(self.mock.count('/dataset'), 4)
+            processor.get_physical_plan()
+            self.assertEqual(self.mock.count('/dataset'), 4)
+
+    def test_writes_invalidate(self):
+        """Queries and uploads through the catalog's connection invalidate
+        the relations they write"""
+        connection = self.catalog.connection
+        books = {'userName': 'Brandon', 'programName': 'Demo',
+                 'relationName': 'MoreBooks'}
+        plan = {'rawQuery': 'store', 'plan': {
+            'type': 'SubQuery', 'fragments': [{'operators': [
+                {'opId': 0, 'opType': 'EmptyRelation'},
+                {'opId': 1, 'opType': 'DbInsert', 'argChild': 0,
+                 'relationKey': books}]}]}}
+        self.assertEqual(connection.stored_relations(plan), [books])
+
+        def fetches():
+            self.catalog.num_tuples(self.books)
+            self.catalog.num_tuples(self.books)
+            return self.mock.count('relation-MoreBooks')
+
+        with self.stub():
+            self.assertEqual(fetches(), 1)
+            # a running query invalidates the relations it stores to when
+            # it is submitted and when it finishes
+            connection.submit_query(plan)
+            self.assertEqual(fetches(), 2)
+            connection.get_query_status(7)
+            self.assertEqual(fetches(), 2)
+            self.mock.query_status = 'SUCCESS'
+            connection.get_query_status(7)
+            self.assertEqual(fetches(), 3)
+
+            connection.create_empty(books, {'columnNames': ['name'],
+                                            'columnTypes': ['STRING_TYPE']})
+            self.assertEqual(fetches(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
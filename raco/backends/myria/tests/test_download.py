@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from httmock import urlmatch, HTTMock
+from StringIO import StringIO
+import collections
+import json
+import unittest
+
+from raco.backends.myria.connection import MyriaConnection
+from raco.backends.myria.errors import MyriaError
+from raco.fakedb import FakeDatabase
+from raco.relation_key import RelationKey
+from raco.scheme import Scheme
+import raco.types as types
+
+SCHEMA = {'columnNames': ['id', 'name', 'score', 'ok'],
+          'columnTypes': ['LONG_TYPE', 'STRING_TYPE', 'DOUBLE_TYPE',
+                          'BOOLEAN_TYPE']}
+
+CSV = ('id,name,score,ok\r\n'
+       '1,Bill,2.5,true\r\n'
+       '2,"Howe, Bill",-1.0,false\r\n'
+       '3,"two\nlines",0.0,true\r\n'
+       '4,Zoë,1e3,false\r\n')
+
+JSON = json.dumps([{'id': 1, 'name': 'Bill', 'score': 2.5, 'ok': True},
+                   {'id': 4, 'name': u'Zoë', 'score': 1e3, 'ok': False}])
+
+TUPLES = [(1, u'Bill', 2.5, True),
+          (2, u'Howe, Bill', -1.0, False),
+          (3, u'two\nlines', 0.0, True),
+          (4, u'Zoë', 1000.0, False)]
+
+
+@urlmatch(netloc=r'localhost:12345')
+def local_mock(url, request):
+    if url.path.endswith('/relation-Missing/data'):
+        return {'status_code': 404, 'content': 'no such relation'}
+    elif url.path.endswith('/data'):
+        content = JSON if 'format=json' in url.query else CSV
+        return {'status_code': 200, 'content': content}
+    elif url.path.startswith('/dataset/'):
+        return {'status_code': 200,
+                'content': json.dumps({'schema': SCHEMA})}
+    return None
+
+
+class TestDownload(unittest.TestCase):
+
+    relation = {'userName': 'public', 'programName': 'adhoc',
+                'relationName': 'Scores'}
+
+    def setUp(self):
+        self.connection = MyriaConnection(hostname='localhost', port=12345)
+
+    def test_csv(self):
+        with HTTMock(local_mock):
+            # small chunks split values, lines and quoted values
+            for chunk_size in (1, 7, 65536):
+                tuples = list(self.connection.iter_dataset(
+                    self.relation, chunk_size=chunk_size))
+                self.assertEqual(tuples, TUPLES)
+
+    def test_json(self):
+        with HTTMock(local_mock):
+            for chunk_size in (1, 5, 65536):
+                tuples = list(self.connection.iter_dataset(
+                    self.relation, SCHEMA, 'json', chunk_size))
+                self.assertEqual(tuples, [TUPLES[0], TUPLES[3]])
+
+    def test_ingest(self):
+        scheme = Scheme([('id', types.LONG_TYPE),
+                         ('name', types.STRING_TYPE),
+                         ('score', types.DOUBLE_TYPE),
+                         ('ok', types.BOOLEAN_TYPE)])
+        db = FakeDatabase()
+        with HTTMock(local_mock):
+            db.ingest(RelationKey('public', 'adhoc', 'Scores'),
+                      self.connection.iter_dataset(self.relation, scheme),
+                      scheme)
+        self.assertEqual(db.get_table('public:adhoc:Scores'),
+                         collections.Counter(TUPLES))
+
+    def test_to_file(self):
+        out = StringIO()
+        with HTTMock(local_mock):
+            written = self.connection.download_dataset_to_file(
+                self.relation, out, chunk_size=3)
+        self.assertEqual(written, len(CSV))
+        self.assertEqual(out.getvalue(), CSV)
+
+    def test_errors(self):
+        missing = dict(self.relation, relationName='Missing')
+        with HTTMock(local_mock):
+            with self.assertRaises(MyriaError):
+                list(self.connection.iter_dataset(missing, SCHEMA))
+            with self.assertRaises(ValueError):
+                list(self.connection.iter_dataset(self.relation, SCHEMA,
+                                                  'xml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+from httmock import urlmatch, HTTMock
+import json
+import threading
+import unittest
+from urlparse import parse_qs
+
+from raco.backends.myria.connection import MyriaConnection
+from raco.backends.myria.errors import MyriaQueryError
+from raco.backends.myria.query_manager import QueryManager
+
+
+class StubCoordinator(object):
+    """Emulates the query resources of a Myria coordinator: a submitted
+    query is polled through its Location with 202 Accepted until it is done.
+
+    The plan of a query says how many polls it runs for ('polls', None to
+    run forever) and the status it ends with ('status')."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.requests = []
+        # the ids of the statuses returned by each batched request
+        self.batches = []
+        # the path of the status of a query
+        self.location = '/query/query-%d'
+        # number of upcoming requests for a single status that fail
+        self.errors = 0
+
+    def status(self, query_id):
+        query = self.queries[query_id]
+        return {'url': 'http://localhost:12345' + self.location % query_id,
+                'queryId': query_id,
+                'status': query['status'],
+                'message': None}
+
+    def advance(self, query_id):
+        query = self.queries[query_id]
+        if query['status'] != 'RUNNING' or query['polls'] is None:
+            return
+        query['polls'] -= 1
+        if query['polls'] <= 0:
+            query['status'] = query['final']
+
+    def response(self, query_id, code=None):
+        status = self.status(query_id)
+        if code is None:
+            code = 202 if status['status'] == 'RUNNING' else 200
+        return {'status_code': code,
+                'content': json.dumps(status),
+                'headers': {'Location': status['url']}}
+
+    def handle(self, url, request):
+        with self.lock:
+            self.requests.append((request.method, url.path))
+            if url.path == '/query' and request.method == 'POST':
+                plan = json.loads(request.body)
+                query_id = len(self.queries) + 1
+                self.queries[query_id] = {'status': 'RUNNING',
+                                          'polls': plan.get('polls', 2),
+                                          'final': plan.get('status',
+                                                            'SUCCESS')}
+                return self.response(query_id, 202)
+            elif url.path == '/query' and request.method == 'GET':
+                # the newest queries first, up to max and at most limit
+                params = parse_qs(url.query)
+                max_id = int(params.get('max', [len(self.queries)])[0])
+                limit = int(params.get('limit', [len(self.queries)])[0])
+                ids = sorted((i for i in self.queries if i <= max_id),
+                             reverse=True)[:limit]
+                for query_id in ids:
+                    self.advance(query_id)
+                results = [self.status(i) for i in ids]
+                self.batches.append(ids)
+                return {'status_code': 200,
+                        'content': json.dumps({'results': results})}
+            elif url.path.startswith('/query/query-') and \
+                    request.method == 'DELETE':
+                query_id = int(url.path[len('/query/query-'):])
+                self.queries[query_id]['status'] = 'KILLED'
+                return {'status_code': 204, 'content': ''}
+            query_id = self.status_query(url.path)
+            if query_id is not None and request.method == 'GET':
+                if self.errors:
+                    self.errors -= 1
+                    return {'status_code': 503, 'content': 'unavailable'}
+                self.advance(query_id)
+                return self.response(query_id)
+        return None
+
+    def status_query(self, path):
+        """Return the id of the query whose status is at path, or None."""
+        prefix, suffix = self.location.split('%d')
+        if path.startswith(prefix) and path.endswith(suffix):
+            return int(path[len(prefix):len(path) - len(suffix)])
+        return None
+
+    def count(self, method, path):
+        return len([r for r in self.requests if r == (method, path)])
+
+
+class TestQueryManager(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubCoordinator()
+        self.connection = MyriaConnection(hostname='localhost', port=12345)
+        self.mock = HTTMock(urlmatch(netloc=r'localhost:12345')(
+            self.stub.handle))
+        self.mock.__enter__()
+        self.manager = QueryManager(self.connection, poll_interval=0.001,
+                                    max_poll_interval=0.01, batch_size=3)
+
+    def tearDown(self):
+        self.manager.shutdown(cancel=True)
+        self.mock.__exit__(None, None, None)
+
+    def test_many_queries(self):
+        # all are submitted before their first poll is due
+        self.manager = QueryManager(self.connection, poll_interval=0.2,
+                                    batch_size=3)
+        futures = self.manager.submit_all([{'polls': i} for i in range(6)])
+        for future in futures:
+            self.assertEqual(future.result(timeout=10)['status'], 'SUCCESS')
+        self.assertEqual(self.stub.count('POST', '/query'), 6)
+        # query i + 1 finishes after i + 1 polls. Each batch polls the
+        # queries still running, until fewer than batch_size are left.
+        self.assertEqual(self.stub.batches, [[6, 5, 4, 3, 2, 1],
+                                             [6, 5, 4, 3],
+                                             [6, 5, 4]])
+        self.assertEqual(self.stub.count('GET', '/query'), 3)
+        self.assertEqual([self.stub.count('GET', '/query/query-%d' % i)
+                          for i in range(1, 7)], [0, 0, 0, 0, 1, 2])
+
+    def test_sparse_query_ids(self):
+        """Only dense ranges of query ids are polled with one request"""
+        self.manager = QueryManager(self.connection, poll_interval=0.2,
+                                    batch_size=3)
+        futures = [self.manager.submit({'polls': 3})]
+        # other users submit many queries in between
+        for query_id in range(2, 102):
+            self.stub.queries[query_id] = {'status': 'SUCCESS', 'polls': 0,
+                                           'final': 'SUCCESS'}
+        futures.extend(self.manager.submit_all([{'polls': 3}] * 3))
+        self.assertEqual([f.query_id for f in futures], [1, 102, 103, 104])
+        for future in futures:
+            self.assertEqual(future.result(timeout=10)['status'], 'SUCCESS')
+        self.assertGreater(len(self.stub.batches), 0)
+        for ids in self.stub.batches:
+            self.assertEqual(ids, [104, 103, 102])
+        self.assertGreater(self.stub.count('GET', '/query/query-1'), 0)
+        self.assertEqual(self.stub.count('GET', '/query/query-102'), 0)
+
+    def test_location(self):
+        """Statuses are polled at the Location of the submission"""
+        self.stub.location = '/elsewhere/%d/status'
+        future = self.manager.submit({'polls': 2})
+        self.assertEqual(future.url,
+                         'http://localhost:12345/elsewhere/1/status')
+        self.assertEqual(future.result(timeout=10)['status'], 'SUCCESS')
+        self.assertEqual(self.stub.count('GET', '/elsewhere/1/status'), 2)
+        self.assertEqual(self.stub.count('GET', '/query/query-1'), 0)
+
+    def test_poll_errors(self):
+        """Failed polls are retried, up to max_poll_failures in a row"""
+        self.manager = QueryManager(self.connection, poll_interval=0.001,
+                                    max_poll_interval=0.01,
+                                    max_poll_failures=3)
+        self.stub.errors = 2
+        future = self.manager.submit({'polls': 2})
+        self.assertEqual(future.result(timeout=10)['status'], 'SUCCESS')
+        self.assertEqual(self.stub.count('GET', '/query/query-1'), 4)
+
+        self.stub.errors = 3
+        future = self.manager.submit({'polls': 2})
+        with self.assertRaises(MyriaQueryError) as cm:
+            future.result(timeout=10)
+        self.assertIn('3 times in a row', str(cm.exception))
+        self.assertEqual(self.stub.count('GET', '/query/query-2'), 3)
+
+    def test_failed_query(self):
+        future = self.manager.submit({'status': 'ERROR'})
+        with self.assertRaises(MyriaQueryError) as cm:
+            future.result(timeout=10)
+        self.assertEqual(cm.exception.status['status'], 'ERROR')
+        self.assertFalse(future.cancelled())
+
+    def test_cancel(self):
+        future = self.manager.submit({'polls': None})
+        callbacks = []
+        future.add_done_callback(callbacks.append)
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertRaises(MyriaQueryError, future.result)
+        self.assertEqual(callbacks, [future])
+        self.assertEqual(self.stub.queries[future.query_id]['status'],
+                         'KILLED')
+        self.assertFalse(future.cancel())
+
+    def test_timeout(self):
+        forever = self.manager.submit({'polls': None}, timeout=0.05)
+        quick = self.manager.submit({'polls': 1}, timeout=10)
+        self.assertEqual(self.manager.wait([forever, quick], timeout=10),
+                         [forever, quick])
+        self.assertRaises(MyriaQueryError, forever.result)
+        self.assertFalse(forever.cancelled())
+        self.assertEqual(self.stub.queries[forever.query_id]['status'],
+                         'KILLED')
+        self.assertEqual(quick.result()['status'], 'SUCCESS')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import collections
+import unittest
+
+from raco.backends.myria import compile_to_json
+from raco.backends.myria.validation import (InvalidPlanException,
+                                            plan_errors, validate_plan)
+from raco.fakedb import FakeDatabase
+import raco.myrial.interpreter as interpreter
+import raco.myrial.parser as parser
+from raco.scheme import Scheme
+import raco.types as types
+
+
+class TestValidation(unittest.TestCase):
+
+    def compile(self, program):
+        db = FakeDatabase()
+        db.ingest('public:adhoc:employee', collections.Counter(),
+                  Scheme([('id', types.LONG_TYPE),
+                          ('dept_id', types.LONG_TYPE),
+                          ('salary', types.LONG_TYPE)]))
+        processor = interpreter.StatementProcessor(db)
+        processor.evaluate(parser.Parser().parse(program))
+        return compile_to_json(program, processor.get_logical_plan(),
+                               processor.get_physical_plan())
+
+    def plan(self):
+        """A plan with one SubQuery: aggregate employees by department, with
+        a shuffle from fragment 2 to fragment 1, and the result sent on to
+        the insert in fragment 0."""
+        plan = self.compile("""
+            T = scan(public:adhoc:employee);
+            A = [from T emit dept_id, max(salary)];
+            store(A, OUTPUT);
+            """)
+        validate_plan(plan)
+        return plan
+
+    def fragments(self, plan):
+        fragments = plan['plan']['fragments']
+        self.assertEqual(len(fragments), 3)
+        return fragments
+
+    def assertInvalid(self, plan, message):
+        with self.assertRaises(InvalidPlanException) as cm:
+            validate_plan(plan)
+        self.assertIn(message, str(cm.exception))
+        self.assertTrue(all(isinstance(e, basestring)
+                            for e in cm.exception.errors))
+
+    def test_parallel_opids(self):
+        """Fragments of the statements in one Parallel block get unique
+        opIds"""
+        plan = self.compile("""
+            T = scan(public:adhoc:employee);
+            A = [from T where salary > 5 emit id];
+            B = [from T emit dept_id, count(*)];
+            store(A, OUT_A);
+            store(B, OUT_B);
+            """)
+        self.assertEqual(plan_errors(plan), [])
+
+    def test_wiring(self):
+        plan = self.plan()
+        operators = self.fragments(plan)[1]['operators']
+        consumer = operators[0]
+        self.assertEqual(consumer['opType'], 'ShuffleConsumer')
+
+        consumer['argOperatorId'] = 100
+        self.assertInvalid(plan, 'no producer 100')
+
+        consumer['argOperatorId'] = operators[-1]['opId']
+        self.assertInvalid(plan, 'is in the same fragment')
+
+        plan = self.plan()
+        consumer = self.fragments(plan)[1]['operators'][0]
+        consumer['opType'] = 'BroadcastConsumer'
+        self.assertInvalid(plan, 'not a BroadcastProducer')
+        self.assertInvalid(plan, 'has no consumer')
+
+    def test_fragment_order(self):
+        plan = self.plan()
+        operators = self.fragments(plan)[2]['operators']
+        operators.reverse()
+        self.assertInvalid(plan, 'is listed after its parent')
+        self.assertInvalid(plan, 'must be the root of their fragment')
+
+        plan = self.plan()
+        operators = self.fragments(plan)[2]['operators']
+        operators[-1]['opId'] = operators[0]['opId']
+        self.assertInvalid(plan, 'duplicate opId')
+
+        plan = self.plan()
+        operators = self.fragments(plan)[1]['operators']
+        operators[1]['argChild'] = self.fragments(plan)[2]['operators'][0][
+            'opId']
+        self.assertInvalid(plan, 'is not in the fragment')
+
+    def test_columns(self):
+        plan = self.plan()
+        aggregate = self.fragments(plan)[1]['operators'][1]
+        self.assertEqual(aggregate['opType'], 'SingleGroupByAggregate')
+        aggregate['argGroupField'] = 2
+        self.assertInvalid(plan, 'a grouping column refers to column 2 of '
+                                 'an input with 2 columns')
+
+        plan = self.compile("""
+            T = scan(public:adhoc:employee);
+            A = [from T emit id];
+            B = [from T emit dept_id];
+            C = A + B;
+            store(C, OUTPUT);
+            """)
+        validate_plan(plan)
+        for fragment in plan['plan']['fragments']:
+            for op in fragment['operators']:
+                if op['opType'] == 'Apply':
+                    op['emitExpressions'].append(op['emitExpressions'][0])
+                    break
+        self.assertInvalid(plan, 'inputs have different numbers of columns')
+
+    def test_structure(self):
+        self.assertEqual(plan_errors({'type': 'Sequence', 'plans': []}), [])
+        self.assertEqual(len(plan_errors({'type': 'Bogus'})), 1)
+        errors = plan_errors({'type': 'DoWhile', 'body': [
+            {'type': 'SubQuery', 'fragments': []}]})
+        self.assertEqual(len(errors), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
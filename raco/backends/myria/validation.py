@@ -0,0 +1,263 @@
+"""Check the structure of Myria JSON query plans without a coordinator.
+
+MyriaConnection.validate_query asks the coordinator to check a plan. This
+module checks, locally and in time linear in the size of the plan, the
+mistakes that a compiler can make in the output of compile_to_json or
+compile_plan:
+
+- every operator has an opType and an opId that is unique in its subquery;
+- the operators of a fragment form a tree, listed children first and with
+  the root last, and only a fragment's root sends tuples to other fragments;
+- every consumer names a producer of the matching kind in another fragment
+  of the same subquery, and every producer has a consumer;
+- the number of columns agrees across operators, e.g., the inputs of a
+  UnionAll, and column indexes are within the columns of the input.
+"""
+
+__all__ = ['InvalidPlanException', 'plan_errors', 'validate_plan']
+
+# consumer opType -> producer opType
+PRODUCERS = {
+    'ShuffleConsumer': 'ShuffleProducer',
+    'BroadcastConsumer': 'BroadcastProducer',
+    'CollectConsumer': 'CollectProducer',
+    'LocalMultiwayConsumer': 'LocalMultiwayProducer',
+    'HyperCubeShuffleConsumer': 'HyperCubeShuffleProducer',
+}
+
+CHILD_FIELDS = ('argChild', 'argChild1', 'argChild2')
+
+# operators that output the columns of their (first) child
+PASS_THROUGH = frozenset(['Filter', 'DupElim', 'Limit', 'InMemoryOrderBy',
+                          'UnionAll', 'Difference', 'DbInsert', 'TempInsert',
+                          'EmptySink'] +
+                         PRODUCERS.values())
+
+
+class InvalidPlanException(ValueError):
+    """A Myria JSON plan is malformed. errors lists every problem found."""
+
+    def __init__(self, errors):
+        ValueError.__init__(self, '\n'.join(errors))
+        self.errors = errors
+
+
+def validate_plan(plan):
+    """Raise InvalidPlanException if plan, the output of compile_to_json or
+    compile_plan, is malformed."""
+    errors = plan_errors(plan)
+    if errors:
+        raise InvalidPlanException(errors)
+
+
+def plan_errors(plan):
+    """Return the list of problems found in plan, the output of
+    compile_to_json or compile_plan."""
+    errors = []
+    if 'plan' in plan and 'type' not in plan:
+        plan = plan['plan']
+    stack = [(plan, 'plan')]
+    while stack:
+        plan, where = stack.pop()
+        kind = plan.get('type') if isinstance(plan, dict) else None
+        if kind == 'SubQuery':
+            _check_subquery(plan.get('fragments') or [], where, errors)
+        elif kind == 'Sequence':
+            stack.extend(reversed([
+                (p, '{}.plans[{}]'.format(where, i))
+                for i, p in enumerate(plan.get('plans') or [])]))
+        elif kind == 'DoWhile':
+            if not plan.get('condition'):
+                errors.append('{}: DoWhile without a condition'.format(where))
+            stack.extend(reversed([
+                (p, '{}.body[{}]'.format(where, i))
+                for i, p in enumerate(plan.get('body') or [])]))
+        else:
+            errors.append('{}: unknown plan type {!r}'.format(where, kind))
+    return errors
+
+
+def _ref(value):
+    """An operator id, which compilers emit as an int or a string."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _children(op):
+    refs = [op[f] for f in CHILD_FIELDS if f in op]
+    refs.extend(op.get('argChildren') or [])
+    return refs
+
+
+def _check_subquery(fragments, where, errors):
+    # opId -> (fragment index, operator)
+    ops = {}
+    if not fragments:
+        errors.append('{}: SubQuery without fragments'.format(where))
+    for f, fragment in enumerate(fragments):
+        operators = fragment.get('operators')
+        if not operators:
+            errors.append('{}.fragments[{}]: no operators'.format(where, f))
+            continue
+        for op in operators:
+            op_id = _ref(op.get('opId'))
+            if op_id is None or 'opType' not in op:
+                errors.append('{}.fragments[{}]: operator without opId or '
+                              'opType: {!r}'.format(where, f, op))
+            elif op_id in ops:
+                errors.append('{}.fragments[{}]: duplicate opId {}'.format(
+                    where, f, op_id))
+            else:
+                ops[op_id] = (f, op)
+
+    consumed = set()
+    # opId -> number of output columns, where it can be determined.
+    # Producers are in fragments after those of their consumers, so the
+    # fragments are visited last first.
+    arity = {}
+    for f in reversed(range(len(fragments))):
+        operators = fragments[f].get('operators') or []
+        # opIds of the operators seen so far, and of those used as a child
+        seen = set()
+        used = set()
+        for i, op in enumerate(operators):
+            op_id = _ref(op.get('opId'))
+            op_type = op.get('opType')
+            if op_id is None or ops.get(op_id, (None, None))[1] is not op:
+                continue
+
+            def error(msg, *args):
+                errors.append('{}.fragments[{}]: operator {} ({}): {}'.format(
+                    where, f, op_id, op_type, msg.format(*args)))
+
+            children = []
+            for ref in _children(op):
+                child = _ref(ref)
+                if child not in seen:
+                    if ops.get(child, (None,))[0] == f:
+                        error('child {} is listed after its parent', ref)
+                    else:
+                        error('child {} is not in the fragment', ref)
+                elif child in used:
+                    error('child {} has more than one parent', child)
+                else:
+                    used.add(child)
+                children.append(child)
+
+            producer = None
+            if 'argOperatorId' in op:
+                producer = _ref(op['argOperatorId'])
+                pf, pop = ops.get(producer, (None, None))
+                expected = PRODUCERS.get(op_type)
+                if pop is None:
+                    error('no producer {}', op['argOperatorId'])
+                elif pf == f:
+                    error('producer {} is in the same fragment', producer)
+                elif (pop.get('opType') != expected if expected else
+                      not pop.get('opType').endswith('Producer')):
+                    error('operator {} is a {}, not a {}', producer,
+                          pop.get('opType'), expected or 'producer')
+                else:
+                    consumed.add(producer)
+
+            if op_type in PRODUCERS.values() and i != len(operators) - 1:
+                error('producers must be the root of their fragment')
+
+            arity[op_id] = _arity(op, [arity.get(c) for c in children],
+                                  arity.get(producer), error)
+            seen.add(op_id)
+
+        roots = seen - used
+        if len(roots) > 1:
+            errors.append('{}.fragments[{}]: several roots {}'.format(
+                where, f, sorted(roots)))
+
+    for op_id, (f, op) in sorted(ops.items()):
+        if op['opType'] in PRODUCERS.values() and op_id not in consumed:
+            errors.append('{}.fragments[{}]: operator {} ({}) has no '
+                          'consumer'.format(where, f, op_id, op['opType']))
+
+
+def _columns(expression):
+    """The indexes of the input columns an expression refers to."""
+    stack = [expression]
+    while stack:
+        e = stack.pop()
+        if isinstance(e, dict):
+            if e.get('type') == 'VARIABLE':
+                yield e.get('columnIdx')
+            stack.extend(e.values())
+        elif isinstance(e, list):
+            stack.extend(e)
+
+
+def _arity(op, child_arities, producer_arity, error):
+    """Check the column indexes of op against the number of columns of its
+    inputs, and return its number of output columns, or None if unknown."""
+    op_type = op.get('opType')
+    width = child_arities[0] if child_arities else None
+
+    def check(indexes, width, what):
+        if width is None:
+            return
+        for index in indexes:
+            if not isinstance(index, (int, long)) or \
+                    not 0 <= index < width:
+                error('{} refers to column {} of an input with {} columns',
+                      what, index, width)
+
+    if op_type in PRODUCERS:
+        return producer_arity
+    if 'schema' in op:
+        return len(op['schema'].get('columnTypes') or [])
+
+    if op_type in ('UnionAll', 'Difference'):
+        known = [a for a in child_arities if a is not None]
+        if len(set(known)) > 1:
+            error('inputs have different numbers of columns {}', known)
+    elif op_type == 'Filter':
+        check(_columns(op.get('argPredicate')), width, 'the predicate')
+    elif op_type in ('Apply', 'StatefulApply'):
+        emits = op.get('emitExpressions') or []
+        if op_type == 'Apply':
+            check(_columns(emits), width, 'an expression')
+        return len(emits)
+    elif op_type == 'SymmetricHashJoin':
+        left, right = (child_arities + [None, None])[:2]
+        if len(op.get('argColumns1', [])) != len(op.get('argColumns2', [])):
+            error('argColumns1 and argColumns2 have different lengths')
+        check(op.get('argColumns1', []), left, 'argColumns1')
+        check(op.get('argSelect1', []), left, 'argSelect1')
+        check(op.get('argColumns2', []), right, 'argColumns2')
+        check(op.get('argSelect2', []), right, 'argSelect2')
+        return len(op.get('argSelect1', [])) + len(op.get('argSelect2', []))
+    elif op_type == 'InMemoryOrderBy':
+        check(op.get('argSortColumns', []), width, 'argSortColumns')
+    elif op_type in ('Aggregate', 'SingleGroupByAggregate',
+                     'MultiGroupByAggregate'):
+        groups = op.get('argGroupFields', [])
+        if 'argGroupField' in op:
+            groups = [op['argGroupField']]
+        check(groups, width, 'a grouping column')
+        count = len(groups)
+        for agg in op.get('aggregators') or []:
+            if agg.get('type') == 'SingleColumn':
+                check([agg.get('column')], width, 'an aggregate')
+                count += len(agg.get('aggOps') or [])
+            elif agg.get('type') == 'UserDefined':
+                count += len(agg.get('emitters') or [])
+            else:
+                count += 1
+        return count
+
+    df = op.get('distributeFunction') or {}
+    if 'indexes' in df:
+        check(df['indexes'], width, 'the distribute function')
+    if 'index' in df:
+        check([df['index']], width, 'the distribute function')
+
+    if op_type in PASS_THROUGH:
+        return width
+    return None
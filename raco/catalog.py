@@ -1,5 +1,6 @@
 from abc import abstractmethod, ABCMeta
 from ast import literal_eval
+from contextlib import contextmanager
 import os
 import json
 
@@ -57,6 +58,67 @@ class Catalog(object):
         # default is to return no information
         return RepresentationProperties()
 
+    def heavy_hitters(self, rel_key, column):
+        """
+        Return a dict mapping each value of the given column of rel_key that
+        is frequent enough to skew a hash partitioning to its number of
+        occurrences. The column is given by its index.
+        """
+        # default is to assume a uniform distribution
+        return {}
+
+    def num_distinct_tuples(self, rel_key):
+        """
+        Return the number of distinct tuples of rel_key, or None if unknown
+        """
+        return None
+
+    def prefetch(self, rel_keys):
+        """
+        Hint that the metadata of the given relations is about to be used,
+        so that a remote catalog can fetch it in one go
+        """
+        pass
+
+    @contextmanager
+    def compiling(self):
+        """
+        Context of a compilation, within which a caching catalog returns
+        consistent metadata
+        """
+        yield self
+
+    def fingerprint(self, rel_keys):
+        """
+        Return a string summarizing the scheme, cardinality and partitioning
+        of the given relations. Anything compiled against this catalog can be
+        reused as long as the fingerprint of the relations it references is
+        unchanged. Relations unknown to the catalog contribute None.
+        """
+        def lookup(f, *args):
+            try:
+                return f(*args)
+            except Exception:
+                return None
+
+        def skew(rel_key, scheme):
+            if scheme is None:
+                return None
+            return [sorted(lookup(self.heavy_hitters, rel_key, i) or {})
+                    for i in range(len(scheme))]
+
+        self.prefetch(rel_keys)
+        meta = [lookup(self.get_num_servers)]
+        for rel_key in sorted(set(rel_keys), key=str):
+            scheme = lookup(self.get_scheme, rel_key)
+            meta.append((str(rel_key),
+                         scheme,
+                         lookup(self.num_tuples, rel_key),
+                         lookup(self.partitioning, rel_key),
+                         skew(rel_key, scheme),
+                         lookup(self.num_distinct_tuples, rel_key)))
+        return repr(meta)
+
 
 # Some useful Catalog implementations
 
@@ -65,12 +127,17 @@ class FakeCatalog(Catalog):
     """ fake catalog, should only be used in test """
 
     def __init__(self, num_servers, child_sizes=None,
-                 child_partitionings=None):
+                 child_partitionings=None, child_heavy_hitters=None,
+                 child_distinct_tuples=None):
         self.num_servers = num_servers
         # default sizes
         self.sizes = {}
         # default partitionings
         self.partitionings = {}
+        # default heavy hitters, {relation: {column: {value: count}}}
+        self.skews = {}
+        # default numbers of distinct tuples, unknown
+        self.distinct = {}
         # overwrite default sizes if necessary
         if child_sizes:
             for child, size in child_sizes.items():
@@ -78,6 +145,12 @@ class FakeCatalog(Catalog):
         if child_partitionings:
             for child, part in child_partitionings.items():
                 self.partitionings[RelationKey(child)] = frozenset(part)
+        if child_heavy_hitters:
+            for child, columns in child_heavy_hitters.items():
+                self.skews[RelationKey(child)] = columns
+        if child_distinct_tuples:
+            for child, distinct in child_distinct_tuples.items():
+                self.distinct[RelationKey(child)] = distinct
 
     def get_num_servers(self):
         return self.num_servers
@@ -93,6 +166,12 @@ class FakeCatalog(Catalog):
                 hash_partitioned=self.partitionings[rel_key])
         return RepresentationProperties()
 
+    def heavy_hitters(self, rel_key, column):
+        return self.skews.get(rel_key, {}).get(column, {})
+
+    def num_distinct_tuples(self, rel_key):
+        return self.distinct.get(rel_key)
+
     def get_scheme(self, rel_key):
         raise NotImplementedError()
 
@@ -4,6 +4,9 @@ from .pipelines import Pipelined
 from raco.utility import emit
 import raco.viz as viz
 import os
+import json
+import time
+from collections import OrderedDict
 from raco.utility import colored
 
 import logging
@@ -35,17 +38,183 @@ class PlanWriter():
         self.ind += 1
 
 
-def optimize_by_rules(expr, rules):
+def default_rule_groups():
+    """Return (name, rules) pairs for the well-known rule groups, so that a
+    RuleProfiler can aggregate statistics by group."""
+    from raco import rules
+    from raco.backends.myria import myria
+
+    return [('remove_trivial_sequences', rules.remove_trivial_sequences),
+            ('simple_group_by', rules.simple_group_by),
+            ('push_select', rules.push_select),
+            ('push_project', rules.push_project),
+            ('push_apply', rules.push_apply),
+            ('shuffle_logic', myria.left_deep_tree_shuffle_logic),
+            ('myriafy', myria.myriafy),
+            ('break_communication', myria.break_communication)]
+
+
+class RuleStats(object):
+    """Counters collected for a single rule instance"""
+
+    def __init__(self, rule, group):
+        self.rule = rule
+        self.group = group
+        # number of passes of the rule over a plan
+        self.invocations = 0
+        # number of operators the rule was fired on
+        self.nodes = 0
+        # number of firings that changed the plan
+        self.rewrites = 0
+        # cumulative time spent inside the rule, in seconds
+        self.time = 0.0
+
+    def add(self, other):
+        self.invocations += other.invocations
+        self.nodes += other.nodes
+        self.rewrites += other.rewrites
+        self.time += other.time
+
+    @property
+    def name(self):
+        """The rule's class name, as used by no_<name> disable flags"""
+        return type(self.rule).__name__
+
+    @property
+    def description(self):
+        """The rule's __str__, if it defines one"""
+        if type(self.rule).__str__ is object.__str__:
+            return ''
+        return str(self.rule)
+
+    def to_dict(self):
+        return {'rule': self.name,
+                'description': self.description,
+                'group': self.group,
+                'invocations': self.invocations,
+                'nodes': self.nodes,
+                'rewrites': self.rewrites,
+                'time': self.time}
+
+
+class RuleProfiler(object):
+    """Record how often and how long each optimizer rule runs.
+
+    Pass an instance to optimize / optimize_by_rules with the profiler
+    keyword. Statistics accumulate across calls until reset() is called.
+    """
+
+    columns = ['invocations', 'nodes', 'rewrites', 'time']
+
+    def __init__(self, groups=None):
+        """
+        :param groups: a list of (name, rules) pairs used to aggregate rules
+        by group. Defaults to default_rule_groups(). Rules not in any group
+        are reported in the group "other".
+        """
+        if groups is None:
+            groups = default_rule_groups()
+        self.group_of = {}
+        for name, rule_list in groups:
+            for rule in rule_list:
+                self.group_of.setdefault(id(rule), name)
+        self.reset()
+
+    def reset(self):
+        self.stats = OrderedDict()
+
+    def _get(self, rule):
+        key = id(rule)
+        if key not in self.stats:
+            self.stats[key] = RuleStats(
+                rule, self.group_of.get(key, 'other'))
+        return self.stats[key]
+
+    def start_pass(self, rule):
+        self._get(rule).invocations += 1
+
+    def record(self, rule, elapsed, changed):
+        stats = self._get(rule)
+        stats.nodes += 1
+        stats.time += elapsed
+        if changed:
+            stats.rewrites += 1
+
+    def by_rule(self, sort_by='time'):
+        """Return the RuleStats of every rule, largest first"""
+        return sorted(self.stats.values(),
+                      key=lambda s: getattr(s, sort_by), reverse=True)
+
+    def by_group(self, sort_by='time'):
+        """Return RuleStats aggregated by rule group, largest first"""
+        groups = OrderedDict()
+        for stats in self.stats.values():
+            if stats.group not in groups:
+                groups[stats.group] = RuleStats(None, stats.group)
+            groups[stats.group].add(stats)
+        return sorted(groups.values(),
+                      key=lambda s: getattr(s, sort_by), reverse=True)
+
+    def total_time(self):
+        return sum(s.time for s in self.stats.values())
+
+    def to_dict(self, sort_by='time'):
+        return {'rules': [s.to_dict() for s in self.by_rule(sort_by)],
+                'groups': [{k: v for k, v in s.to_dict().items()
+                            if k not in ('rule', 'description')}
+                           for s in self.by_group(sort_by)],
+                'total_time': self.total_time()}
+
+    def to_json(self, sort_by='time'):
+        return json.dumps(self.to_dict(sort_by))
+
+    def format_table(self, sort_by='time'):
+        """Return the statistics as a human-readable table"""
+        def fmt(name, s, desc=''):
+            line = '%-24s %-24s %6d %8d %8d %10.2f  %s' % (
+                name, s.group, s.invocations, s.nodes, s.rewrites,
+                s.time * 1000, desc[:40])
+            return line.rstrip()
+        header = '%-24s %-24s %6s %8s %8s %10s  %s' % (
+            'rule', 'group', 'passes', 'nodes', 'rewrites', 'time (ms)',
+            'description')
+        lines = [header]
+        lines += [fmt(s.name, s, s.description)
+                  for s in self.by_rule(sort_by)]
+        lines += ['', 'Totals by group:']
+        lines += [fmt('', s) for s in self.by_group(sort_by)]
+        lines += ['', 'Total optimizer time: %.2f ms' %
+                  (self.total_time() * 1000)]
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.format_table()
+
+
+def optimize_by_rules(expr, rules, profiler=None):
+    """Apply each rule to the operators of a plan. A subplan that occurs
+    several times is shared, and rewritten once: see algebra.intern and
+    algebra.rewrite_shared. The result may still share subplans."""
+    expr = algebra.intern(expr)
+
     writer = PlanWriter()
     writer.write_if_enabled(expr, "before rules")
 
     for rule in rules:
-        def recursiverule(e):
-            newe = rule(e)
+        def apply_rule(e):
+            if profiler is not None:
+                start = time.time()
+                newe = rule(e)
+                elapsed = time.time() - start
+            else:
+                newe = rule(e)
             writer.write_if_enabled(newe, str(rule))
 
-            # log the optimizer step
-            if str(e) == str(newe):
+            # log the optimizer step. Rules that modify e in place return
+            # it, and are not detected.
+            changed = newe is not e and (hash(newe) != hash(e) or
+                                         str(e) != str(newe))
+            if not changed:
                 LOG.debug("apply rule %s (no effect)\n" +
                           " %s \n", rule, e)
             else:
@@ -53,21 +222,34 @@ def optimize_by_rules(expr, rules):
                           colored("  -", "red") + " %s" + "\n" +
                           colored("  +", "green") + " %s", rule, e, newe)
 
-            newe.apply(recursiverule)
+            if profiler is not None:
+                profiler.record(rule, elapsed, changed)
 
             return newe
-        expr = recursiverule(expr)
 
-    return expr
+        if profiler is not None:
+            profiler.start_pass(rule)
+        expr, copies = algebra.rewrite_shared(expr, apply_rule,
+                                              rule.bottom_up)
+        if copies:
+            # merge the copies that the rule modified in the same way
+            expr = algebra.intern(expr)
+
+    return algebra.intern(expr)
 
 
 def optimize(expr, target, **kwargs):
     """Fire the rule-based optimizer on an expression.  Fire all rules in the
-    target algebra."""
+    target algebra.
+
+    If a RuleProfiler is passed as the profiler keyword, per-rule statistics
+    are recorded into it."""
     assert isinstance(expr, algebra.Operator)
     assert isinstance(target, language.Algebra), type(target)
 
-    return optimize_by_rules(expr, target.opt_rules(**kwargs))
+    profiler = kwargs.pop('profiler', None)
+    return target.finalize(
+        optimize_by_rules(expr, target.opt_rules(**kwargs), profiler))
 
 
 def compile(expr, **kwargs):
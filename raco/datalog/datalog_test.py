@@ -6,6 +6,7 @@ from raco import RACompiler
 from raco.backends.myria import (compile_to_json,
                                  MyriaLeftDeepTreeAlgebra,
                                  MyriaHyperCubeAlgebra)
+from raco.backends.myria.validation import validate_plan
 from raco.catalog import FakeCatalog
 
 
@@ -35,8 +36,10 @@ class DatalogTestCase(unittest.TestCase):
 
             if not skip_json:
                 # test whether we can generate json without errors
-                json_string = json.dumps(compile_to_json(
-                    query, dlog.logicalplan, dlog.physicalplan, "datalog"))
+                compiled = compile_to_json(
+                    query, dlog.logicalplan, dlog.physicalplan, "datalog")
+                validate_plan(compiled)
+                json_string = json.dumps(compiled)
                 assert json_string
 
         self.db.evaluate(plan)
@@ -6,7 +6,8 @@ Most non-trivial operators and functions are in separate files in this package.
 from abc import ABCMeta, abstractmethod
 import logging
 
-from raco.utility import Printable
+from raco.utility import (MemoizingMeta, Printable, PropertyCache,
+                          TrackedList, UndoLog)
 from raco import types
 
 LOG = logging.getLogger(__name__)
@@ -26,8 +27,19 @@ def check_is_numeric(_type):
     check_type(_type, types.NUMERIC_TYPES)
 
 
+class ExpressionMeta(MemoizingMeta):
+
+    """Metaclass of expressions: caches the structural hash defined by each
+    class."""
+
+    memoized = ('__hash__',)
+
+
 class Expression(Printable):
-    __metaclass__ = ABCMeta
+    __metaclass__ = ExpressionMeta
+    # Expressions are numerous, so the common fields are slots. Other
+    # attributes are kept in a __dict__ that is created on first use.
+    __slots__ = ('_property_cache', '__dict__')
     literals = None
 
     @abstractmethod
@@ -62,6 +74,21 @@ class Expression(Printable):
     def __copy__(self):
         raise RuntimeError("Shallow copy not supported for expressions")
 
+    def __getstate__(self):
+        return PropertyCache.getstate(self)
+
+    def __setattr__(self, key, value):
+        # The properties of the operators that hold an expression may
+        # depend on it. A list of operands is stored as a TrackedList, which
+        # invalidates when it is changed in place.
+        if hasattr(self, key):
+            PropertyCache.invalidate()
+        if UndoLog.active is not None:
+            UndoLog.record_attribute(self, key)
+        if type(value) is list:
+            value = TrackedList(value)
+        super(Expression, self).__setattr__(key, value)
+
     def postorder(self, f):
         """Apply a function to each node in an expression tree.
 
@@ -105,6 +132,7 @@ class Expression(Printable):
 
 
 class ZeroaryOperator(Expression):
+    __slots__ = ()
 
     def __init__(self):
         pass
@@ -132,6 +160,7 @@ class ZeroaryOperator(Expression):
 
 
 class UnaryOperator(Expression):
+    __slots__ = ('input',)
 
     def __init__(self, input):
         self.input = input
@@ -174,6 +203,7 @@ class UnaryOperator(Expression):
 
 
 class BinaryOperator(Expression):
+    __slots__ = ('left', 'right')
 
     def __init__(self, left, right):
         self.left = left
@@ -238,6 +268,7 @@ class BinaryOperator(Expression):
 
 
 class NaryOperator(Expression):
+    __slots__ = ('operands',)
 
     def __init__(self, operands):
         self.operands = operands
@@ -248,7 +279,7 @@ class NaryOperator(Expression):
         return self.operands == other.operands
 
     def __hash__(self):
-        return hash(self.__class__) + hash(self.operands)
+        return hash(self.__class__) + hash(tuple(self.operands))
 
     def __str__(self):
         return "(%s %s)" % \
@@ -282,6 +313,7 @@ class NaryOperator(Expression):
 
 
 class Literal(ZeroaryOperator):
+    __slots__ = ('value',)
 
     def __init__(self, value):
         self.value = value
@@ -316,20 +348,24 @@ class Literal(ZeroaryOperator):
 
 
 class StringLiteral(Literal):
+    __slots__ = ()
 
     def __str__(self):
         return '"{val}"'.format(val=self.value)
 
 
 class NumericLiteral(Literal):
+    __slots__ = ()
     pass
 
 
 class BooleanLiteral(Literal):
+    __slots__ = ()
     pass
 
 
 class AttributeRef(Expression):
+    __slots__ = ()
 
     def evaluate(self, _tuple, scheme, state=None):
         return _tuple[self.get_position(
@@ -354,6 +390,7 @@ class AttributeRef(Expression):
 
 
 class NamedAttributeRef(AttributeRef):
+    __slots__ = ('name',)
 
     def __init__(self, attributename):
         self.name = attributename
@@ -375,6 +412,7 @@ class NamedAttributeRef(AttributeRef):
 
 
 class UnnamedAttributeRef(AttributeRef):
+    __slots__ = ('debug_info', 'position')
 
     def __init__(self, position, debug_info=None):
         self.debug_info = debug_info
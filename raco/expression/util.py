@@ -130,14 +130,13 @@ def resolve_function(func_expr, arg_dict):
     :returns: An expression with no variables
     """
 
-    def convert(n):
+    def bind(n):
+        # an argument is copied for each reference to it, since the resolved
+        # expression may be modified in place later
         if isinstance(n, NamedAttributeRef):
-            n = copy.deepcopy(arg_dict[n.name])
-        else:
-            n.apply(convert)
-        return n
+            return copy.deepcopy(arg_dict[n.name])
 
-    return convert(copy.deepcopy(func_expr))
+    return _substitute(func_expr, bind)
 
 
 def resolve_state_vars(expr, state_vars, mangled_names):
@@ -153,14 +152,30 @@ def resolve_state_vars(expr, state_vars, mangled_names):
     :return: An instance of Expression
     """
 
-    def convert(n):
+    def bind(n):
         if isinstance(n, NamedAttributeRef) and n.name in state_vars:
-            n = NamedStateAttributeRef(mangled_names[n.name])
-        else:
-            n.apply(convert)
+            return NamedStateAttributeRef(mangled_names[n.name])
+
+    return _substitute(expr, bind)
+
+
+def _substitute(expr, replace):
+    """Return a copy of an expression in which each node n is replaced by
+    replace(n), unless that is None.
+
+    Unlike a deep copy followed by an in-place rewrite, every node of the
+    original is copied once, and the nodes that are replaced are not copied
+    at all."""
+
+    def convert(n):
+        new = replace(n)
+        if new is not None:
+            return new
+        n = copy.deepcopy(n, {id(c): c for c in n.get_children()})
+        n.apply(convert)
         return n
 
-    return convert(copy.deepcopy(expr))
+    return convert(expr)
 
 
 def accessed_columns(expr):
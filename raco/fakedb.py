@@ -8,7 +8,8 @@ from raco.dbconn import DBConnection
 from raco import relation_key, types
 from raco.algebra import StoreTemp, DEFAULT_CARDINALITY
 from raco.catalog import Catalog
-from raco.expression import AND, EQ, BuiltinAggregateExpression
+from raco.expression import (AND, EQ, BuiltinAggregateExpression,
+                             AttributeRef, toUnnamed)
 from raco.representation import RepresentationProperties
 
 debug = False
@@ -52,6 +53,12 @@ class FakeDatabase(Catalog):
         except KeyError:
             return DEFAULT_CARDINALITY
 
+    def num_distinct_tuples(self, rel_key):
+        try:
+            return len(self.tables.get_table(rel_key))
+        except KeyError:
+            return None
+
     def partitioning(self, rel_key):
         """get fake metadata for relation.
         This has no effect on query evaluation
@@ -73,11 +80,14 @@ class FakeDatabase(Catalog):
 
     def ingest(self, rel_key, contents, scheme,
                partitioning=RepresentationProperties()):
-        """Directly load raw data into the database"""
+        """Directly load raw data into the database. contents is a
+        collections.Counter of tuples, or any iterable of tuples."""
         if isinstance(rel_key, basestring):
             rel_key = relation_key.RelationKey.from_string(rel_key)
         assert isinstance(rel_key, relation_key.RelationKey)
-        self.tables.add_table(rel_key, scheme, contents.elements())
+        if isinstance(contents, collections.Counter):
+            contents = contents.elements()
+        self.tables.add_table(rel_key, scheme, contents)
         self.partitionings[rel_key] = partitioning
 
     def get_scheme(self, rel_key):
@@ -436,7 +446,14 @@ class FakeDatabase(Catalog):
                 for t in self.naryjoin(op))
 
     def myriainmemoryorderby(self, op):
-        return self.evaluate(op.input)
+        tuples = list(self.evaluate(op.input))
+        input_scheme = op.input.scheme()
+        # stable sorts, from the least significant column to the most
+        for col, asc in reversed(zip(op.sort_columns, op.ascending)):
+            if isinstance(col, AttributeRef):
+                col = toUnnamed(col, input_scheme).position
+            tuples.sort(key=lambda t: t[col], reverse=not asc)
+        return iter(tuples)
 
     def myriahypercubeshuffleconsumer(self, op):
         return self.evaluate(op.input)
@@ -11,6 +11,7 @@ from raco.expression.aggregate import *
 from raco.types import *
 from raco.relation_key import *
 from raco.expression.boolean import *
+from raco import serialization
 
 
 import logging
@@ -19,6 +20,8 @@ _LOG = logging.getLogger(name=__name__)
 
 
 def plan_from_repr(repr_string):
+    if serialization.is_serialized(repr_string):
+        return serialization.loads(repr_string)
     _LOG.warning("Relying on eval! "
                  "This module should only be used in "
                  "trusted development situations\n")
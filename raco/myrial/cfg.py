@@ -1,8 +1,8 @@
 from raco.algebra import *
 from raco.myrial.exceptions import MyrialCompileException
+from raco.rules import CommonSubexpressionElimination
 
 import bisect
-import copy
 import itertools
 import logging
 import networkx as nx
@@ -51,6 +51,7 @@ class ControlFlowGraph(object):
         self.graph = nx.DiGraph()
         self.sorted_vertices = []
         self._next_op_id = 0
+        self._next_invariant = 0
 
     def __str__(self):
         g = self.graph
@@ -98,35 +99,70 @@ class ControlFlowGraph(object):
         :returns: A tuple containing live_in, live_out dictionaries.  The keys
         are variable names (strings) and the values are string sets.
         """
-
-        # All variables that are accessed are live-in at a node
-        live_in = {i: copy.copy(self.graph.node[i]['uses'])
-                   for i in self.graph}
-        live_out = {i: set() for i in self.graph}
-
-        while True:
-            # Create a copy of live_in, live_out that we will compare against
-            # to detect loop termination. This is shallower than a full deep
-            # copy, but we need to copy the value sets in this dictionary as
-            # they are mutated in the loop below. Make the sets frozen to
-            # ensure they are really immutable.
-            live_in_prev = {i: frozenset(s) for i, s in live_in.items()}
-            live_out_prev = {i: frozenset(s) for i, s in live_out.items()}
-
-            for i in self.graph:
-                # live out variables that are not defined are live-in
-                def_var = self.graph.node[i]['def_var']
-                def_set = set()
-                if def_var is not None:
-                    def_set.add(def_var)
-                live_in[i].update(live_out_prev[i] - def_set)
-
-                # variables that are live-in at a successor are live-out
-                for successor in self.graph.successors(i):
-                    live_out[i].update(live_in_prev[successor])
-
-            if live_in == live_in_prev and live_out == live_out_prev:
-                return live_in, live_out
+        bits, live_in, live_out = self.__liveness()
+        names = {bit: var for var, bit in bits.items()}
+
+        def variables(vector):
+            result = set()
+            while vector:
+                bit = vector & -vector
+                result.add(names[bit])
+                vector ^= bit
+            return result
+
+        return ({i: variables(v) for i, v in live_in.items()},
+                {i: variables(v) for i, v in live_out.items()})
+
+    def __liveness(self):
+        """Worklist liveness analysis on bit vectors.
+
+        Each variable is assigned a bit, and the live sets are encoded as
+        integers. A node is revisited only when the live-in set of one of
+        its successors changes, so the analysis takes about one visit per
+        node on programs without loops.
+
+        :returns: A tuple containing the bit of each variable, and the
+        live_in, live_out dictionaries from node to bit vector.
+        """
+        bits = {}
+
+        def bit(var):
+            if var not in bits:
+                bits[var] = 1 << len(bits)
+            return bits[var]
+
+        use, kill = {}, {}
+        for i in self.graph:
+            use[i] = 0
+            for var in self.graph.node[i]['uses']:
+                use[i] |= bit(var)
+            def_var = self.graph.node[i]['def_var']
+            kill[i] = bit(def_var) if def_var is not None else 0
+
+        live_in = dict(use)
+        live_out = {i: 0 for i in self.graph}
+
+        # Visit the nodes backwards, in the direction of the data flow
+        worklist = sorted(self.graph)
+        pending = set(worklist)
+        while worklist:
+            i = worklist.pop()
+            pending.remove(i)
+
+            out = 0
+            for successor in self.graph.successors(i):
+                out |= live_in[successor]
+            live_out[i] = out
+
+            _in = use[i] | (out & ~kill[i])
+            if _in != live_in[i]:
+                live_in[i] = _in
+                for predecessor in self.graph.predecessors(i):
+                    if predecessor not in pending:
+                        pending.add(predecessor)
+                        worklist.append(predecessor)
+
+        return bits, live_in, live_out
 
     def __delete_node(self, node):
         """Remove a node from the control flow graph.
@@ -197,13 +233,15 @@ class ControlFlowGraph(object):
         is reached.
         """
 
+        # Inlining A into B does not change the liveness of any variable:
+        # the uses of A move to B, and def(A) is dead after B. B takes over
+        # the live-in set of A, so the analysis runs only once.
+        bits, live_in, live_out = self.__liveness()
+
         _continue = True
         while _continue:
-            live_in, live_out = self.compute_liveness()
             _continue = False
 
-            # TODO XXX O(N^2) algorithm
-
             # Walk through the program backwards, and try inlining line A into
             # line B according to the above logic.
             #
@@ -221,6 +259,10 @@ class ControlFlowGraph(object):
                 if self.graph.in_degree(nodeB) == 2:
                     continue  # start of do/while loop
 
+                if (self.graph.in_degree(nodeA) == 2 and
+                        self.graph.out_degree(nodeB) == 2):
+                    continue  # the loop body would be empty
+
                 def_var = self.graph.node[nodeA]['def_var']
                 if not def_var:
                     continue
@@ -229,10 +271,12 @@ class ControlFlowGraph(object):
                 if def_var not in uses:
                     continue
 
-                if def_var in live_out[nodeB]:
+                if live_out[nodeB] & bits[def_var]:
                     continue
 
                 self.__inline_node(nodeB, nodeA)
+                live_in[nodeB] = live_in.pop(nodeA)
+                del live_out[nodeA]
                 _continue = True
                 inlined_into = nodeB
 
@@ -241,23 +285,25 @@ class ControlFlowGraph(object):
 
         Specifically: delete CFG nodes that define a variable that is not in
         the live_out set. Recurse until convergence.
+
+        Deleting a node only shrinks the live sets, so all of the dead nodes
+        found by one liveness analysis are deleted together.
         """
 
         _continue = True
         while _continue:
-            _continue = False
-            live_in, live_out = self.compute_liveness()
+            bits, live_in, live_out = self.__liveness()
 
-            for node in self.graph:
-                out_set = live_out[node]
+            # Only delete nodes that 1) Define a variable (and therefore
+            # aren't STORE, etc.); 2) Are not required downstream.
+            dead = []
+            for node in self.sorted_vertices:
                 def_var = self.graph.node[node]['def_var']
-
-                # Only delete nodes that 1) Define a variable (and therefore
-                # aren't STORE, etc.); 2) Are not required downstream.
-                if def_var and def_var not in out_set:
-                    self.__delete_node(node)
-                    _continue = True
-                    break
+                if def_var and not live_out[node] & bits[def_var]:
+                    dead.append(node)
+            for node in dead:
+                self.__delete_node(node)
+            _continue = bool(dead)
 
     def dead_loop_elimination(self):
         """Delete entire do/while loops whose results are not consumed.
@@ -267,7 +313,8 @@ class ControlFlowGraph(object):
         if len(self.sorted_vertices) == 0:
             return
 
-        # A stack that contains the defined variables within each loop.
+        # A stack that contains the defined variables within each loop, as
+        # bit vectors.
         def_set_stack = []
 
         def current_def_set():
@@ -279,18 +326,18 @@ class ControlFlowGraph(object):
         current_loop_first_index = -1
         loops_to_delete = []  # tuples of the form [begin_index, end_index]
 
-        live_in, live_out = self.compute_liveness()
+        bits, live_in, live_out = self.__liveness()
         last_op = self.sorted_vertices[-1]
 
         for i in self.sorted_vertices:
             if self.graph.in_degree(i) == 2:
                 # start new do/while loop
                 current_loop_first_index = i
-                def_set_stack.append(set())
+                def_set_stack.append(0)
                 # Add anything defined by the current statement to the def_set
                 def_var = self.graph.node[i]['def_var']
                 if def_var:
-                    def_set_stack[-1].add(def_var)
+                    def_set_stack[-1] |= bits[def_var]
             elif (current_def_set() is not None and
                     (self.graph.out_degree(i) == 2 or i == last_op)):
                 # end of do/while loop: check whether anything this loop
@@ -303,13 +350,13 @@ class ControlFlowGraph(object):
                 if next_op is None:
                     # no next node?  Loop is obviously dead
                     loops_to_delete.append(loop_range)
-                elif len(def_set.intersection(live_in[next_op])) == 0:
+                elif not def_set & live_in[next_op]:
                     loops_to_delete.append(loop_range)
             elif current_def_set() is not None:
                 # Add anything defined by the current statement to the def_set
                 def_var = self.graph.node[i]['def_var']
                 if def_var:
-                    def_set_stack[-1].add(def_var)
+                    def_set_stack[-1] |= bits[def_var]
 
         if not loops_to_delete:
             return
@@ -333,8 +380,225 @@ class ControlFlowGraph(object):
 
         self.dead_loop_elimination()
 
+    def __loops(self):
+        """Return the (first node, condition node) of each do/while loop,
+        innermost loops first."""
+        loops = [(dest, src) for src, dest in self.graph.edges()
+                 if dest < src]
+        return sorted(loops, key=lambda loop: loop[1] - loop[0])
+
+    def __insert_before_loop(self, nodes, first):
+        """Insert a list of nodes, which are not connected to the graph, in
+        front of the loop that starts at first.
+
+        The nodes are renumbered to keep the node IDs in program order.
+        """
+        for pred in self.graph.predecessors(first):
+            if pred < first:
+                self.graph.remove_edge(pred, first)
+                self.graph.add_edge(pred, nodes[0])
+        for source, dest in sliding_window(nodes + [first]):
+            self.graph.add_edge(source, dest)
+
+        order = [n for n in self.sorted_vertices if n not in nodes]
+        index = order.index(first)
+        order[index:index] = nodes
+        ids = sorted(order)
+        self.graph = nx.relabel_nodes(self.graph, dict(zip(order, ids)))
+        self.sorted_vertices = ids
+
+    def __hoist_node(self, node, first):
+        """Move a statement of the loop that starts at first in front of the
+        loop."""
+        successor = self.graph.successors(node)[0]
+        for pred in self.graph.predecessors(node):
+            self.graph.add_edge(pred, successor)
+        self.graph.remove_edges_from(self.graph.in_edges(node) +
+                                     self.graph.out_edges(node))
+        if node == first:
+            first = successor
+        self.__insert_before_loop([node], first)
+
+    def __is_invariant(self, node, body, statements):
+        """Is the statement at node, which is part of the loop body,
+        invariant? Its variable must be assigned only by it and must not be
+        read in the loop before it."""
+        def_var = self.graph.node[node]['def_var']
+        if def_var is None:
+            return False
+        for n in body:
+            if n == node:
+                continue
+            if self.graph.node[n]['def_var'] == def_var:
+                return False
+            if n < node and def_var in self.graph.node[n]['uses']:
+                return False
+        op = self.graph.node[node]['op']
+        return CommonSubexpressionElimination._safe(statements, op.input)
+
+    def __hoist_subtrees(self, node, first, statements, iterations):
+        """Materialize the invariant subtrees of a statement of the loop
+        that starts at first in front of the loop, if that is cheaper than
+        evaluating them in each iteration.
+
+        :returns: True if any subtree was hoisted.
+        """
+        cse = CommonSubexpressionElimination
+        new_nodes = []
+
+        def hoist(op):
+            if cse._safe(statements, op) and cse._profitable(op, iterations):
+                name = '__licm_{n}'.format(n=self._next_invariant)
+                self._next_invariant += 1
+
+                new_node = self.next_op_id
+                self._next_op_id += 1
+                uses_set = {o.name for o in op.walk()
+                            if isinstance(o, ScanTemp)}
+                self.graph.add_node(new_node, op=StoreTemp(name, op),
+                                    def_var=name, uses=uses_set)
+                self.graph.node[node]['uses'].add(name)
+                new_nodes.append(new_node)
+                return ScanTemp(name, op.scheme())
+            op.apply(hoist)
+            return op
+
+        op = self.graph.node[node]['op']
+        op.apply(hoist)
+        if new_nodes:
+            # drop the variables that were only read by the hoisted subtrees
+            remaining = {o.name for o in op.walk() if isinstance(o, ScanTemp)}
+            for n in new_nodes:
+                self.graph.node[node]['uses'] -= (
+                    self.graph.node[n]['uses'] - remaining)
+            self.__insert_before_loop(new_nodes, first)
+        return bool(new_nodes)
+
+    def loop_invariant_code_motion(self, iterations=10):
+        """Move computations that do not change across the iterations of a
+        do/while loop in front of the loop.
+
+        A statement of a loop is invariant if it is deterministic and reads
+        nothing that the loop modifies, and if its variable is assigned only
+        by it and is not read in the loop before it. Such statements are
+        moved in front of the loop; since a do/while loop runs at least
+        once, this does not change the result.
+
+        Invariant subtrees of the remaining statements are materialized in
+        front of the loop when that is cheaper than evaluating them in each
+        of the expected number of iterations, according to the cost model of
+        CommonSubexpressionElimination.
+
+        The procedure is applied recursively on the CFG until convergence,
+        so computations move out of nested loops one loop at a time.
+        """
+
+        # Estimate the size of the temporary relations for the cost model
+        sizes = {}
+        tagged = []
+        for node in self.sorted_vertices:
+            op = self.graph.node[node]['op']
+            for scan in op.walk():
+                if (isinstance(scan, ScanTemp) and scan.name in sizes and
+                        not hasattr(scan, 'analyzed_num_tuples')):
+                    scan.analyzed_num_tuples = sizes[scan.name]
+                    tagged.append(scan)
+            def_var = self.graph.node[node]['def_var']
+            if def_var is not None:
+                sizes[def_var] = CommonSubexpressionElimination._estimate(op)
+
+        try:
+            self.__loop_invariant_code_motion(iterations)
+        finally:
+            for scan in tagged:
+                del scan.analyzed_num_tuples
+
+    def __loop_invariant_code_motion(self, iterations):
+        _continue = True
+        while _continue:
+            _continue = False
+            loops = self.__loops()
+
+            for first, last in loops:
+                body = [n for n in self.sorted_vertices if first <= n < last]
+                statements = [self.graph.node[n]['op'] for n in body]
+
+                for node in body + [last]:
+                    # skip the statements of nested loops
+                    innermost = next(loop for loop in loops
+                                     if loop[0] <= node <= loop[1])
+                    if innermost != (first, last):
+                        continue
+
+                    if (node != last and len(body) > 1 and
+                            self.__is_invariant(node, body, statements)):
+                        self.__hoist_node(node, first)
+                    elif not self.__hoist_subtrees(node, first, statements,
+                                                   iterations):
+                        continue
+                    _continue = True
+                    break
+
+                if _continue:
+                    break
+
+    def __accesses(self, nodes):
+        """Return the sets of variables and relations read and written by
+        the statements at the given nodes."""
+        reads, writes = set(), set()
+        for node in nodes:
+            reads.update(self.graph.node[node]['uses'])
+            def_var = self.graph.node[node]['def_var']
+            if def_var is not None:
+                writes.add(def_var)
+            for op in self.graph.node[node]['op'].walk():
+                if isinstance(op, (Scan, SampleScan)):
+                    reads.add(op.relation_key)
+                elif isinstance(op, Store):
+                    writes.add(op.relation_key)
+                elif isinstance(op, Dump):
+                    # keep the output in program order
+                    writes.add(Dump)
+        return reads, writes
+
+    def __schedule(self, ops, nodes):
+        """Group independent statements of a block into Parallel blocks.
+
+        A statement depends on an earlier one if it reads what the earlier
+        one writes, or writes what the earlier one reads or writes. Each
+        statement is scheduled in the first step after all of the statements
+        it depends on, and the statements of a step form a Parallel block.
+        Do/while loops do not run in parallel with other statements.
+
+        :param ops: the statements of the block
+        :param nodes: for each statement, the list of its CFG nodes
+        :returns: the new list of statements of the block
+        """
+        accesses = [self.__accesses(n) for n in nodes]
+        steps = []
+        for j, op in enumerate(ops):
+            reads, writes = accesses[j]
+            step = 0
+            for i in range(j):
+                if (isinstance(op, DoWhile) or isinstance(ops[i], DoWhile) or
+                        writes & (accesses[i][0] | accesses[i][1]) or
+                        reads & accesses[i][1]):
+                    step = max(step, steps[i] + 1)
+            steps.append(step)
+
+        scheduled = []
+        for step in range(max(steps) + 1 if steps else 0):
+            group = [op for op, s in zip(ops, steps) if s == step]
+            if len(group) == 1:
+                scheduled.append(group[0])
+            else:
+                scheduled.append(Parallel(group))
+        return scheduled
+
     def get_logical_plan(self, dead_code_elimination=True,
-                         apply_chaining=True):
+                         apply_chaining=True,
+                         loop_invariant_code_motion=True,
+                         parallel=False):
         """Extract a logical plan from the control flow graph.
 
         The logic here is simplistic:
@@ -342,6 +606,9 @@ class ControlFlowGraph(object):
         * Any node with out-degree == 2 is a while condition
         * Any other node is an ordinary operation.
 
+        If parallel is True, independent statements are grouped into
+        Parallel blocks; see __schedule.
+
         :returns: An instance of raco.algebra.Operator
         """
 
@@ -349,6 +616,9 @@ class ControlFlowGraph(object):
             self.dead_loop_elimination()
             self.dead_code_elimination()
 
+        if loop_invariant_code_motion:
+            self.loop_invariant_code_motion()
+
         if apply_chaining:
             self.apply_chaining()
 
@@ -356,6 +626,8 @@ class ControlFlowGraph(object):
             raise MyrialCompileException("Optimized program is empty")
 
         op_stack = [Sequence()]
+        # the CFG nodes of each statement of the blocks in op_stack
+        nodes_stack = [[]]
 
         def current_block():
             return op_stack[-1]
@@ -367,19 +639,30 @@ class ControlFlowGraph(object):
                 LOG.info("Terminating while loop (%d): %s", i, op)
                 # Terminate current do/while loop
                 assert isinstance(current_block(), DoWhile)
-                current_block().add(op)
-
                 do_while_op = op_stack.pop()
+                loop_nodes = nodes_stack.pop()
+                if parallel:
+                    do_while_op.args = self.__schedule(do_while_op.args,
+                                                       loop_nodes)
+                do_while_op.add(op)
+
                 current_block().add(do_while_op)
+                nodes_stack[-1].append(sum(loop_nodes, [i]))
                 continue
 
             if self.graph.in_degree(i) == 2:
                 LOG.info("Introducing while loop (%d)", i)
                 # Introduce new do/while loop
                 op_stack.append(DoWhile())
+                nodes_stack.append([])
 
             LOG.info("Adding operation to sequence (%d) %s", i, op)
             current_block().add(op)
+            nodes_stack[-1].append([i])
+
+        if parallel:
+            current_block().args = self.__schedule(current_block().args,
+                                                   nodes_stack[-1])
 
         assert len(op_stack) == 1
         return current_block()
@@ -2,9 +2,14 @@
 
 import collections
 
+from raco.backends.myria import compile_to_json
+import raco.backends.myria.validation as validation
+import raco.myrial.interpreter as interpreter
 import raco.myrial.myrial_test as myrial_test
 import raco.scheme as scheme
 from raco import types
+from raco.algebra import (DoWhile, Parallel, Scan, ScanTemp, Sequence,
+                          StoreTemp)
 import networkx as nx
 
 
@@ -81,6 +86,35 @@ class CFGTest(myrial_test.MyrialTestCase):
         self.processor.cfg.dead_code_elimination()
         self.assertEquals(set(self.processor.cfg.graph.nodes()), {2, 6, 7, 8})
 
+    def test_dead_code_elim_chain(self):
+        """A chain of dead statements is removed, but not the statements that
+        feed a loop."""
+        query = """
+        Point = SCAN(public:adhoc:points);
+        A = [FROM Point EMIT id];
+        B = [FROM A EMIT id];
+        C = [FROM B EMIT id];
+        x = [0 AS val];
+        DO
+          x = [FROM x, C EMIT x.val + 1 AS val];
+        WHILE [FROM x EMIT val < 5];
+        D = [FROM x EMIT val];
+        E = [FROM D EMIT val];
+        STORE(x, OUTPUT);
+        """
+
+        statements = self.parser.parse(query)
+        self.processor.evaluate(statements)
+        cfg = self.processor.cfg
+        cfg.dead_code_elimination()
+
+        self.assertEquals([cfg.graph.node[n]['def_var']
+                           for n in cfg.sorted_vertices],
+                          ['Point', 'A', 'B', 'C', 'x', 'x', None, None])
+        live_in, live_out = cfg.compute_liveness()
+        self.assertEquals(live_in[cfg.sorted_vertices[5]], {'x', 'C'})
+        self.assertEquals(live_out[cfg.sorted_vertices[6]], {'x', 'C'})
+
     def test_bug_245_dead_loop_elim_do_while(self):
         with open('examples/deadcode2.myl') as fh:
             query = fh.read()
@@ -224,3 +258,208 @@ class CFGTest(myrial_test.MyrialTestCase):
 
         self.processor.cfg.apply_chaining()
         self.assertEquals(set(self.processor.cfg.graph.nodes()), {4, 6, 7})
+
+    def test_chaining_shares_subplans(self):
+        """A variable that is read twice is inlined once, and is computed
+        once by the physical plan."""
+        self.db.ingest(CFGTest.points_key,
+                       collections.Counter([(i, float(i), float(i))
+                                            for i in range(4)]),
+                       CFGTest.points_schema)
+        query = """
+        A = [FROM SCAN(public:adhoc:points) AS P WHERE P.x > 1 EMIT P.id];
+        B = [FROM A AS A1, A AS A2 WHERE A1.id = A2.id EMIT A1.id];
+        C = [FROM B AS B1, B AS B2 WHERE B1.id = B2.id EMIT B1.id];
+        STORE(C, OUTPUT);
+        """
+
+        statements = self.parser.parse(query)
+        self.processor.evaluate(statements)
+        plan = self.processor.get_logical_plan()
+        self.assertEquals(len(list(plan.walk())), 23)
+        self.assertEquals(len({id(op) for op in plan.walk()}), 11)
+
+        physical_plan = self.processor.get_physical_plan()
+        plan_json = compile_to_json(query, plan, physical_plan)
+        self.assertEqual(validation.plan_errors(plan_json), [])
+        op_types = collections.Counter(
+            op['opType'] for fragment in plan_json['plan']['fragments']
+            for op in fragment['operators'])
+        self.assertEqual(op_types['TableScan'], 1)
+        self.assertEqual(op_types['ShuffleProducer'], 1)
+        self.assertEqual(op_types['SymmetricHashJoin'], 2)
+        self.db.evaluate(physical_plan)
+        self.assertEquals(self.db.get_table('OUTPUT'),
+                          collections.Counter([(2,), (3,)]))
+
+    def test_chained_self_references(self):
+        """A chain of statements that each read the previous variable twice
+        yields logical and physical plans that grow linearly."""
+        self.db.ingest(CFGTest.points_key,
+                       collections.Counter([(1, 1.0, 1.0)]),
+                       CFGTest.points_schema)
+        n = 6
+        query = '\n'.join(
+            ['A0 = SCAN(public:adhoc:points);'] +
+            ['A{} = A{} + A{};'.format(i, i - 1, i - 1)
+             for i in range(1, n + 1)] +
+            ['STORE(A{}, OUTPUT);'.format(n)])
+
+        statements = self.parser.parse(query)
+        self.processor.evaluate(statements)
+        plan = self.processor.get_logical_plan()
+        self.assertEquals(len({id(op) for op in plan.walk()}), n + 3)
+
+        physical_plan = self.processor.get_physical_plan()
+        operators = {id(op): op for op in physical_plan.collectGraph()[
+            'nodes']}
+        self.assertLessEqual(len(operators), 4 * n + 3)
+        scans = [op for op in operators.values() if isinstance(op, Scan)]
+        self.assertEquals(len(scans), 2)
+
+        # each shared UnionAll is computed once and split to its two parents
+        plan_json = compile_to_json(query, plan, physical_plan)
+        fragments = plan_json['plan']['fragments']
+        self.assertLessEqual(sum(len(f['operators']) for f in fragments),
+                             5 * n + 3)
+        self.assertEqual(validation.plan_errors(plan_json), [])
+
+        self.db.evaluate(physical_plan)
+        self.assertEquals(self.db.get_table('OUTPUT'),
+                          collections.Counter({(1, 1.0, 1.0): 2 ** n}))
+
+    def test_loop_invariant_body(self):
+        """A loop whose statements are all invariant keeps a body."""
+        query = """
+        Point = SCAN(public:adhoc:points);
+        DO
+          C = [FROM Point EMIT id];
+          E = [FROM C EMIT COUNT(*) > 0 AS cnt];
+        WHILE E;
+        STORE(C, OUTPUT);
+        """
+
+        statements = self.parser.parse(query)
+        self.processor.evaluate(statements)
+        self.processor.get_logical_plan()
+        self.db.evaluate(self.processor.get_physical_plan())
+        self.assertEquals(self.db.get_table('OUTPUT'), collections.Counter())
+
+    def test_loop_invariant_code_motion(self):
+        """Invariant statements and subtrees are moved in front of a loop."""
+        self.db.ingest(CFGTest.points_key,
+                       collections.Counter([(i, float(i), float(i * i))
+                                            for i in range(20)]),
+                       CFGTest.points_schema)
+        query = """
+        Point = SCAN(public:adhoc:points);
+        x = [0 AS val];
+        b = [0 AS val];
+        DO
+          c = [FROM b EMIT val];
+          b = [FROM Point EMIT COUNT(*) AS val];
+          Big = [FROM Point WHERE x * y > 100 EMIT *];
+          x = [FROM x, [FROM Point WHERE x > 2 EMIT id] AS P
+               WHERE P.id == x.val + 3 EMIT P.id AS val];
+        WHILE [FROM x EMIT val < 5];
+        STORE(Big, OUTPUT);
+        STORE(x, OUTPUT2);
+        STORE(c, OUTPUT3);
+        """
+
+        statements = self.parser.parse(query)
+        self.processor.evaluate(statements)
+        cfg = self.processor.cfg
+        cfg.loop_invariant_code_motion()
+
+        def def_var(node):
+            return cfg.graph.node[node]['def_var']
+
+        # Big and the subquery over Point precede the loop. b is read
+        # before it is assigned, so only its aggregate is materialized.
+        first, last = [(d, s) for s, d in cfg.graph.edges() if d < s][0]
+        before = [def_var(n) for n in cfg.sorted_vertices if n < first]
+        body = [def_var(n) for n in cfg.sorted_vertices if first <= n < last]
+        self.assertEquals(before, ['Point', 'x', 'b', '__licm_0', 'Big',
+                                   '__licm_1'])
+        self.assertEquals(body, ['c', 'b', 'x'])
+        self.assertEquals(cfg.graph.node[first + 1]['uses'], {'__licm_0'})
+        self.assertEquals(cfg.graph.node[first + 2]['uses'],
+                          {'x', '__licm_1'})
+        self.assertEquals(sorted(cfg.graph.edges()),
+                          sorted([(i, i + 1)
+                                  for i in range(len(cfg.graph) - 1)] +
+                                 [(last, first)]))
+
+        results = []
+        for licm in [True, False]:
+            self.processor = interpreter.StatementProcessor(self.db)
+            self.processor.evaluate(statements)
+            self.db.evaluate(self.processor.get_physical_plan(
+                loop_invariant_code_motion=licm))
+            results.append([self.db.get_table(out)
+                            for out in ['OUTPUT', 'OUTPUT2', 'OUTPUT3']])
+        self.assertEquals(results[0], results[1])
+        self.assertEquals(results[0][1], collections.Counter([(6,)]))
+        self.assertEquals(results[0][2], collections.Counter([(20,)]))
+
+    def test_parallel_schedule(self):
+        query = """
+        Point = SCAN(public:adhoc:points);
+        A = [FROM Point WHERE x > 1 EMIT *];
+        B = [FROM Point WHERE y > 1 EMIT *];
+        DO
+          C = [FROM A EMIT id];
+          D = [FROM B EMIT id];
+          E = [FROM C, D WHERE C.id = D.id EMIT COUNT(*) > 0 AS cnt];
+        WHILE E;
+        STORE(C, OUTPUT);
+        STORE(D, OUTPUT2);
+        """
+
+        statements = self.parser.parse(query)
+        self.processor.evaluate(statements)
+        plan = self.processor.cfg.get_logical_plan(
+            apply_chaining=False, loop_invariant_code_motion=False,
+            parallel=True)
+
+        # A and B only depend on Point, the loop is a barrier, and the
+        # loop condition stays last in the loop body
+        self.assertIsInstance(plan, Sequence)
+        self.assertEquals([type(op) for op in plan.args],
+                          [StoreTemp, Parallel, DoWhile, Parallel])
+        self.assertEquals(sorted(op.name for op in plan.args[1].args),
+                          ['A', 'B'])
+        loop = plan.args[2]
+        self.assertEquals([type(op) for op in loop.args],
+                          [Parallel, StoreTemp, ScanTemp])
+        self.assertEquals(sorted(op.name for op in loop.args[0].args),
+                          ['C', 'D'])
+        self.assertEquals(loop.args[1].name, 'E')
+        self.assertEquals(
+            sorted(str(op.relation_key) for op in plan.args[3].args),
+            ['public:adhoc:OUTPUT', 'public:adhoc:OUTPUT2'])
+
+    def test_parallel_op_ids(self):
+        """The statements of a Parallel block compile into one SubQuery, in
+        which opIds are unique"""
+        query = """
+        Point = SCAN(public:adhoc:points);
+        A = [FROM Point WHERE x > 1 EMIT *];
+        B = [FROM Point WHERE y > 1 EMIT *];
+        STORE(A, OUTPUT);
+        STORE(B, OUTPUT2);
+        """
+
+        statements = self.parser.parse(query)
+        self.processor.evaluate(statements)
+        plan = self.processor.get_physical_plan()
+        plans = compile_to_json(query, None, plan)['plan']['plans']
+
+        self.assertEquals(len(plans), 3)
+        for subquery in plans[1:]:
+            self.assertEquals(subquery['type'], 'SubQuery')
+            self.assertGreater(len(subquery['fragments']), 1)
+            op_ids = [op['opId'] for fragment in subquery['fragments']
+                      for op in fragment['operators']]
+            self.assertEquals(len(op_ids), len(set(op_ids)))
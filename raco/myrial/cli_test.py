@@ -32,6 +32,17 @@ class CliTest(unittest.TestCase):
                                        'examples/standalone.myl'])
         self.assertIn("FileScan('./examples/dept.csv'", out)
 
+    def test_cli_profile_optimizer(self):
+        proc = subprocess.Popen(
+            ['python', 'scripts/myrial', '--profile-optimizer',
+             '--profile-format', 'json',
+             'examples/reachable.myl'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertIn('DO', out)
+        self.assertIn('"rewrites"', err)
+        self.assertIn('push_select', err)
+
     def test_cli_reserved_column_name(self):
         proc = subprocess.Popen(
             ['python', 'scripts/myrial', 'examples/bad_column_name.myl'],
@@ -7,12 +7,14 @@ import raco.algebra
 import raco.expression
 import raco.catalog
 import raco.scheme
-from raco.backends.myria import (MyriaLeftDeepTreeAlgebra,
+from raco.backends.myria import (MyriaAlgebra,
+                                 MyriaLeftDeepTreeAlgebra,
                                  MyriaHyperCubeAlgebra,
                                  compile_to_json)
 from raco.compile import optimize
 from raco import relation_key
 from raco.algebra import Shuffle
+from raco.myrial.plan_cache import referenced_relations
 
 import collections
 import copy
@@ -81,7 +83,9 @@ class ExpressionProcessor(object):
             raise NoSuchRelationException(_id)
 
         self.uses_set.add(_id)
-        return copy.deepcopy(self.symbols[_id])
+        # symbols are scans of temporary relations; schemes are not modified
+        symbol = self.symbols[_id]
+        return raco.algebra.ScanTemp(symbol.name, symbol.scheme())
 
     def alias(self, _id):
         return self.__lookup_symbol(_id)
@@ -324,7 +328,14 @@ class StatementProcessor(object):
 
     """Evaluate a list of statements"""
 
-    def __init__(self, catalog, use_dummy_schema=False):
+    def __init__(self, catalog, use_dummy_schema=False, plan_cache=None):
+        """
+        :param catalog: the catalog statements are compiled against
+        :param use_dummy_schema: do not require relations to exist
+        :param plan_cache: an optional raco.myrial.plan_cache.PlanCache. When
+        given, evaluation of statements is deferred until a plan is requested
+        that is not in the cache.
+        """
         # Map from identifiers (aliases) to raco.algebra.Operation instances
         self.symbols = {}
 
@@ -334,12 +345,32 @@ class StatementProcessor(object):
 
         self.cfg = ControlFlowGraph()
 
+        self.plan_cache = plan_cache
+        # All statements given to evaluate, and those not yet processed
+        self.statements = []
+        self.pending_statements = []
+
     def evaluate(self, statements):
         """Evaluate a list of statements"""
-        for statement in statements:
-            # Switch on the first tuple entry
-            method = getattr(self, statement[0].lower())
-            method(*statement[1:])
+        if self.plan_cache is not None:
+            # evaluation modifies the statements; keep a pristine copy
+            self.statements.extend(copy.deepcopy(statements))
+            self.pending_statements.extend(statements)
+        else:
+            self.__evaluate_statements(statements)
+
+    def __evaluate_pending(self):
+        statements = self.pending_statements
+        self.pending_statements = []
+        self.__evaluate_statements(statements)
+
+    def __evaluate_statements(self, statements):
+        with self.catalog.compiling():
+            self.catalog.prefetch(referenced_relations(statements))
+            for statement in statements:
+                # Switch on the first tuple entry
+                method = getattr(self, statement[0].lower())
+                method(*statement[1:])
 
     def __evaluate_expr(self, expr, _def):
         """Evaluate an expression; add a node to the control flow graph.
@@ -437,11 +468,32 @@ class StatementProcessor(object):
         # loop
         self.cfg.add_edge(last_op_id, first_op_id)
 
+    def __cached(self, kind, compute, **kwargs):
+        """Return the result of compute(**kwargs), using the plan cache if
+        there is one."""
+        with self.catalog.compiling():
+            if self.plan_cache is None:
+                return compute(**kwargs)
+
+            key = self.plan_cache.key(kind, self.statements, self.catalog,
+                                      **kwargs)
+            if key is None:
+                return compute(**kwargs)
+            value = self.plan_cache.get(key)
+            if value is None:
+                value = compute(**kwargs)
+                self.plan_cache.put(key, value)
+            return value
+
     def get_logical_plan(self, **kwargs):
         """Return an operator representing the logical query plan."""
+        self.__evaluate_pending()
         return self.cfg.get_logical_plan(
             dead_code_elimination=kwargs.get('dead_code_elimination', True),
-            apply_chaining=kwargs.get('apply_chaining', True))
+            apply_chaining=kwargs.get('apply_chaining', True),
+            loop_invariant_code_motion=kwargs.get(
+                'loop_invariant_code_motion', True),
+            parallel=kwargs.get('parallel', False))
 
     def __get_physical_plan_for__(self, target_phys_algebra, **kwargs):
         logical_plan = self.get_logical_plan(**kwargs)
@@ -451,18 +503,28 @@ class StatementProcessor(object):
 
     def get_physical_plan(self, **kwargs):
         """Return an operator representing the physical query plan."""
+        return self.__cached('physical', self.__get_physical_plan, **kwargs)
+
+    def __get_physical_plan(self, **kwargs):
         target_phys_algebra = kwargs.get('target_alg')
         if target_phys_algebra is None:
             if kwargs.get('multiway_join', False):
                 target_phys_algebra = MyriaHyperCubeAlgebra(self.catalog)
             else:
-                target_phys_algebra = MyriaLeftDeepTreeAlgebra()
+                target_phys_algebra = MyriaLeftDeepTreeAlgebra(self.catalog)
+
+        if isinstance(target_phys_algebra, MyriaAlgebra):
+            # Myria runs the statements of a Parallel block concurrently
+            kwargs.setdefault('parallel', True)
 
         return self.__get_physical_plan_for__(target_phys_algebra, **kwargs)
 
     def get_json(self, **kwargs):
+        return self.__cached('json', self.__get_json, **kwargs)
+
+    def __get_json(self, **kwargs):
         lp = self.get_logical_plan()
-        pps = self.get_physical_plan(**kwargs)
+        pps = self.__get_physical_plan(**kwargs)
 
         # TODO This is not correct. The first argument is the raw query string,
         # not the string representation of the logical plan
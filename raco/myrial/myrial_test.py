@@ -2,12 +2,26 @@ import json
 import unittest
 
 from raco.backends.myria import compile_to_json, MyriaStore, MyriaSink
+from raco.backends.myria.validation import validate_plan
 import raco.fakedb
 import raco.myrial.interpreter as interpreter
 import raco.myrial.parser as parser
 import raco.viz
 from raco.replace_with_repr import replace_with_repr
-from raco import relation_key
+from raco import relation_key, serialization
+
+
+def canonical_json(value):
+    """Order the dicts and sets in a serialized plan, to compare plans"""
+    if isinstance(value, list):
+        return [canonical_json(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    value = {k: canonical_json(v) for k, v in value.iteritems()}
+    if value.keys() in (['d'], ['s'], ['f']):
+        items = value.values()[0]
+        return {value.keys()[0]: sorted(items, key=json.dumps)}
+    return value
 
 
 class MyrialTestCase(unittest.TestCase):
@@ -39,6 +53,11 @@ class MyrialTestCase(unittest.TestCase):
         # verify that we can convert p to a dot
         # TODO verify the dot somehow?
         raco.viz.get_dot(p)
+        # Test serialization, and run the deserialized plan from here on
+        p_json = serialization.loads(serialization.dumps(p))
+        assert (canonical_json(serialization.to_json(p_json)) ==
+                canonical_json(serialization.to_json(p)))
+        p = serialization.loads(serialization.dumps(p, binary=True))
         # Test repr
         # FIXME: replace_with_repr() is broken for logical ops
         # (__repr__ doesn't persist any constructor args),
@@ -65,9 +84,10 @@ class MyrialTestCase(unittest.TestCase):
 
         if not test_logical and not skip_json:
             # Test that JSON compilation runs without error
-            # TODO: verify the JSON output somehow?
-            json_string = json.dumps(compile_to_json(
-                "some query", "some logical plan", plan, "myrial"))
+            compiled = compile_to_json(
+                "some query", "some logical plan", plan, "myrial")
+            validate_plan(compiled)
+            json_string = json.dumps(compiled)
             assert json_string
 
         self.db.evaluate(plan)
@@ -1,7 +1,9 @@
 import collections
+import copy
 import random
 import sys
 import re
+import json
 
 from raco.algebra import *
 from raco.expression import NamedAttributeRef as AttRef
@@ -13,11 +15,12 @@ from raco.backends.myria import (
     MyriaShuffleConsumer, MyriaShuffleProducer, MyriaHyperCubeShuffleProducer,
     MyriaBroadcastConsumer, MyriaBroadcastProducer, MyriaSplitConsumer,
     MyriaScan, MyriaQueryScan, MyriaUnionAll,
-    MyriaDupElim, MyriaGroupBy, MyriaSelect)
+    MyriaDupElim, MyriaGroupBy, MyriaSelect, MyriaApply, MyriaLimit,
+    MyriaInMemoryOrderBy, MyriaCollectConsumer, MyriaCollectProducer)
 from raco.backends.myria import (MyriaLeftDeepTreeAlgebra,
                                  MyriaHyperCubeAlgebra)
-from raco.compile import optimize
-from raco import relation_key
+from raco.compile import optimize, RuleProfiler
+from raco import relation_key, rules
 from raco.catalog import FakeCatalog
 
 import raco.scheme as scheme
@@ -500,10 +503,13 @@ class OptimizerTest(myrial_test.MyrialTestCase):
         self.assertEquals(self.get_count(pp, Difference), 1)
         for op in pp.walk():
             if isinstance(op, Difference):
-                self.assertIsInstance(op.left, MyriaShuffleConsumer)
-                self.assertIsInstance(op.left.input, MyriaShuffleProducer)
-                self.assertIsInstance(op.right, MyriaShuffleConsumer)
-                self.assertIsInstance(op.right.input, MyriaShuffleProducer)
+                # both inputs read the same shuffled scan, computed once
+                self.assertIsInstance(op.left, MyriaSplitConsumer)
+                self.assertIsInstance(op.right, MyriaSplitConsumer)
+                self.assertEqual(op.left.input, op.right.input)
+                shuffled = op.left.input.input
+                self.assertIsInstance(shuffled, MyriaShuffleConsumer)
+                self.assertIsInstance(shuffled.input, MyriaShuffleProducer)
 
     def test_bug_240_broken_remove_unused_columns_rule(self):
         query = """
@@ -1329,3 +1335,424 @@ class OptimizerTest(myrial_test.MyrialTestCase):
         self.assertIsInstance(pp.input.input, MyriaShuffleProducer)
         self.assertIsInstance(pp.input.input.input, Select)
         self.assertIsInstance(pp.input.input.input.input, FileScan)
+
+    def test_rule_profiler(self):
+        """Test that the rule profiler records per-rule statistics."""
+        query = """
+        X = scan(public:adhoc:X);
+        Y = scan(public:adhoc:Y);
+        Z = [from X, Y where X.c = Y.d and X.a > X.b emit X.a, Y.f];
+        store(Z, OUTPUT);"""
+
+        lp = self.get_logical_plan(query)
+        profiler = RuleProfiler()
+        pp = self.logical_to_physical(lp, profiler=profiler)
+        self.assertEquals(self.get_count(pp, MyriaSelect), 1)
+
+        stats = profiler.by_rule()
+        self.assertTrue(all(s.invocations >= 1 for s in stats))
+        self.assertTrue(all(s.nodes >= s.rewrites for s in stats))
+        times = [s.time for s in stats]
+        self.assertEquals(times, sorted(times, reverse=True))
+
+        groups = {s.group: s for s in profiler.by_group()}
+        for name in ['push_select', 'push_apply', 'shuffle_logic',
+                     'myriafy', 'break_communication']:
+            self.assertIn(name, groups)
+        self.assertGreater(groups['push_select'].rewrites, 0)
+        self.assertGreater(groups['myriafy'].rewrites, 0)
+        self.assertEquals(sum(s.nodes for s in stats),
+                          sum(s.nodes for s in groups.values()))
+
+        report = json.loads(profiler.to_json(sort_by='nodes'))
+        self.assertEquals(len(report['rules']), len(stats))
+        self.assertIn('push_select', profiler.format_table())
+
+    def test_common_subexpression_elimination(self):
+        """Test that a filtered scan shared by several statements is computed
+        once, regardless of the aliases used."""
+        query = """
+        A = [from scan(public:adhoc:X) as x where x.a > x.b emit x.a];
+        B = [from scan(public:adhoc:X) as y where y.a > y.b emit y.c];
+        C = [from scan(public:adhoc:X) as z where z.a > z.b emit *];
+        store(A, OUTA);
+        store(B, OUTB);
+        store(C, OUTPUT);"""
+
+        lp = self.get_logical_plan(query)
+        self.assertEquals(self.get_count(lp, Scan), 3)
+
+        pp = self.logical_to_physical(copy.deepcopy(lp))
+        self.assertEquals(self.get_count(pp, MyriaScan), 1)
+        self.assertEquals(self.get_count(pp, MyriaSelect), 1)
+
+        self.db.evaluate(pp)
+        expected = collections.Counter(
+            [(a, b, c) for (a, b, c) in self.x_data.elements() if a > b])
+        self.assertEquals(self.db.get_table('OUTPUT'), expected)
+        self.assertEquals(
+            self.db.get_table('OUTA'),
+            collections.Counter([(a,) for (a, b, c) in expected.elements()]))
+
+        pp = self.logical_to_physical(
+            lp, no_CommonSubexpressionElimination=True)
+        self.assertEquals(self.get_count(pp, MyriaScan), 3)
+
+    def test_common_subexpression_not_materialized(self):
+        """Test that subtrees that are cheap to recompute are not
+        materialized."""
+        query = """
+        A = [from scan(public:adhoc:X) as x where x.a > x.b emit x.a];
+        B = [from scan(public:adhoc:X) as y where y.a > y.b emit y.c];
+        store(A, OUTA);
+        store(B, OUTB);"""
+
+        pp = self.logical_to_physical(self.get_logical_plan(query))
+        self.assertEquals(self.get_count(pp, MyriaScan), 2)
+        self.assertEquals(sorted(op.name for op in pp.walk()
+                                 if isinstance(op, StoreTemp)), ['A', 'B'])
+
+    def test_common_subexpression_elimination_parallel(self):
+        """Test that shared subtrees of Parallel children are stored before
+        the Parallel runs."""
+        def query(name):
+            return Store(relation_key.RelationKey(name),
+                         Select(expression.GT(AttIndex(0), AttIndex(1)),
+                                Scan(self.x_key, self.x_scheme)))
+
+        par = Parallel([query('OUT1'), query('OUT2'), query('OUT3')])
+        seq = rules.CommonSubexpressionElimination()(par)
+        self.assertIsInstance(seq, Sequence)
+        self.assertEquals(len(seq.args), 2)
+        self.assertIsInstance(seq.args[0], StoreTemp)
+        self.assertIs(seq.args[1], par)
+        self.assertEquals(self.get_count(seq, Scan), 1)
+        self.assertEquals(self.get_count(par, ScanTemp), 3)
+
+    def test_skew_aware_shuffle_join(self):
+        """Test that heavy hitters of a join key are broadcast joined."""
+        query = """
+        x = scan({x});
+        y = scan({y});
+        out = [from x, y where x.c == y.d emit *];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, y=self.y_key)
+
+        catalog = FakeCatalog(4, child_heavy_hitters={
+            'X': {2: {8: 4, 11: 4}}})
+        lp = self.get_logical_plan(query)
+        pp = optimize(lp, MyriaLeftDeepTreeAlgebra(catalog))
+
+        self.assertEquals(self.get_count(pp, MyriaUnionAll), 1)
+        # the light tuples of both sides are shuffled, the heavy tuples of
+        # x stay in place and the matching tuples of y are broadcast
+        self.assertEquals(self.get_count(pp, MyriaShuffleProducer), 2)
+        self.assertEquals(self.get_count(pp, MyriaBroadcastProducer), 1)
+        for op in pp.walk():
+            if isinstance(op, MyriaBroadcastProducer):
+                self.assertEquals(op.input.input.relation_key, self.y_key)
+
+        self.db.evaluate(pp)
+        expected = collections.Counter(
+            [(a, b, c, d, e, f) for (a, b, c) in self.x_data.elements()
+             for (d, e, f) in self.y_data.elements() if c == d])
+        self.assertEquals(self.db.get_table('OUTPUT'), expected)
+
+    def test_skew_aware_shuffle_join_uniform(self):
+        """Test that joins without heavy hitters are shuffled as usual."""
+        query = """
+        x = scan({x});
+        y = scan({y});
+        out = [from x, y where x.c == y.d emit *];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, y=self.y_key)
+
+        lp = self.get_logical_plan(query)
+        pp = optimize(lp, MyriaLeftDeepTreeAlgebra(FakeCatalog(4)))
+        self.assertEquals(self.get_count(pp, MyriaUnionAll), 0)
+        self.assertEquals(self.get_count(pp, MyriaShuffleProducer), 2)
+        self.assertEquals(self.get_count(pp, MyriaBroadcastProducer), 0)
+
+    def test_broadcast_join_cost(self):
+        """Test that the small input of a join is broadcast when that is
+        cheaper than shuffling both inputs."""
+        query = """
+        x = scan({x});
+        z = scan({z});
+        out = [from x, z where x.a == z.src emit *];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, z=self.z_key)
+        lp = self.get_logical_plan(query)
+
+        pp = optimize(copy.deepcopy(lp),
+                      MyriaLeftDeepTreeAlgebra(FakeCatalog(4)))
+        self.assertEquals(self.get_count(pp, MyriaShuffleProducer), 0)
+        self.assertEquals(self.get_count(pp, MyriaBroadcastProducer), 1)
+        for op in pp.walk():
+            if isinstance(op, MyriaBroadcastProducer):
+                self.assertEquals(op.input.relation_key, self.z_key)
+
+        self.db.evaluate(pp)
+        expected = collections.Counter(
+            [(a, b, c, s, d) for (a, b, c) in self.x_data.elements()
+             for (s, d) in self.z_data.elements() if a == s])
+        self.assertEquals(self.db.get_table('OUTPUT'), expected)
+
+        # on many servers the broadcast costs more than the shuffles
+        pp = optimize(copy.deepcopy(lp),
+                      MyriaLeftDeepTreeAlgebra(FakeCatalog(64)))
+        self.assertEquals(self.get_count(pp, MyriaShuffleProducer), 2)
+        self.assertEquals(self.get_count(pp, MyriaBroadcastProducer), 0)
+
+        # a threshold of 0 disables broadcast joins
+        pp = optimize(copy.deepcopy(lp),
+                      MyriaLeftDeepTreeAlgebra(FakeCatalog(4)),
+                      broadcast_join_threshold=0)
+        self.assertEquals(self.get_count(pp, MyriaShuffleProducer), 2)
+        self.assertEquals(self.get_count(pp, MyriaBroadcastProducer), 0)
+
+    def test_join_partitioning_conjunction(self):
+        """A join of inputs hashed on the join columns is partitioned by
+        the join columns of either side."""
+        join = Join(expression.EQ(AttIndex(2), AttIndex(3)),
+                    Shuffle(Scan(self.x_key, self.x_scheme), [AttIndex(2)]),
+                    Shuffle(Scan(self.y_key, self.y_scheme), [AttIndex(0)]))
+        part = join.partitioning()
+        self.assertEquals(part.hash_partitioned, frozenset([AttIndex(2)]))
+        self.assertTrue(part.is_hash_partitioned([AttIndex(2)]))
+        self.assertTrue(part.is_hash_partitioned([AttIndex(3)]))
+        self.assertFalse(part.is_hash_partitioned([AttIndex(2),
+                                                   AttIndex(3)]))
+
+        # projections keep the keys that survive
+        pjoin = ProjectingJoin(join.condition, join.left, join.right,
+                               [AttIndex(0), AttIndex(3)])
+        self.assertEquals(pjoin.partitioning().hash_partitioned,
+                          frozenset([AttIndex(1)]))
+
+        # inputs hashed on other columns are not co-located
+        join.right = Shuffle(join.right.input, [AttIndex(1)])
+        self.assertFalse(join.partitioning().is_hash_partitioned(
+            [AttIndex(3)]))
+
+    def test_orderby_sorted_properties(self):
+        op = OrderBy(Shuffle(Scan(self.x_key, self.x_scheme), [AttIndex(0)]),
+                     [AttIndex(1), AttIndex(2)], [True, False])
+        part = op.partitioning()
+        self.assertTrue(part.is_hash_partitioned([AttIndex(0)]))
+        self.assertTrue(part.is_sorted([(AttIndex(1), True)]))
+        self.assertFalse(part.is_sorted([(AttIndex(1), False)]))
+        self.assertTrue(part.is_grouped([AttIndex(2), AttIndex(1)]))
+        self.assertFalse(part.is_grouped([AttIndex(2)]))
+
+        # the sort order survives a projection of a prefix
+        proj = Apply([('b', AttIndex(1)), ('a', AttIndex(0))], op)
+        self.assertTrue(proj.partitioning().is_sorted([(AttIndex(0), True)]))
+        self.assertTrue(proj.partitioning().is_hash_partitioned(
+            [AttIndex(1)]))
+
+    def test_join_on_equivalent_key_no_reshuffle(self):
+        """Joining on the other key of a previous join does not shuffle."""
+        query = """
+        x = scan({x});
+        y = scan({y});
+        z = scan({z});
+        out = [from x, y, z where x.c == y.d and y.d == z.src
+               emit x.a, z.dst];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, y=self.y_key, z=self.z_key)
+
+        lp = self.get_logical_plan(query)
+        pp = self.logical_to_physical(lp)
+        # x, y and z are shuffled, the result of x join y is not
+        self.assertEquals(self.get_count(pp, MyriaShuffleProducer), 3)
+
+        self.db.evaluate(pp)
+        expected = collections.Counter(
+            [(a, dst) for (a, b, c) in self.x_data.elements()
+             for (d, e, f) in self.y_data.elements()
+             for (src, dst) in self.z_data.elements()
+             if c == d and d == src])
+        self.assertEquals(self.db.get_table('OUTPUT'), expected)
+
+    def test_eager_aggregation(self):
+        """Test that a partial aggregate is pushed below a join."""
+        query = """
+        x = scan({x});
+        z = scan({z});
+        out = [from x, z where x.a == z.src
+               emit z.dst, sum(x.b), count(*), avg(x.c), max(x.b)];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, z=self.z_key)
+
+        lp = self.get_logical_plan(query)
+        pp = self.logical_to_physical(copy.deepcopy(lp))
+        # x is aggregated before it is shuffled to the join
+        for op in pp.walk():
+            if isinstance(op, MyriaScan) and op.relation_key == self.x_key:
+                scan = op
+        aggregated = [op for op in pp.walk() if isinstance(op, MyriaGroupBy)
+                      and op.input is scan]
+        self.assertEquals(len(aggregated), 1)
+        self.assertEquals(aggregated[0].grouping_list, [AttIndex(0)])
+
+        self.db.evaluate(pp)
+        result = self.db.get_table('OUTPUT')
+        self.db.evaluate(self.logical_to_physical(
+            lp, no_EagerAggregation=True))
+        self.assertEquals(result, self.db.get_table('OUTPUT'))
+
+    def test_eager_aggregation_both_sides(self):
+        """Aggregates that read both inputs stay above the join."""
+        query = """
+        x = scan({x});
+        z = scan({z});
+        out = [from x, z where x.a == z.src emit z.dst, sum(x.b + z.dst)];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, z=self.z_key)
+
+        lp = self.get_logical_plan(query)
+        pp = self.logical_to_physical(lp)
+        for op in pp.walk():
+            if isinstance(op, MyriaGroupBy):
+                self.assertEquals(self.get_count(op, Join), 1)
+
+    def test_infer_join_predicates(self):
+        """A constant predicate on one join input filters the other too."""
+        query = """
+        x = scan({x});
+        z = scan({z});
+        out = [from x, z where x.a == z.src and z.src == 3 emit *];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, z=self.z_key)
+
+        lp = self.get_logical_plan(query)
+        pp = self.logical_to_physical(copy.deepcopy(lp))
+        selected = [op.input.relation_key for op in pp.walk()
+                    if isinstance(op, Select) and
+                    isinstance(op.input, MyriaScan)]
+        self.assertEquals(len(selected), 2)
+        self.assertEquals(set(selected), {self.x_key, self.z_key})
+
+        self.db.evaluate(pp)
+        result = self.db.get_table('OUTPUT')
+        self.db.evaluate(self.logical_to_physical(
+            lp, no_InferJoinPredicates=True))
+        self.assertEquals(result, self.db.get_table('OUTPUT'))
+
+    def test_infer_join_predicates_chain(self):
+        """Range predicates follow a chain of join equalities."""
+        query = """
+        x = scan({x});
+        y = scan({y});
+        z = scan({z});
+        out = [from x, y, z where x.a == y.d and y.d == z.src and
+               x.a > 3 and z.src <= 12 emit *];
+        store(out, OUTPUT);
+        """.format(x=self.x_key, y=self.y_key, z=self.z_key)
+
+        lp = self.get_logical_plan(query)
+        pp = self.logical_to_physical(copy.deepcopy(lp))
+        selects = [op for op in pp.walk() if isinstance(op, Select) and
+                   isinstance(op.input, MyriaScan)]
+        self.assertEquals(len(selects), 3)
+        for op in selects:
+            self.assertEquals(self.get_num_select_conjuncs(op), 2)
+
+        self.db.evaluate(pp)
+        result = self.db.get_table('OUTPUT')
+        self.db.evaluate(self.logical_to_physical(
+            lp, no_InferJoinPredicates=True))
+        self.assertEquals(result, self.db.get_table('OUTPUT'))
+
+    def test_push_limit(self):
+        """Limits are evaluated before Applies and below a UnionAll."""
+        query = """
+        x = scan({x});
+        y = scan({y});
+        u = unionall([from x emit a + b as s], [from y emit d * e as s]);
+        out = limit(u, 4);
+        store(out, OUTPUT);
+        """.format(x=self.x_key, y=self.y_key)
+
+        pp = self.logical_to_physical(self.get_logical_plan(query))
+        # each input is limited on each worker before it is collected
+        for op in pp.walk():
+            if isinstance(op, MyriaApply):
+                self.assertIsInstance(op.input, MyriaLimit)
+        self.assertEquals(self.get_count(pp, MyriaLimit), 4)
+        self.assertEquals(self.get_count(pp, MyriaCollectConsumer), 1)
+
+        self.db.evaluate(pp)
+        result = self.db.get_table('OUTPUT')
+        self.assertEquals(sum(result.values()), 4)
+        expected = collections.Counter(
+            [(a + b,) for a, b, _ in self.x_data.elements()] +
+            [(d * e,) for d, e, _ in self.y_data.elements()])
+        self.assertEquals(result - expected, collections.Counter())
+
+    def test_distributed_top_k(self):
+        """Each worker sends only its top k tuples to the collector."""
+        lp = Store(relation_key.RelationKey('OUTPUT'),
+                   Limit(5, OrderBy(Scan(self.x_key, self.x_scheme),
+                                    [0, 1, 2],
+                                    [False, True, True])))
+        pp = self.logical_to_physical(lp)
+        collect = [op for op in pp.walk()
+                   if isinstance(op, MyriaCollectProducer)]
+        self.assertEquals(len(collect), 1)
+        self.assertIsInstance(collect[0].input, MyriaLimit)
+        self.assertIsInstance(collect[0].input.input, MyriaInMemoryOrderBy)
+        self.assertEquals(self.get_count(pp, MyriaInMemoryOrderBy), 2)
+
+        self.db.evaluate(pp)
+        expected = sorted(self.x_data.elements(),
+                          key=lambda t: (-t[0], t[1], t[2]))[:5]
+        self.assertEquals(self.db.get_table('OUTPUT'),
+                          collections.Counter(expected))
+
+    def test_distinct_before_setop_shuffle(self):
+        """Inputs with many duplicates are deduplicated before a set
+        operation shuffles them."""
+        query = """
+        x = scan({x});
+        y = scan({y});
+        out = diff(x, y);
+        store(out, OUTPUT);
+        """.format(x=self.x_key, y=self.y_key)
+
+        lp = self.get_logical_plan(query)
+        catalog = FakeCatalog(4, child_distinct_tuples={'X': 3, 'Y': 30})
+        pp = optimize(copy.deepcopy(lp), MyriaLeftDeepTreeAlgebra(catalog))
+        producers = [op for op in pp.walk()
+                     if isinstance(op, MyriaShuffleProducer)]
+        self.assertEquals(len(producers), 2)
+        for op in producers:
+            if isinstance(op.input, MyriaDupElim):
+                self.assertEquals(op.input.input.relation_key, self.x_key)
+            else:
+                self.assertEquals(op.input.relation_key, self.y_key)
+
+        self.db.evaluate(pp)
+        result = self.db.get_table('OUTPUT')
+        self.db.evaluate(optimize(lp, MyriaLeftDeepTreeAlgebra(catalog),
+                                  no_DistinctBeforeShuffle=True))
+        self.assertEquals(result, self.db.get_table('OUTPUT'))
+
+    def test_distinct_local_pass_by_duplicates(self):
+        """Distinct is evaluated locally before the shuffle only if the
+        input has enough duplicates."""
+        query = """
+        x = scan({x});
+        out = distinct(x);
+        store(out, OUTPUT);
+        """.format(x=self.x_key)
+
+        lp = self.get_logical_plan(query)
+        for distinct, dupelims in [(30, 1), (5, 2)]:
+            catalog = FakeCatalog(
+                4, child_distinct_tuples={'X': distinct})
+            pp = optimize(copy.deepcopy(lp),
+                          MyriaLeftDeepTreeAlgebra(catalog))
+            self.assertEquals(self.get_count(pp, MyriaDupElim), dupelims)
+            self.assertEquals(self.get_count(pp, MyriaShuffleProducer), 1)
@@ -0,0 +1,169 @@
+"""Cache of compiled MyriaL programs.
+
+Compiling a MyriaL program runs the parser, the statement processor, the
+control flow graph optimizations, the rule-based optimizer and the JSON
+compiler. Programs that are compiled over and over (e.g., dashboards) can
+reuse the result of a previous compilation as long as the program, the
+target algebra, the compiler arguments and the catalog metadata of every
+relation the program reads are unchanged.
+"""
+
+from collections import OrderedDict
+import copy
+import cPickle
+import hashlib
+import logging
+import os
+
+from raco.relation_key import RelationKey
+
+LOG = logging.getLogger(__name__)
+
+# compiler arguments that do not affect the compiled plan
+IGNORED_KWARGS = frozenset(['profiler', 'target_alg', 'target'])
+
+
+def _relations(statements):
+    reads, writes = set(), set()
+
+    def descend(node):
+        if isinstance(node, RelationKey):
+            reads.add(node)
+        elif isinstance(node, tuple) and node and node[0] == 'STORE':
+            writes.add(node[2])
+        elif isinstance(node, (tuple, list)):
+            for child in node:
+                descend(child)
+
+    descend(statements)
+    return reads, writes
+
+
+def referenced_relations(statements):
+    """Return the set of relation keys read by a list of statements."""
+    return _relations(statements)[0]
+
+
+def written_relations(statements):
+    """Return the set of relation keys stored to by a list of statements."""
+    return _relations(statements)[1]
+
+
+def _scheme(catalog, rel_key):
+    try:
+        return catalog.get_scheme(rel_key)
+    except Exception:
+        return None
+
+
+class PlanCache(object):
+    """An LRU cache of compiled plans with an optional on-disk store.
+
+    Entries are keyed by PlanCache.key, which covers the normalized statement
+    list, the configuration of the target algebra (see Algebra.cache_key),
+    the compiler arguments, the catalog fingerprint of every relation the
+    program reads and the scheme of every relation it stores to. A change to
+    the scheme, cardinality or partitioning of an input therefore results in
+    a cache miss, while the statistics of the outputs, which the program
+    itself changes, do not.
+    """
+
+    def __init__(self, max_entries=128, directory=None):
+        """
+        :param max_entries: number of plans kept in memory
+        :param directory: if not None, plans are also pickled to this
+        directory so that they survive the process
+        """
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(kind, statements, catalog, target_alg=None, **kwargs):
+        """Return the cache key of a compilation.
+
+        :param kind: what is being cached, e.g. 'physical' or 'json'
+        :param statements: the statement list produced by the parser
+        :param catalog: the catalog the statements are compiled against
+        :param target_alg: the target algebra, or None for the default
+        :param kwargs: the remaining compiler arguments
+        :return: the key, or None if the compilation must not be cached
+        because the target algebra cannot describe its configuration
+        """
+        rel_keys, write_keys = _relations(statements)
+        alg = ''
+        if target_alg is not None:
+            alg = target_alg.cache_key(rel_keys)
+            if alg is None:
+                return None
+        args = sorted((k, repr(v)) for k, v in kwargs.items()
+                      if k not in IGNORED_KWARGS)
+        fingerprint = catalog.fingerprint(rel_keys)
+        outputs = repr([(str(k), _scheme(catalog, k))
+                        for k in sorted(write_keys - rel_keys, key=str)])
+        h = hashlib.sha1()
+        for part in (kind, repr(statements), alg, repr(args), fingerprint,
+                     outputs):
+            h.update(part)
+            h.update('\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        """Return a copy of the cached value for key, or None."""
+        if key in self.entries:
+            value = self.entries.pop(key)
+            self.entries[key] = value
+        elif self.directory is not None and os.path.exists(self._path(key)):
+            try:
+                with open(self._path(key), 'rb') as f:
+                    value = cPickle.load(f)
+            except Exception as e:
+                LOG.warning("ignoring unreadable plan cache entry %s: %s",
+                            key, e)
+                self.misses += 1
+                return None
+            self._put_memory(key, value)
+        else:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        """Store a copy of value under key."""
+        value = copy.deepcopy(value)
+        self._put_memory(key, value)
+        if self.directory is not None:
+            try:
+                with open(self._path(key), 'wb') as f:
+                    cPickle.dump(value, f, cPickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                LOG.warning("unable to store plan cache entry %s: %s", key, e)
+                if os.path.exists(self._path(key)):
+                    os.remove(self._path(key))
+
+    def _put_memory(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drop every cached plan, in memory and on disk."""
+        self.entries.clear()
+        if self.directory is not None:
+            for fname in os.listdir(self.directory):
+                if fname.endswith('.pickle'):
+                    os.remove(os.path.join(self.directory, fname))
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,171 @@
+"""Tests for the compiled plan cache."""
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+from raco import types
+from raco.backends.logical import OptLogicalAlgebra
+from raco.backends.myria import (MyriaHyperCubeAlgebra,
+                                 MyriaLeftDeepTreeAlgebra)
+from raco.catalog import FakeCatalog
+from raco.fakedb import FakeDatabase
+from raco.myrial.interpreter import StatementProcessor
+from raco.myrial.parser import Parser
+from raco.myrial.plan_cache import (PlanCache, referenced_relations,
+                                    written_relations)
+from raco.relation_key import RelationKey
+from raco.scheme import Scheme
+
+
+class PlanCacheTest(unittest.TestCase):
+
+    query = """
+    X = scan(public:adhoc:X);
+    Y = [from X where a > 3 emit a, b];
+    store(Y, OUTPUT);"""
+
+    x_key = RelationKey.from_string("public:adhoc:X")
+    x_scheme = Scheme([("a", types.LONG_TYPE), ("b", types.LONG_TYPE)])
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.db.ingest(self.x_key, collections.Counter([(1, 2), (4, 5)]),
+                       self.x_scheme)
+        self.parser = Parser()
+        self.cache = PlanCache()
+
+    def compile(self, query=None, cache=None, **kwargs):
+        if cache is None:
+            cache = self.cache
+        processor = StatementProcessor(self.db, plan_cache=cache)
+        processor.evaluate(self.parser.parse(query or self.query))
+        return processor, processor.get_json(**kwargs)
+
+    def test_referenced_relations(self):
+        statements = self.parser.parse(self.query)
+        self.assertEquals(referenced_relations(statements), {self.x_key})
+        self.assertEquals(written_relations(statements),
+                          {RelationKey("OUTPUT")})
+
+    def test_repeat_compile_hits(self):
+        _, json1 = self.compile()
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 1))
+
+        processor, json2 = self.compile()
+        self.assertEquals(self.cache.hits, 1)
+        self.assertEquals(json1, json2)
+        # a cache hit does not evaluate the statements
+        self.assertEquals(len(processor.pending_statements), 3)
+        self.assertEquals(len(processor.cfg.graph), 0)
+
+    def test_physical_plan_hits(self):
+        processor = StatementProcessor(self.db, plan_cache=self.cache)
+        processor.evaluate(self.parser.parse(self.query))
+        pp1 = processor.get_physical_plan()
+        pp2 = processor.get_physical_plan()
+        self.assertEquals(self.cache.hits, 1)
+        self.assertEquals(str(pp1), str(pp2))
+        self.assertIsNot(pp1, pp2)
+
+    def test_different_program_misses(self):
+        self.compile()
+        self.compile(self.query.replace('a > 3', 'a > 4'))
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_kwargs_miss(self):
+        self.compile()
+        self.compile(add_splits=False)
+        self.compile(target_alg=MyriaHyperCubeAlgebra(FakeCatalog(2)))
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 3))
+
+    def test_algebra_configuration_misses(self):
+        # the cost-based join rules only run when the algebra has a catalog
+        self.compile(target_alg=MyriaLeftDeepTreeAlgebra())
+        self.compile(target_alg=MyriaLeftDeepTreeAlgebra(self.db))
+        self.compile(target_alg=MyriaHyperCubeAlgebra(FakeCatalog(2)))
+        self.compile(target_alg=MyriaHyperCubeAlgebra(FakeCatalog(64)))
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 4))
+        self.compile(target_alg=MyriaHyperCubeAlgebra(FakeCatalog(64)))
+        self.assertEquals(self.cache.hits, 1)
+
+        # algebras that cannot describe their configuration are not cached
+        processor = StatementProcessor(self.db, plan_cache=self.cache)
+        processor.evaluate(self.parser.parse(self.query))
+        processor.get_physical_plan(target_alg=OptLogicalAlgebra())
+        processor.get_physical_plan(target_alg=OptLogicalAlgebra())
+        self.assertEquals((self.cache.hits, len(self.cache)), (1, 4))
+
+    def test_catalog_change_misses(self):
+        self.compile()
+        self.db.ingest(self.x_key, collections.Counter([(1, 2)]),
+                       self.x_scheme)
+        self.compile()
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 2))
+
+        # changes to unreferenced relations do not matter
+        self.db.ingest("public:adhoc:Z", collections.Counter([(1,)]),
+                       Scheme([("z", types.LONG_TYPE)]))
+        self.compile()
+        self.assertEquals(self.cache.hits, 1)
+
+        # creating the output relation misses, but later runs of the program
+        # that only change its contents hit
+        self.db.ingest("public:adhoc:OUTPUT", collections.Counter([(4, 5)]),
+                       self.x_scheme)
+        self.compile()
+        self.db.ingest("public:adhoc:OUTPUT",
+                       collections.Counter([(4, 5), (6, 7)]), self.x_scheme)
+        self.compile()
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 3))
+
+        # a change to the scheme of the output misses
+        self.db.ingest("public:adhoc:OUTPUT", collections.Counter([(1,)]),
+                       Scheme([("z", types.LONG_TYPE)]))
+        self.compile()
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 4))
+
+    def test_lru_eviction(self):
+        cache = PlanCache(max_entries=1)
+        self.compile(cache=cache)
+        self.compile(self.query.replace('a > 3', 'a > 4'), cache=cache)
+        self.compile(cache=cache)
+        self.assertEquals((cache.hits, cache.misses), (0, 3))
+        self.assertEquals(len(cache), 1)
+
+    def test_disk_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            _, json1 = self.compile(cache=PlanCache(directory=directory))
+
+            cache = PlanCache(directory=directory)
+            _, json2 = self.compile(cache=cache)
+            self.assertEquals(cache.hits, 1)
+            self.assertEquals(json1, json2)
+
+            cache.invalidate()
+            self.compile(cache=cache)
+            self.assertEquals(cache.misses, 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_disk_store_physical_plan(self):
+        directory = tempfile.mkdtemp()
+        try:
+            processor = StatementProcessor(
+                self.db, plan_cache=PlanCache(directory=directory))
+            processor.evaluate(self.parser.parse(self.query))
+            pp1 = processor.get_physical_plan()
+            self.assertEquals(len(os.listdir(directory)), 1)
+
+            cache = PlanCache(directory=directory)
+            processor = StatementProcessor(self.db, plan_cache=cache)
+            processor.evaluate(self.parser.parse(self.query))
+            pp2 = processor.get_physical_plan()
+            self.assertEquals((cache.hits, cache.misses), (1, 0))
+            self.assertEquals(pp1, pp2)
+            self.assertEquals(pp1.scheme(), pp2.scheme())
+        finally:
+            shutil.rmtree(directory)
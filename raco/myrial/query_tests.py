@@ -2775,11 +2775,28 @@ class TestQueryFunctions(myrial_test.MyrialTestCase, FakeData):
         store(T2, OUTPUT2);
         """.format(rel=self.emp_key)
 
-        physical_plan = self.get_physical_plan(query)
+        physical_plan = self.get_physical_plan(query, parallel=False)
         self.assertIsInstance(physical_plan, raco.algebra.Sequence)
         self.check_result(query, self.emp_table, output='OUTPUT')
         self.check_result(query, self.emp_table, output='OUTPUT2')
 
+    def test_parallel(self):
+        query = """
+        T1 = scan({rel});
+        store(T1, OUTPUT);
+        T2 = [from scan({rel}) as E emit E.id];
+        store(T2, OUTPUT2);
+        """.format(rel=self.emp_key)
+
+        # the two independent stores run in parallel
+        physical_plan = self.get_physical_plan(query)
+        self.assertIsInstance(physical_plan, raco.algebra.Parallel)
+        self.assertEquals(len(physical_plan.args), 2)
+        self.check_result(query, self.emp_table, output='OUTPUT')
+        self.check_result(
+            query, collections.Counter([(e[0],) for e in self.emp_table]),
+            output='OUTPUT2')
+
     def test_238_dont_renumber_columns(self):
         # see https://github.com/uwescience/raco/issues/238
         query = """
@@ -1,4 +1,6 @@
 from nose.plugins.skip import SkipTest
+from functools import reduce
+from operator import mul
 import unittest
 import algebra
 from raco import RACompiler
@@ -159,3 +161,114 @@ class testNaryJoin(unittest.TestCase):
         # note: there is more than one optimal [4,4,4,4] or [1,16,1,16] etc.
         self.assertEqual(get_work_load(rect_join, [4, 4, 4, 4]),
                          get_work_load(rect_join, get_dim_size(rect_join)))
+
+    @staticmethod
+    def chain_conditions(r_index):
+        """Build join conditions from a reversed index"""
+        conditions = [[] for _ in range(max(max(r) for r in r_index) + 1)]
+        for child_idx, dims in enumerate(r_index):
+            for column, dim in enumerate(dims):
+                if dim != -1:
+                    conditions[dim].append((child_idx, column))
+        return conditions
+
+    def test_dim_size_matches_exhaustive_search(self):
+        HSClass = myrialang.HCShuffleBeforeNaryJoin
+
+        def assignments(num_server, num_dims):
+            if num_dims == 0:
+                yield ()
+                return
+            for d in range(1, num_server + 1):
+                for rest in assignments(num_server // d, num_dims - 1):
+                    yield (d,) + rest
+
+        def exhaustive(num_server, child_sizes, r_index, num_dims):
+            return min(HSClass.workload(d, child_sizes, r_index)
+                       for d in assignments(num_server, num_dims))
+
+        cases = [
+            # triangle
+            ([[0, 1], [1, 2], [2, 0]], [100, 100, 100], 64),
+            ([[0, 1], [1, 2], [2, 0]], [1, 100, 20], 64),
+            # chain
+            ([[0], [0, 1], [1]], [1000, 10, 1000], 30),
+            # star
+            ([[0, -1], [0, -1], [0, -1]], [5, 50, 500], 16),
+            # rectangle
+            ([[0, 1], [1, 2], [2, 3], [3, 0]], [10, 10, 10, 10], 100),
+        ]
+        for r_index, child_sizes, num_server in cases:
+            conditions = self.chain_conditions(r_index)
+            dim_sizes, workload = HSClass.get_hyper_cube_dim_size(
+                num_server, child_sizes, conditions, r_index)
+            self.assertLessEqual(reduce(mul, dim_sizes, 1), num_server)
+            self.assertEqual(
+                workload, HSClass.workload(dim_sizes, child_sizes, r_index))
+            self.assertAlmostEqual(
+                workload, exhaustive(num_server, child_sizes, r_index,
+                                     len(conditions)))
+
+    def test_dim_size_large_cluster(self):
+        HSClass = myrialang.HCShuffleBeforeNaryJoin
+        # a 6-cycle join over 6 variables on 1000 servers
+        r_index = [[i, (i + 1) % 6] for i in range(6)]
+        conditions = self.chain_conditions(r_index)
+        dim_sizes, workload = HSClass.get_hyper_cube_dim_size(
+            1000, [10 ** 7] * 6, conditions, r_index)
+        self.assertLessEqual(reduce(mul, dim_sizes, 1), 1000)
+        # with fractional shares every dimension would be 1000 ** (1/6), so
+        # each relation would be spread over 10 servers and the workload
+        # would be 6 * 10 ** 6. With integral shares each relation must
+        # still be spread over at least 3 * 3 servers, and the workload be
+        # within 10% of the fractional optimum.
+        for dims in r_index:
+            self.assertGreaterEqual(dim_sizes[dims[0]] * dim_sizes[dims[1]],
+                                    9)
+        self.assertLessEqual(workload, 1.1 * 6 * 10 ** 6)
+
+    def test_cell_partition_arithmetic(self):
+        HSClass = myrialang.HCShuffleBeforeNaryJoin
+        r_index = [[0, 1], [1, 2], [2, 0]]
+        conditions = self.chain_conditions(r_index)
+        schemes = [[None, None]] * 3
+
+        def partition(dim_sizes, child_idx, hashed_columns):
+            return HSClass.get_cell_partition(
+                dim_sizes, conditions, schemes, child_idx, hashed_columns)
+
+        self.assertEqual(partition([1, 2, 2], 0, [0, 1]), [[0, 1], [2, 3]])
+        self.assertEqual(partition([1, 2, 2], 1, [0, 1]),
+                         [[0], [1], [2], [3]])
+        self.assertEqual(partition([1, 2, 2], 2, [1, 0]), [[0, 2], [1, 3]])
+
+        # every cell appears exactly once, in as many voxels as expected
+        cells = partition([4, 5, 6], 1, [0, 1])
+        self.assertEqual(len(cells), 5 * 6)
+        self.assertEqual(sorted(sum(cells, [])), range(4 * 5 * 6))
+        for cell in cells:
+            self.assertEqual(len(cell), 4)
+
+    def test_dim_size_skewed_column(self):
+        HSClass = myrialang.HCShuffleBeforeNaryJoin
+        # triangle, half of R and S share the same value of y (dimension 1)
+        r_index = [[0, 1], [1, 2], [2, 0]]
+        conditions = self.chain_conditions(r_index)
+        child_sizes = [1000] * 3
+        child_skews = [{1: 500}, {0: 500}, {}]
+
+        uniform, _ = HSClass.get_hyper_cube_dim_size(
+            64, child_sizes, conditions, r_index)
+        dim_sizes, workload = HSClass.get_hyper_cube_dim_size(
+            64, child_sizes, conditions, r_index, child_skews)
+        self.assertEqual(uniform, (4, 4, 4))
+        # hashing on the skewed dimension barely helps, so it gets less
+        self.assertLess(dim_sizes[1], 4)
+        self.assertLess(workload, HSClass.workload(
+            uniform, child_sizes, r_index, child_skews))
+
+        best = min(HSClass.workload((x, y, z), child_sizes, r_index,
+                                    child_skews)
+                   for x in range(1, 65) for y in range(1, 65 // x + 1)
+                   for z in range(1, 65 // (x * y) + 1))
+        self.assertAlmostEqual(workload, best)
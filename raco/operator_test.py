@@ -1,11 +1,16 @@
+import copy
+import cPickle
+import sys
 import unittest
 
 import raco.fakedb
+from raco import serialization
 from raco.relation_key import RelationKey
 from raco.algebra import *
 from raco.expression import *
 import raco.relation_key as relation_key
 from raco.expression import StateVar
+from raco.utility import TrackedList
 
 
 class TestQueryFunctions():
@@ -145,3 +150,156 @@ class OperatorTest(unittest.TestCase):
         pj = ProjectingJoin(condition=BooleanLiteral(True),
                             left=emp, right=emp1, output_columns=refs)
         self.assertEquals(emp.scheme().get_names(), pj.scheme().get_names())
+
+    def test_cached_scheme(self):
+        """Derived properties are cached until an operator is modified"""
+        emp = Scan(TestQueryFunctions.emp_key, TestQueryFunctions.emp_schema)
+        proj = Apply([('id', UnnamedAttributeRef(0))], emp)
+        self.assertIs(proj.scheme(), proj.scheme())
+
+        proj.emitters = [('name', UnnamedAttributeRef(2))]
+        self.assertEquals(proj.scheme().get_names(), ['name'])
+
+        # modifying a descendant invalidates the cache of the ancestors
+        select = Select(EQ(UnnamedAttributeRef(0), NumericLiteral(1)), proj)
+        self.assertEquals(select.scheme().get_types(), ['STRING_TYPE'])
+        proj.emitters[0][1].position = 3
+        self.assertEquals(select.scheme().get_types(), ['LONG_TYPE'])
+
+        # and so does changing a list in place
+        proj.emitters.append(('id', UnnamedAttributeRef(0)))
+        self.assertEquals(select.scheme().get_names(), ['name', 'id'])
+        proj.emitters[1] = ('salary', UnnamedAttributeRef(3))
+        self.assertEquals(select.scheme().get_names(), ['name', 'salary'])
+        del proj.emitters[0]
+        self.assertEquals(select.scheme().get_names(), ['salary'])
+
+        union = UnionAll([proj])
+        self.assertEquals(len(union.scheme()), 1)
+        union.args[0] = emp
+        self.assertEquals(len(union.scheme()), 4)
+
+        # lists are tracked after copies and round trips as well
+        for other in (copy.deepcopy(union),
+                      cPickle.loads(cPickle.dumps(union, 2)),
+                      serialization.loads(serialization.dumps(union, True))):
+            self.assertIsInstance(other.args, TrackedList)
+            self.assertEquals(len(other.scheme()), 4)
+            other.args[0] = proj
+            self.assertEquals(len(other.scheme()), 1)
+
+    def test_verify_cached_scheme(self):
+        """Checking cached values recomputes each value once, and finds
+        stale values"""
+        verify = PropertyCache.verify
+        PropertyCache.verify = True
+        try:
+            emp = Scan(TestQueryFunctions.emp_key,
+                       TestQueryFunctions.emp_schema)
+            op = emp
+            for _ in range(100):
+                op = UnionAll([op, emp])
+                self.assertEquals(op.scheme(), emp.scheme())
+
+            proj = Apply([('id', UnnamedAttributeRef(0))], emp)
+            proj.scheme()
+            # modify the list behind the cache's back
+            list.append(proj.emitters, ('name', UnnamedAttributeRef(2)))
+            self.assertRaises(AssertionError, proj.scheme)
+        finally:
+            PropertyCache.verify = verify
+            PropertyCache.invalidate()
+
+    def test_structural_equality(self):
+        """Operators compare and hash by structure, and cached hashes follow
+        modifications"""
+        emp = Scan(TestQueryFunctions.emp_key, TestQueryFunctions.emp_schema)
+        cond = EQ(UnnamedAttributeRef(0), NumericLiteral(1))
+        seq = Sequence([StoreTemp('A', Select(cond, emp)),
+                        StoreTemp('B', emp)])
+        other = copy.deepcopy(seq)
+        self.assertEqual(seq, other)
+        self.assertEqual(hash(seq), hash(other))
+
+        other.args[0].input.condition.right.value = 2
+        self.assertNotEqual(seq, other)
+        self.assertNotEqual(Sequence(seq.args[:1]), seq)
+
+        other.args[0].input.condition.right.value = 1
+        self.assertEqual(seq, other)
+        self.assertEqual(hash(seq.args[0].input.condition),
+                         hash(copy.deepcopy(cond)))
+
+    def test_copy_and_pickle(self):
+        """Operators and expressions with slots keep all of their fields"""
+        emp = Scan(TestQueryFunctions.emp_key, TestQueryFunctions.emp_schema)
+        sel = Select(EQ(UnnamedAttributeRef(0, 'id'), NumericLiteral(1)), emp)
+        sel.has_been_pushed = True
+        # cached values are not copied or pickled
+        hash(sel)
+        sel.scheme()
+        for other in [copy.deepcopy(sel),
+                      cPickle.loads(cPickle.dumps(
+                          sel, cPickle.HIGHEST_PROTOCOL))]:
+            self.assertEqual(other, sel)
+            self.assertTrue(other.has_been_pushed)
+            self.assertEqual(other.condition.left.debug_info, 'id')
+            self.assertEqual(other.scheme(), sel.scheme())
+            self.assertEqual(other.scheme().getPosition('salary'), 3)
+
+    def test_deep_plan(self):
+        """Traversals of very deep plans do not exhaust the stack"""
+        emp = Scan(TestQueryFunctions.emp_key, TestQueryFunctions.emp_schema)
+        depth = 3 * sys.getrecursionlimit()
+        op = emp
+        for _ in range(depth):
+            op = UnionAll([op, emp])
+        plan = Store(RelationKey('OUTPUT'), op)
+
+        self.assertEqual(len(list(plan.walk())), 2 * depth + 2)
+        self.assertEqual(len(list(plan.postorder(lambda o: [o]))),
+                         2 * depth + 2)
+        self.assertEqual(len(str(plan).split('[')), depth + 2)
+        self.assertEqual(plan.scheme(), emp.scheme())
+        self.assertIsInstance(hash(plan), int)
+
+        # transform applies pre and post in the same order as a recursion
+        seen = []
+        renamed = transform(plan, pre=lambda o: seen.append(('pre', o)) or o,
+                            post=lambda o: seen.append(('post', o)) or o)
+        self.assertIs(renamed, plan)
+        self.assertEqual(len(seen), 2 * (2 * depth + 2))
+        self.assertEqual(seen[:3], [('pre', plan), ('pre', op),
+                                    ('pre', op.args[0])])
+        self.assertEqual(seen[-2:], [('post', op), ('post', plan)])
+
+    def test_shared_rewrite(self):
+        """A rule that modifies a shared subplan gets a private copy of it,
+        and equal subplans are merged"""
+        emp = Scan(TestQueryFunctions.emp_key, TestQueryFunctions.emp_schema)
+        cond = EQ(UnnamedAttributeRef(0), NumericLiteral(1))
+        sel = Select(cond, emp)
+        outer = Select(GT(UnnamedAttributeRef(3), NumericLiteral(0)), sel)
+        plan = UnionAll([outer, sel])
+
+        def merge_selects(op):
+            if isinstance(op, Select) and isinstance(op.input, Select):
+                op.input.condition = AND(op.input.condition, op.condition)
+                return op.input
+            return op
+
+        result, copies = rewrite_shared(plan, merge_selects)
+        self.assertIs(result, plan)
+        self.assertEqual(copies, 1)
+        self.assertIs(plan.args[1], sel)
+        self.assertIs(sel.condition, cond)
+        self.assertIsInstance(plan.args[0], Select)
+        self.assertIsInstance(plan.args[0].condition, AND)
+        self.assertIs(plan.args[0].input, emp)
+
+        twin = Select(copy.deepcopy(cond),
+                      Scan(TestQueryFunctions.emp_key,
+                           TestQueryFunctions.emp_schema))
+        plan = intern(UnionAll([sel, twin]))
+        self.assertIs(plan.args[0], sel)
+        self.assertIs(plan.args[1], sel)
@@ -388,7 +388,7 @@ class Pipelined(object):
         if not hasattr(self, 'assigned_attrs'):
             object.__setattr__(self, 'assigned_attrs', set())
         self.assigned_attrs.add(key)
-        object.__setattr__(self, key, value)
+        super(Pipelined, self).__setattr__(key, value)
 
     def _freeze(self):
         self.__isfrozen = True
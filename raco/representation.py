@@ -7,42 +7,93 @@ class RepresentationProperties(object):
             hash_partitioned=frozenset(),
             sorted=None,
             grouped=None,
-            broadcasted=False):
+            broadcasted=False,
+            equivalent_hashes=frozenset()):
         """
         @param hash_partitioned: None or set of AttributeRefs in hash key
-        @param sorted: None or list of (AttributeRefs, ASC/DESC) in sort order
-        @param grouped: None or list of AttributeRefs to group by
+        @param sorted: None or list of (AttributeRef, ascending) in the sort
+        order of the tuples on each worker
+        @param grouped: None or set of AttributeRefs such that the tuples
+        with equal values of them are contiguous on each worker
+        @param equivalent_hashes: set of other hash keys, each a set of
+        AttributeRefs, that the tuples are partitioned by as well
 
         None means that no knowledge about the interesting property is
         known
         """
 
-        # TODO: make it a set of sets, representing a conjunction of hashes
-        # TODO: for example, after a HashJoin($1=$4) we know h($1) && h($4)
-        # TODO:     which is not equivalent to h($1, $4). Currently can only
-        # TODO:     represent conjunctions of size 1
+        # A conjunction of hash partitionings: hash_partitioned is the key
+        # reported to the backend, equivalent_hashes are the other keys that
+        # hold. For example, after a HashJoin($1=$4) we know h($1) && h($4)
+        # which is not equivalent to h($1, $4).
         self.hash_partitioned = hash_partitioned
+        if hash_partitioned:
+            self.equivalent_hashes = frozenset(
+                frozenset(h) for h in equivalent_hashes
+                if h and frozenset(h) != frozenset(hash_partitioned))
+        else:
+            self.equivalent_hashes = frozenset()
+        self.sorted = tuple(sorted) if sorted else None
+        self.grouped = frozenset(grouped) if grouped else None
         self.broadcasted = broadcasted
 
         assert not (len(self.hash_partitioned) > 0 and self.broadcasted), \
             "inconsistent state: cannot be partitioned and broadcasted"
 
-        if sorted is not None or grouped is not None:
-            raise NotImplementedError("sorted and grouped not yet supported")
+    def hash_partitionings(self):
+        """Return the set of all hash keys the tuples are partitioned by"""
+        if not self.hash_partitioned:
+            return frozenset()
+        return self.equivalent_hashes | {frozenset(self.hash_partitioned)}
+
+    def is_hash_partitioned(self, columns):
+        """Is the relation hash partitioned by exactly these columns?"""
+        return frozenset(columns) in self.hash_partitionings()
+
+    def is_sorted(self, sort_order):
+        """Is the relation sorted by the given list of (AttributeRef,
+        ascending) on each worker? A longer sort order satisfies any of its
+        prefixes."""
+        sort_order = tuple(sort_order)
+        if self.sorted is None or not sort_order:
+            return False
+        return self.sorted[:len(sort_order)] == sort_order
+
+    def is_grouped(self, columns):
+        """Are tuples with equal values of the columns contiguous on each
+        worker?"""
+        columns = frozenset(columns)
+        if not columns:
+            return False
+        if self.grouped == columns:
+            return True
+        if self.sorted is not None:
+            for i in range(len(self.sorted)):
+                if frozenset(c for c, _ in self.sorted[:i + 1]) == columns:
+                    return True
+        return False
 
     def __str__(self):
-        return "{clazz}(hash: {hash_attrs}, broadcasted: {b})".format(
-            clazz=self.__class__.__name__,
-            hash_attrs=self.hash_partitioned,
-            b=self.broadcasted)
+        attrs = ["hash: {hash_attrs}".format(hash_attrs=self.hash_partitioned)]
+        if self.equivalent_hashes:
+            attrs.append("also hash: {eq}".format(
+                eq=sorted(self.equivalent_hashes)))
+        if self.sorted is not None:
+            attrs.append("sorted: {s}".format(s=self.sorted))
+        if self.grouped is not None:
+            attrs.append("grouped: {g}".format(g=self.grouped))
+        attrs.append("broadcasted: {b}".format(b=self.broadcasted))
+        return "{clazz}({attrs})".format(clazz=self.__class__.__name__,
+                                         attrs=", ".join(attrs))
 
     def __repr__(self):
-        return "{clazz}({hp!r}, {sort!r}, {grp!r}, {br!r})".format(
+        return "{clazz}({hp!r}, {sort!r}, {grp!r}, {br!r}, {eq!r})".format(
             clazz=self.__class__.__name__,
             hp=self.hash_partitioned,
-            sort=None,
-            grp=None,
-            br=self.broadcasted
+            sort=self.sorted,
+            grp=self.grouped,
+            br=self.broadcasted,
+            eq=self.equivalent_hashes
         )
 
     def __eq__(self, other):
@@ -1,6 +1,7 @@
+import copy
 import re
 
-from raco import algebra, expression
+from raco import algebra, expression, scheme
 from raco.representation import RepresentationProperties
 from .expression import (accessed_columns, UnnamedAttributeRef,
                          rebase_local_aggregate_output, rebase_finalizer,
@@ -20,6 +21,11 @@ class Rule(object):
 
     _flag_pattern = re.compile(r'no_([A-Za-z_]+)')  # e.g., no_MergeSelects
 
+    # Rules fire on an operator before its children by default. Rules that
+    # depend on the physical properties of their inputs fire on the children
+    # first, so that the properties reflect the exchanges placed below.
+    bottom_up = False
+
     def __init__(self):
         self._disabled = False
 
@@ -409,7 +415,7 @@ class PushSelects(Rule):
 
     @staticmethod
     def descend_tree(op, cond):
-        """Recursively push a selection condition down a tree of operators.
+        """Push a selection condition down a tree of operators.
 
         :param op: The root of an operator tree
         :type op: raco.algebra.Operator
@@ -419,69 +425,84 @@ class PushSelects(Rule):
         :return: A (possibly modified) operator.
         """
 
-        if isinstance(op, algebra.Select):
-            # Keep pushing; selects are commutative
-            op.input = PushSelects.descend_tree(op.input, cond)
-            return op
-        elif isinstance(op, algebra.CompositeBinaryOperator):
-            # Joins and cross-products; consider conversion to an equijoin
-            # Expressions containing random do not commute across joins
-            has_random = any(isinstance(e, RANDOM) for e in cond.walk())
-            if not has_random:
-                left_len = len(op.left.scheme())
-                accessed = accessed_columns(cond)
-                in_left = [col < left_len for col in accessed]
-                if all(in_left):
-                    # Push the select into the left sub-tree.
-                    op.left = PushSelects.descend_tree(op.left, cond)
-                    return op
-                elif not any(in_left):
-                    # Push into right subtree; rebase column indexes
-                    expression.rebase_expr(cond, left_len)
-                    op.right = PushSelects.descend_tree(op.right, cond)
-                    return op
-                else:
-                    # Selection includes both children; attempt to create an
-                    # equijoin condition
-                    cols = PushSelects.is_column_equality_comparison(cond)
-                    if cols:
-                        return op.add_equijoin_condition(cols[0], cols[1])
-        elif isinstance(op, algebra.Apply):
-            # Convert accessed to a list from a set to ensure consistent order
-            accessed = list(accessed_columns(cond))
-            accessed_emits = [op.emitters[i][1] for i in accessed]
-            if all(isinstance(e, expression.AttributeRef)
-                   for e in accessed_emits):
-                unnamed_emits = expression.ensure_unnamed(
-                    accessed_emits, op.input)
-                # This condition only touches columns that are copied verbatim
-                # from the child, so we can push it.
-                index_map = {a: e.position
-                             for (a, e) in zip(accessed, unnamed_emits)}
-                expression.reindex_expr(cond, index_map)
-                op.input = PushSelects.descend_tree(op.input, cond)
-                return op
-        elif isinstance(op, algebra.GroupBy):
-            # Convert accessed to a list from a set to ensure consistent order
-            accessed = list(accessed_columns(cond))
-            if all((a < len(op.grouping_list)) for a in accessed):
-                accessed_grps = [op.grouping_list[a] for a in accessed]
-                # This condition only touches columns that are copied verbatim
-                # from the child (grouping keys), so we can push it.
-                assert all(isinstance(e, expression.AttributeRef)
-                           for e in op.grouping_list)
-                unnamed_grps = expression.ensure_unnamed(accessed_grps,
-                                                         op.input)
-                index_map = {a: e.position
-                             for (a, e) in zip(accessed, unnamed_grps)}
-                expression.reindex_expr(cond, index_map)
-                op.input = PushSelects.descend_tree(op.input, cond)
-                return op
+        # Walk down with a loop rather than recursion, for deep plans. The
+        # condition ends up below parent.attr, or replaces the root.
+        root = op
+        parent, attr = None, None
+        while True:
+            child_attr = None
+            new_op = None
+            if isinstance(op, algebra.Select):
+                # Keep pushing; selects are commutative
+                child_attr = 'input'
+            elif isinstance(op, algebra.CompositeBinaryOperator):
+                # Joins and cross-products; consider conversion to an equijoin
+                # Expressions containing random do not commute across joins
+                has_random = any(isinstance(e, RANDOM) for e in cond.walk())
+                if not has_random:
+                    left_len = len(op.left.scheme())
+                    accessed = accessed_columns(cond)
+                    in_left = [col < left_len for col in accessed]
+                    if all(in_left):
+                        # Push the select into the left sub-tree.
+                        child_attr = 'left'
+                    elif not any(in_left):
+                        # Push into right subtree; rebase column indexes
+                        expression.rebase_expr(cond, left_len)
+                        child_attr = 'right'
+                    else:
+                        # Selection includes both children; attempt to
+                        # create an equijoin condition
+                        cols = PushSelects.is_column_equality_comparison(cond)
+                        if cols:
+                            new_op = op.add_equijoin_condition(cols[0],
+                                                               cols[1])
+            elif isinstance(op, algebra.Apply):
+                # Convert accessed to a list from a set to ensure consistent
+                # order
+                accessed = list(accessed_columns(cond))
+                accessed_emits = [op.emitters[i][1] for i in accessed]
+                if all(isinstance(e, expression.AttributeRef)
+                       for e in accessed_emits):
+                    unnamed_emits = expression.ensure_unnamed(
+                        accessed_emits, op.input)
+                    # This condition only touches columns that are copied
+                    # verbatim from the child, so we can push it.
+                    index_map = {a: e.position
+                                 for (a, e) in zip(accessed, unnamed_emits)}
+                    expression.reindex_expr(cond, index_map)
+                    child_attr = 'input'
+            elif isinstance(op, algebra.GroupBy):
+                # Convert accessed to a list from a set to ensure consistent
+                # order
+                accessed = list(accessed_columns(cond))
+                if all((a < len(op.grouping_list)) for a in accessed):
+                    accessed_grps = [op.grouping_list[a] for a in accessed]
+                    # This condition only touches columns that are copied
+                    # verbatim from the child (grouping keys), so we can push
+                    # it.
+                    assert all(isinstance(e, expression.AttributeRef)
+                               for e in op.grouping_list)
+                    unnamed_grps = expression.ensure_unnamed(accessed_grps,
+                                                             op.input)
+                    index_map = {a: e.position
+                                 for (a, e) in zip(accessed, unnamed_grps)}
+                    expression.reindex_expr(cond, index_map)
+                    child_attr = 'input'
+
+            if child_attr is not None:
+                parent, attr = op, child_attr
+                op = getattr(op, child_attr)
+                continue
 
-        # Can't push any more: instantiate the selection
-        new_op = algebra.Select(cond, op)
-        new_op.has_been_pushed = True
-        return new_op
+            if new_op is None:
+                # Can't push any more: instantiate the selection
+                new_op = algebra.Select(cond, op)
+                new_op.has_been_pushed = True
+            if parent is None:
+                return new_op
+            setattr(parent, attr, new_op)
+            return root
 
     def fire(self, op):
         if not isinstance(op, algebra.Select):
@@ -492,10 +513,18 @@ class PushSelects(Rule):
         else:
             op.has_been_pushed = False
 
-        new_op = PushSelects.descend_tree(op.input, op.condition)
+        while True:
+            new_op = PushSelects.descend_tree(op.input, op.condition)
 
-        # The new root may also be a select, so fire the rule recursively
-        return self.fire(new_op)
+            # The new root may also be a select, so fire the rule again
+            op = new_op
+            if not isinstance(op, algebra.Select):
+                return op
+            if hasattr(op, "has_been_pushed"):
+                if op.has_been_pushed:
+                    return op
+            else:
+                op.has_been_pushed = False
 
     def __str__(self):
         return ("Select, Cross/Join => Join;"
@@ -521,6 +550,145 @@ class MergeSelects(Rule):
         return "Select, Select => Select"
 
 
+class InferJoinPredicates(Rule):
+
+    """Propagate predicates that compare a column with a literal across
+    equi-join conditions.
+
+    With a.x = b.y and a.x = 5, b.y = 5 holds as well; so do range
+    predicates such as a.x > 5. Predicates are collected from the Selects
+    below each side of a join, following the equalities of the joins below,
+    and the missing ones are added to the other side. They are placed as
+    far down as possible, i.e., above the operators that the columns cannot
+    be traced through, so that the inputs are filtered before they are
+    shuffled. Must run after PushSelects, which turns selections into join
+    conditions.
+    """
+
+    comparisons = {
+        expression.EQ: expression.EQ,
+        expression.NEQ: expression.NEQ,
+        expression.LT: expression.GT,
+        expression.LTEQ: expression.GTEQ,
+        expression.GT: expression.LT,
+        expression.GTEQ: expression.LTEQ,
+    }
+
+    @staticmethod
+    def column_predicate(conjunc, scheme):
+        """Return (column, comparison, literal) if the conjunct compares a
+        column with a literal, or None."""
+        cls = type(conjunc)
+        if cls not in InferJoinPredicates.comparisons:
+            return None
+        left, right = conjunc.left, conjunc.right
+        if (isinstance(left, expression.Literal) and
+                isinstance(right, expression.AttributeRef)):
+            left, right = right, left
+            cls = InferJoinPredicates.comparisons[cls]
+        if (isinstance(left, expression.AttributeRef) and
+                isinstance(right, expression.Literal)):
+            return left.get_position(scheme), cls, right
+        return None
+
+    @staticmethod
+    def trace(op, col):
+        """Return the (child, column) pairs holding the values of column col
+        of a join op: the column itself and the columns of the other input
+        that the join condition equates it with."""
+        combined = op.left.scheme() + op.right.scheme()
+        if getattr(op, 'output_columns', None) is not None:
+            col = op.output_columns[col].get_position(combined)
+        left_len = len(op.left.scheme())
+        pairs = []
+        if isinstance(op, algebra.Join):
+            pairs = op.equijoin_pairs()
+        equated = set([col])
+        equated.update(r for l, r in pairs if l == col)
+        equated.update(l for l, r in pairs if r == col)
+        return [(op.left, c) if c < left_len else (op.right, c - left_len)
+                for c in sorted(equated)]
+
+    def predicates(self, op, col):
+        """Return the set of (comparison, literal) known to hold for column
+        col of the output of op."""
+        found = set()
+        stack = [(op, col)]
+        while stack:
+            op, col = stack.pop()
+            if isinstance(op, algebra.Select):
+                scheme = op.input.scheme()
+                for conjunc in expression.extract_conjuncs(op.condition):
+                    pred = self.column_predicate(conjunc, scheme)
+                    if pred is not None and pred[0] == col:
+                        found.add(pred[1:])
+                stack.append((op.input, col))
+            elif isinstance(op, algebra.Apply):
+                emitter = op.emitters[col][1]
+                if isinstance(emitter, expression.AttributeRef):
+                    stack.append(
+                        (op.input, emitter.get_position(op.input.scheme())))
+            elif isinstance(op, algebra.CompositeBinaryOperator):
+                stack.extend(self.trace(op, col))
+        return found
+
+    def restrict(self, op, col, preds):
+        """Return op, changed to ensure that the predicates hold for column
+        col of its output."""
+        # A work list of (parent, attribute, column, predicates) rather than
+        # recursion, for deep plans. The operator is read when its item is
+        # taken, after the items above it changed it.
+        root = [op]
+        work = [(None, None, col, preds)]
+        while work:
+            parent, attr, col, preds = work.pop()
+            if not preds:
+                continue
+            op = root[0] if parent is None else getattr(parent, attr)
+            if isinstance(op, algebra.Select):
+                preds = preds - self.predicates(op, col)
+                work.append((op, 'input', col, preds))
+                continue
+            elif isinstance(op, algebra.Apply):
+                emitter = op.emitters[col][1]
+                if isinstance(emitter, expression.AttributeRef):
+                    work.append((op, 'input',
+                                 emitter.get_position(op.input.scheme()),
+                                 preds))
+                    continue
+            elif isinstance(op, algebra.CompositeBinaryOperator):
+                for child, c in reversed(self.trace(op, col)):
+                    attr = 'left' if child is op.left else 'right'
+                    work.append((op, attr, c, preds))
+                continue
+
+            conjuncs = [cls(UnnamedAttributeRef(col), copy.deepcopy(literal))
+                        for cls, literal in sorted(
+                            preds, key=lambda p: (p[0].__name__, repr(p[1])))]
+            new_op = algebra.Select(reduce(expression.AND, conjuncs), op)
+            if parent is None:
+                root[0] = new_op
+            else:
+                setattr(parent, attr, new_op)
+        return root[0]
+
+    def fire(self, op):
+        if not isinstance(op, algebra.Join):
+            return op
+
+        left_len = len(op.left.scheme())
+        for l, r in op.equijoin_pairs():
+            r -= left_len
+            left_preds = self.predicates(op.left, l)
+            right_preds = self.predicates(op.right, r)
+            op.left = self.restrict(op.left, l, right_preds - left_preds)
+            op.right = self.restrict(op.right, r, left_preds - right_preds)
+        return op
+
+    def __str__(self):
+        return "Join(Select(a = 5), B) => Join(Select(a = 5), Select(b = 5))"
+
+
 class PushApply(Rule):
 
     """Many Applies in MyriaL are added to select fewer columns from the
@@ -540,20 +708,23 @@ class PushApply(Rule):
         child = op.input
 
         if isinstance(child, algebra.Apply):
-
-            emits = op.get_unnamed_emit_exprs()
-            child_emits = child.get_unnamed_emit_exprs()
-
-            def convert(n):
-                if isinstance(n, expression.UnnamedAttributeRef):
-                    return child_emits[n.position]
-                n.apply(convert)
-                return n
-            emits = [convert(e) for e in emits]
-
-            new_apply = algebra.Apply(emitters=zip(op.get_names(), emits),
-                                      input=child.input)
-            return self.fire(new_apply)
+            # Merge the whole chain of Applies with a loop rather than
+            # recursion, for long chains
+            while isinstance(child, algebra.Apply):
+                emits = op.get_unnamed_emit_exprs()
+                child_emits = child.get_unnamed_emit_exprs()
+
+                def convert(n):
+                    if isinstance(n, expression.UnnamedAttributeRef):
+                        return child_emits[n.position]
+                    n.apply(convert)
+                    return n
+                emits = [convert(e) for e in emits]
+
+                op = algebra.Apply(emitters=zip(op.get_names(), emits),
+                                   input=child.input)
+                child = op.input
+            return self.fire(op)
 
         elif isinstance(child, algebra.ProjectingJoin):
             emits = op.get_unnamed_emit_exprs()
@@ -821,6 +992,401 @@ class SwapJoinSides(Rule):
         return "Join(L,R) => Join(R,L)"
 
 
+class CommonSubexpressionElimination(Rule):
+
+    """Compute subtrees shared by several statements of a Sequence or
+    Parallel only once.
+
+    Subtrees are compared structurally, ignoring column names and aliases. A
+    subtree that occurs k times is materialized into a temporary relation by
+    a StoreTemp that precedes its first use, and each occurrence is replaced
+    by a ScanTemp, when the estimated cost of materializing (computing it
+    once, writing it once and reading it k times) is below the cost of
+    computing it k times. Cost is the sum of the estimated number of tuples
+    produced by each operator.
+    """
+
+    statement_ops = (algebra.Store, algebra.StoreTemp, algebra.Sink,
+                     algebra.Dump, algebra.Sequence, algebra.Parallel,
+                     algebra.DoWhile)
+
+    # Operator fields that do not determine the result of an operator
+    ignored_fields = frozenset(['bound', 'cleanup', 'alias', '_trace',
+                                'has_been_pushed', 'analyzed_num_tuples',
+                                'input', 'left', 'right', 'args',
+                                '_property_cache'])
+
+    def __init__(self):
+        self._next_temp = 0
+        super(CommonSubexpressionElimination, self).__init__()
+
+    def fire(self, expr):
+        if not isinstance(expr, (algebra.Sequence, algebra.Parallel)):
+            return expr
+
+        # StoreTemps computing shared subtrees of a Parallel must run before
+        # the Parallel, so collect them separately.
+        before = []
+        found = self._eliminate_one(expr)
+        while found is not None:
+            index, store = found
+            if isinstance(expr, algebra.Parallel):
+                before.append(store)
+            else:
+                expr.args.insert(index, store)
+            found = self._eliminate_one(expr)
+
+        if before:
+            return algebra.Sequence(before + [expr])
+        return expr
+
+    def _eliminate_one(self, seq):
+        """Find the largest shared subtree of the statements of seq that is
+        worth materializing, and replace its occurrences by ScanTemps.
+
+        :returns: None, or a tuple (index, StoreTemp) where index is the
+        position of the first statement that uses the shared subtree
+        """
+        occurrences = {}
+        sizes = {}
+        memo = {}
+        for index, stmt in enumerate(seq.args):
+            if isinstance(stmt, (algebra.Sequence, algebra.Parallel,
+                                 algebra.DoWhile)):
+                continue
+            for op in stmt.walk():
+                if isinstance(op, self.statement_ops):
+                    continue
+                key = self._canonical(op, memo)
+                occurrences.setdefault(key, []).append((index, op))
+                sizes[key] = sum(1 for _ in op.walk())
+
+        candidates = sorted((k for k, occ in occurrences.items()
+                             if len(occ) > 1),
+                            key=lambda k: sizes[k], reverse=True)
+        for key in candidates:
+            occ = self._outermost(occurrences[key])
+            if len(occ) < 2 or not self._profitable(occ[0][1], len(occ)):
+                continue
+            first = min(index for index, _ in occ)
+            last = max(index for index, _ in occ)
+            if isinstance(seq, algebra.Parallel):
+                first, last = 0, len(seq.args)
+            if not self._safe(seq.args[first:last], occ[0][1]):
+                continue
+            return first, self._materialize(seq, occ)
+        return None
+
+    @staticmethod
+    def _outermost(occ):
+        """Drop occurrences nested inside another occurrence."""
+        ids = set()
+        for _, op in occ:
+            ids.update(id(c) for c in op.walk() if c is not op)
+        return [(index, op) for index, op in occ if id(op) not in ids]
+
+    @classmethod
+    def _canonical(cls, op, memo):
+        """Return a hashable, alias-insensitive representation of op."""
+        if id(op) in memo:
+            return memo[id(op)]
+        fields = []
+        for name, value in sorted(vars(op).items()):
+            if name in cls.ignored_fields:
+                continue
+            if name == 'emitters':
+                # output column names do not matter
+                value = [ex for _, ex in value]
+            fields.append((name, cls._canonical_value(value)))
+        key = (type(op).__name__, tuple(fields),
+               tuple(cls._canonical(c, memo) for c in op.children()))
+        memo[id(op)] = key
+        return key
+
+    @classmethod
+    def _canonical_value(cls, value):
+        if isinstance(value, expression.Expression):
+            # expression equality ignores the alias in debug_info
+            return value
+        elif isinstance(value, scheme.Scheme):
+            return tuple(value.get_types())
+        elif isinstance(value, (list, tuple)):
+            return tuple(cls._canonical_value(v) for v in value)
+        elif isinstance(value, (set, frozenset)):
+            return frozenset(cls._canonical_value(v) for v in value)
+        elif isinstance(value, (basestring, int, long, float, bool)) or \
+                value is None:
+            return value
+        return repr(value)
+
+    @staticmethod
+    def _estimate(op):
+        try:
+            return op.num_tuples()
+        except (NotImplementedError, AttributeError):
+            return algebra.DEFAULT_CARDINALITY
+
+    @classmethod
+    def _profitable(cls, op, k):
+        compute = sum(cls._estimate(o) for o in op.walk())
+        rows = cls._estimate(op)
+        return compute + rows + k * rows < k * compute
+
+    @staticmethod
+    def _expressions(value):
+        """Return the expressions held by an operator field."""
+        if isinstance(value, expression.Expression):
+            return [value]
+        if isinstance(value, (list, tuple)):
+            return [e for v in value
+                    for e in CommonSubexpressionElimination._expressions(v)]
+        return []
+
+    @classmethod
+    def _safe(cls, statements, op):
+        """Check that op is deterministic and that none of the statements
+        modifies a relation that op reads."""
+        reads = set()
+        for o in op.walk():
+            if isinstance(o, (algebra.SampleScan, algebra.FileScan)):
+                return False
+            if isinstance(o, algebra.Scan):
+                reads.add(str(o.relation_key))
+            elif isinstance(o, algebra.ScanTemp):
+                reads.add(o.name)
+            for ex in cls._expressions(vars(o).values()):
+                if any(isinstance(e, RANDOM) for e in ex.walk()):
+                    return False
+
+        for stmt in statements:
+            for o in stmt.walk():
+                if isinstance(o, algebra.Store) and \
+                        str(o.relation_key) in reads:
+                    return False
+                if isinstance(o, algebra.StoreTemp) and o.name in reads:
+                    return False
+        return True
+
+    def _new_temp_name(self, seq):
+        used = set(o.name for o in seq.walk()
+                   if isinstance(o, (algebra.StoreTemp, algebra.ScanTemp)))
+        while True:
+            self._next_temp += 1
+            name = '__cse_%d' % self._next_temp
+            if name not in used:
+                return name
+
+    def _materialize(self, seq, occ):
+        """Replace the occurrences in occ by ScanTemps of a new temporary
+        relation and return the StoreTemp that computes it."""
+        name = self._new_temp_name(seq)
+        shared = occ[0][1]
+        shared_scheme = shared.scheme()
+        store = algebra.StoreTemp(name, shared)
+
+        replacements = {}
+        for _, op in occ:
+            scan = algebra.ScanTemp(name, shared_scheme)
+            scan.analyzed_num_tuples = self._estimate(shared)
+            op_names = op.scheme().get_names()
+            if op_names != shared_scheme.get_names():
+                scan = algebra.Apply(
+                    [(n, UnnamedAttributeRef(i))
+                     for i, n in enumerate(op_names)], scan)
+            replacements[id(op)] = scan
+
+        def replace(node):
+            if id(node) in replacements:
+                return replacements[id(node)]
+            return node.apply(replace)
+
+        seq.args = [replace(stmt) for stmt in seq.args]
+        return store
+
+    def __str__(self):
+        return "Shared subtrees => StoreTemp, ScanTemp"
+
+
+class EagerAggregation(Rule):
+
+    """Push a partial aggregate below a join.
+
+    GroupBy(G; A)[Join(L, R)] becomes
+    GroupBy(G; remote(A))[Join(GroupBy(G_L; local(A))[L], R)], followed by
+    the finalizers of A, when every aggregate is decomposable and only reads
+    columns of L. G_L holds the columns of L used by G or by the join
+    condition, so each partial row joins with exactly the tuples of R that
+    the tuples it summarizes joined with. The aggregates are split into
+    local and remote phases as in DecomposeGroupBy. The same holds with L
+    and R swapped.
+
+    The partial aggregate is an instance of partition_groupby_class, which
+    DecomposeGroupBy leaves alone: it runs on each worker without a shuffle,
+    since the remote aggregate combines the partial rows of every worker.
+    """
+
+    def __init__(self, partition_groupby_class):
+        self._gb_class = partition_groupby_class
+        super(EagerAggregation, self).__init__()
+
+    def fire(self, op):
+        if op.__class__ != algebra.GroupBy:
+            return op
+        join = op.input
+        if join.__class__ != algebra.ProjectingJoin:
+            return op
+        # user-defined aggregates may read state, keep them in place
+        if (not op.aggregate_list or op.inits or
+                not all(isinstance(agg, expression.BuiltinAggregateExpression)
+                        and agg.is_decomposable()
+                        for agg in op.aggregate_list)):
+            return op
+
+        left_len = len(join.left.scheme())
+        combined_scheme = join.left.scheme() + join.right.scheme()
+        in_scheme = join.scheme()
+        if join.output_columns is None:
+            out_map = range(len(combined_scheme))
+        else:
+            out_map = [col.get_position(combined_scheme)
+                       for col in join.output_columns]
+
+        # positions in the combined scheme of the join inputs
+        try:
+            grouping = [out_map[expression.toUnnamed(ref, in_scheme).position]
+                        for ref in op.grouping_list]
+        except TypeError:
+            return op
+        aggregates = [to_unnamed_recursive(copy.deepcopy(agg), in_scheme)
+                      for agg in op.aggregate_list]
+        agg_cols = set(out_map[c] for agg in aggregates
+                       for c in accessed_columns(agg))
+        condition = to_unnamed_recursive(copy.deepcopy(join.condition),
+                                         combined_scheme)
+        cond_cols = accessed_columns(condition)
+
+        # which input to aggregate early
+        if all(c < left_len for c in agg_cols):
+            push_left = True
+            if not agg_cols:
+                # e.g., COUNTALL: aggregate the larger input
+                try:
+                    push_left = (join.left.num_tuples() >=
+                                 join.right.num_tuples())
+                except NotImplementedError:
+                    pass
+        elif all(c >= left_len for c in agg_cols):
+            push_left = False
+        else:
+            return op
+
+        if push_left:
+            lo, hi, child = 0, left_len, join.left
+        else:
+            lo, hi, child = left_len, len(combined_scheme), join.right
+        # do not aggregate twice
+        if isinstance(child, algebra.GroupBy):
+            return op
+        local_cols = sorted(c for c in set(grouping) | cond_cols
+                            if lo <= c < hi)
+        # grouping by every column only removes duplicates
+        if len(local_cols) == hi - lo:
+            return op
+
+        # layout of the new join output
+        num_local = len(local_cols)
+        if push_left:
+            local_agg_pos = num_local
+        else:
+            local_agg_pos = left_len + num_local
+        (local_emitters, local_statemods, remote_emitters, remote_statemods,
+         finalizer_exprs) = decompose_aggregates(
+            aggregates, local_agg_pos, len(grouping))
+        num_local_aggs = len(local_emitters)
+
+        def new_position(c):
+            if lo <= c < hi:
+                return lo + local_cols.index(c)
+            if push_left:
+                return c - left_len + num_local + num_local_aggs
+            return c
+
+        # the local aggregate reads the aggregated input directly
+        local_map = {p: c - lo for p, c in enumerate(out_map)}
+        local_emitters = [copy.deepcopy(e) for e in local_emitters]
+        for emitter in local_emitters:
+            expression.reindex_expr(emitter, local_map)
+        local_gb = self._gb_class(
+            [UnnamedAttributeRef(c - lo) for c in local_cols],
+            local_emitters, child, local_statemods)
+
+        expression.reindex_expr(
+            condition, {c: new_position(c) for c in cond_cols})
+        if push_left:
+            new_left, new_right = local_gb, join.right
+        else:
+            new_left, new_right = join.left, local_gb
+        new_len = len(new_left.scheme()) + len(new_right.scheme())
+        new_join = algebra.ProjectingJoin(
+            condition, new_left, new_right,
+            [UnnamedAttributeRef(i) for i in range(new_len)])
+
+        remote_gb = algebra.GroupBy(
+            [UnnamedAttributeRef(new_position(c)) for c in grouping],
+            remote_emitters, new_join, remote_statemods)
+
+        if finalizer_exprs is None:
+            finalizer_exprs = [UnnamedAttributeRef(len(grouping) + i)
+                               for i in range(len(remote_emitters))]
+        names = op.scheme().get_names()
+        emitters = [UnnamedAttributeRef(i) for i in range(len(grouping))]
+        emitters += finalizer_exprs
+        return algebra.Apply(zip(names, emitters), remote_gb)
+
+    def __str__(self):
+        return "GroupBy(Join(L, R)) => GroupBy(Join(GroupBy(L), R))"
+
+
+class PushLimit(Rule):
+
+    """Push a Limit towards the inputs.
+
+    A Limit commutes with an Apply, which produces one tuple for each of its
+    input tuples, and the inputs of a UnionAll need to produce at most as
+    many tuples as the Limit returns. Adjacent Limits are merged.
+    """
+
+    def fire(self, op):
+        if not isinstance(op, algebra.Limit):
+            return op
+
+        child = op.input
+        if isinstance(child, algebra.Limit):
+            child.count = min(op.count, child.count)
+            return child
+
+        if isinstance(child, algebra.Apply):
+            op.input = child.input
+            child.input = op
+            return child
+
+        if isinstance(child, algebra.UnionAll):
+            def limit(arg):
+                if isinstance(arg, algebra.Limit) and arg.count <= op.count:
+                    return arg
+                return algebra.Limit(op.count, arg)
+
+            if not all(isinstance(arg, algebra.Limit) and
+                       arg.count <= op.count for arg in child.args):
+                child.args = [limit(arg) for arg in child.args]
+            return op
+
+        return op
+
+    def __str__(self):
+        return "Limit(Apply(X)) => Apply(Limit(X))"
+
+
 # logical groups of catalog transparent rules
 # 1. this must be applied first
 remove_trivial_sequences = [RemoveTrivialSequences()]
@@ -853,6 +1419,86 @@ push_apply = [
     RemoveNoOpApply(),
 ]
 
+# push limit, after the Applies are in place
+push_limit = [PushLimit()]
+
+
+def decompose_aggregates(aggregate_list, local_output_pos,
+                         remote_output_pos):
+    """Split decomposable aggregates into a local and a remote phase.
+
+    :param aggregate_list: the aggregates, all of them decomposable
+    :param local_output_pos: the position of the first local aggregate
+    output in the input of the remote aggregate
+    :param remote_output_pos: the position of the first remote aggregate
+    output in the input of the finalizer
+    :return: the local emitters, local statemods, remote emitters, remote
+    statemods and finalizer expressions; the latter are None if no aggregate
+    requires a finalizer
+    """
+    local_emitters = []
+    local_statemods = []
+    remote_emitters = []
+    remote_statemods = []
+    finalizer_exprs = []
+    requires_finalizer = False
+
+    for agg in aggregate_list:
+        # Multiple emit arguments can be associated with a single
+        # decomposition rule; coalesce them all together.
+        state = agg.get_decomposable_state()
+        assert state
+
+        ################################
+        # Extract the set of emitters and statemods required for the
+        # local aggregate.
+        ################################
+
+        laggs = state.get_local_emitters()
+        local_emitters.extend(laggs)
+        local_statemods.extend(state.get_local_statemods())
+
+        ################################
+        # Extract the set of emitters and statemods required for the
+        # remote aggregate.  Remote expressions must be rebased to
+        # remove instances of LocalAggregateOutput
+        ################################
+
+        raggs = state.get_remote_emitters()
+        raggs = [rebase_local_aggregate_output(x, local_output_pos)
+                 for x in raggs]
+        remote_emitters.extend(raggs)
+
+        rsms = state.get_remote_statemods()
+        for sm in rsms:
+            update_expr = rebase_local_aggregate_output(
+                sm.update_expr, local_output_pos)
+            remote_statemods.append(
+                StateVar(sm.name, sm.init_expr, update_expr))
+
+        ################################
+        # Extract any required finalizers.  These must be rebased to remove
+        # instances of RemoteAggregateOutput
+        ################################
+
+        finalizer = state.get_finalizer()
+        if finalizer is not None:
+            requires_finalizer = True
+            finalizer_exprs.append(
+                rebase_finalizer(finalizer, remote_output_pos))
+        else:
+            for i in range(len(raggs)):
+                finalizer_exprs.append(
+                    UnnamedAttributeRef(remote_output_pos + i))
+
+        local_output_pos += len(laggs)
+        remote_output_pos += len(raggs)
+
+    if not requires_finalizer:
+        finalizer_exprs = None
+    return (local_emitters, local_statemods, remote_emitters,
+            remote_statemods, finalizer_exprs)
+
 
 class DecomposeGroupBy(Rule):
 
@@ -921,68 +1567,10 @@ class DecomposeGroupBy(Rule):
             return out_op
 
         num_grouping_terms = len(op.grouping_list)
-
-        local_emitters = []
-        local_statemods = []
-        remote_emitters = []
-        remote_statemods = []
-        finalizer_exprs = []
-
-        # The starting positions for the current local, remote aggregate
-        local_output_pos = num_grouping_terms
-        remote_output_pos = num_grouping_terms
-        requires_finalizer = False
-
-        for agg in op.aggregate_list:
-            # Multiple emit arguments can be associated with a single
-            # decomposition rule; coalesce them all together.
-            state = agg.get_decomposable_state()
-            assert state
-
-            ################################
-            # Extract the set of emitters and statemods required for the
-            # local aggregate.
-            ################################
-
-            laggs = state.get_local_emitters()
-            local_emitters.extend(laggs)
-            local_statemods.extend(state.get_local_statemods())
-
-            ################################
-            # Extract the set of emitters and statemods required for the
-            # remote aggregate.  Remote expressions must be rebased to
-            # remove instances of LocalAggregateOutput
-            ################################
-
-            raggs = state.get_remote_emitters()
-            raggs = [rebase_local_aggregate_output(x, local_output_pos)
-                     for x in raggs]
-            remote_emitters.extend(raggs)
-
-            rsms = state.get_remote_statemods()
-            for sm in rsms:
-                update_expr = rebase_local_aggregate_output(
-                    sm.update_expr, local_output_pos)
-                remote_statemods.append(
-                    StateVar(sm.name, sm.init_expr, update_expr))
-
-            ################################
-            # Extract any required finalizers.  These must be rebased to remove
-            # instances of RemoteAggregateOutput
-            ################################
-
-            finalizer = state.get_finalizer()
-            if finalizer is not None:
-                requires_finalizer = True
-                finalizer_exprs.append(
-                    rebase_finalizer(finalizer, remote_output_pos))
-            else:
-                for i in range(len(raggs)):
-                    finalizer_exprs.append(
-                        UnnamedAttributeRef(remote_output_pos + i))
-
-            local_output_pos += len(laggs)
-            remote_output_pos += len(raggs)
+        (local_emitters, local_statemods, remote_emitters, remote_statemods,
+         finalizer_exprs) = decompose_aggregates(
+            op.aggregate_list, num_grouping_terms, num_grouping_terms)
+        requires_finalizer = finalizer_exprs is not None
 
         ################################
         # Glue together the local and remote aggregates:
@@ -1041,7 +1629,7 @@ def check_partition_equality(op, representation):
     @return true if the op has an equal hash partitioning to representation
     """
 
-    return op.partitioning().hash_partitioned == frozenset(representation)
+    return op.partitioning().is_hash_partitioned(representation)
 
 
 class DeDupBroadcastInputs(Rule):
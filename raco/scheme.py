@@ -1,8 +1,6 @@
 from raco import expression
 import raco.types
 
-from collections import OrderedDict
-
 
 class DummyScheme(object):
     """Dummy scheme used to generate plans in the absence of catalog info."""
@@ -15,26 +13,32 @@ class DummyScheme(object):
 
 class Scheme(object):
     """Add an attribute to the scheme."""
+    __slots__ = ('attributes', 'positions')
     salt = "1"
 
     def __init__(self, attributes=None):
         if attributes is None:
             attributes = []
         self.attributes = []
-        self.asdict = OrderedDict()
+        # name -> position in attributes
+        self.positions = {}
         for n, t in attributes:
             self.addAttribute(n, t)
 
     def addAttribute(self, name, _type):
         assert _type in raco.types.ALL_TYPES, \
             'Invalid type name: %s' % str(_type)
+        # map_type returns the shared type name constants; the names of
+        # wide, generated schemes are shared as well
         _type = raco.types.map_type(_type)
+        if type(name) is str:
+            name = intern(name)
 
-        if name in self.asdict:
+        if name in self.positions:
             # ugly.  I don't like throwing errors in this case, but it's worse
             # not to
             return self.addAttribute(name + self.salt, _type)
-        self.asdict[name] = (len(self.attributes), _type)
+        self.positions[name] = len(self.attributes)
         self.attributes.append((name, _type))
         # just in case we changed the name.  ugly.
         return name
@@ -62,7 +66,7 @@ class Scheme(object):
         return not (self == other)
 
     def getPosition(self, name):
-        return self.asdict[name][0]
+        return self.positions[name]
 
     def getName(self, position):
         return self[position][0]
@@ -71,7 +75,7 @@ class Scheme(object):
         if type(name) == int:
             return self[name][1]
         else:
-            return self.asdict[name][1]
+            return self.attributes[self.positions[name]][1]
 
     def resolve(self, attrref):
         """return the name and type of the attribute reference, resolved
@@ -89,7 +93,7 @@ class Scheme(object):
         if typ:
             return (attr, type) in self.attributes
         else:
-            return attr in self.asdict
+            return attr in self.positions
 
     def __str__(self):
         """Pretty print the scheme"""
@@ -116,5 +120,7 @@ class Scheme(object):
 
 
 class EmptyScheme(Scheme):
+    __slots__ = ()
+
     def __init__(self):
         Scheme.__init__(self, [])
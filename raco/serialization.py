@@ -0,0 +1,673 @@
+"""Serialization of logical and physical plans without eval.
+
+A plan is flattened into a table of the raco objects it references
+(operators, expressions, schemes, relation keys, ...). Every object is
+stored once, so subtrees shared by several parents stay shared after a
+round trip. The decoder allocates every object up front and then fills
+in their states in a single forward pass. States are written in
+post-order, so an object is complete before a parent hashes or compares
+it; only back edges such as parent pointers see an object early.
+
+Two encodings of the same format are supported:
+
+    - compact JSON (``dumps(plan)``), for humans and HTTP services;
+    - a msgpack-style binary encoding (``dumps(plan, binary=True)``) with
+      an interned string table, which is smaller and faster to decode.
+
+``loads`` detects the encoding. Decoding only instantiates classes
+defined in the raco package and never calls their constructors, so
+untrusted input cannot execute code the way ``eval`` of a repr can.
+"""
+
+import base64
+import importlib
+import json
+import struct
+import sys
+
+from raco.utility import MemoizingMeta, TrackedList
+
+FORMAT = 'raco-plan'
+VERSION = 1
+
+_MAGIC = '\xc1RACO'
+_SKIPPED_SLOTS = frozenset(['__dict__', '__weakref__', '_property_cache'])
+_PRIMITIVES = (type(None), bool, int, long, float, str, unicode)
+_PRIMITIVE_TYPES = frozenset(_PRIMITIVES)
+_CONTAINER_TYPES = frozenset([list, TrackedList, tuple, set, frozenset])
+
+
+class PlanSerializationException(ValueError):
+    """The plan cannot be encoded, or the input is not a valid plan."""
+
+
+def _is_raco_object(value):
+    cls = type(value)
+    return (not isinstance(value, type) and
+            cls.__module__.split('.', 1)[0] == 'raco')
+
+
+def _slot_names(cls):
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        names.extend(s for s in slots if s not in _SKIPPED_SLOTS)
+    return names
+
+
+def _get_state(obj, slots_by_class):
+    """Return the attributes of obj as a dict, skipping cached
+    properties"""
+    cls = type(obj)
+    slots = slots_by_class.get(cls)
+    if slots is None:
+        slots = slots_by_class[cls] = _slot_names(cls)
+    state = {}
+    for name in slots:
+        try:
+            state[name] = object.__getattribute__(obj, name)
+        except AttributeError:
+            pass
+    attrs = getattr(obj, '__dict__', None)
+    if attrs:
+        state.update(attrs)
+    return state
+
+
+def _objects_in(value, out):
+    """Append the raco objects referenced by a state value to out"""
+    t = type(value)
+    if t in _PRIMITIVE_TYPES:
+        return
+    if t in _CONTAINER_TYPES:
+        for v in value:
+            _objects_in(v, out)
+    elif _is_raco_object(value):
+        out.append(value)
+    elif isinstance(value, _PRIMITIVES):
+        return
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            _objects_in(v, out)
+    elif isinstance(value, dict):
+        for k, v in value.iteritems():
+            _objects_in(k, out)
+            _objects_in(v, out)
+    else:
+        raise PlanSerializationException(
+            "cannot serialize {v!r} of type {t}".format(
+                v=value, t=type(value).__name__))
+
+
+def _flatten(root):
+    """Return the raco objects reachable from root in post-order and
+    their states. Back edges (e.g., parent pointers) are kept as
+    references to objects that are still being visited."""
+    slots_by_class = {}
+    order = []
+    states = {}
+    index = {}
+    visiting = set()
+    stack = [(root, False)]
+    while stack:
+        obj, expanded = stack.pop()
+        key = id(obj)
+        if key in index:
+            continue
+        if expanded:
+            visiting.discard(key)
+            index[key] = len(order)
+            order.append(obj)
+            continue
+        if key in visiting:
+            continue
+        visiting.add(key)
+        stack.append((obj, True))
+        state = states[key] = _get_state(obj, slots_by_class)
+        children = []
+        for name in sorted(state):
+            _objects_in(state[name], children)
+        for child in reversed(children):
+            ckey = id(child)
+            if ckey not in index and ckey not in visiting:
+                stack.append((child, False))
+    return order, states, index
+
+
+def _class_name(cls):
+    return '{m}.{n}'.format(m=cls.__module__, n=cls.__name__)
+
+
+def _resolve_class(name):
+    """Look up a class by its qualified name, only within raco"""
+    module_name, _, class_name = name.rpartition('.')
+    if module_name.split('.', 1)[0] != 'raco':
+        raise PlanSerializationException(
+            "refusing to load class {n} from outside raco".format(n=name))
+    try:
+        cls = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError):
+        raise PlanSerializationException(
+            "unknown class {n}".format(n=name))
+    if not isinstance(cls, type) or cls.__module__ != module_name:
+        raise PlanSerializationException(
+            "{n} is not a raco class".format(n=name))
+    return cls
+
+
+def _layouts(order, states):
+    """Group the objects by class and attribute names. Return the list of
+    (class, attribute names) and the index of each object's layout."""
+    layouts = {}
+    object_layouts = []
+    for obj in order:
+        key = (type(obj), tuple(sorted(states[id(obj)])))
+        object_layouts.append(layouts.setdefault(key, len(layouts)))
+    return sorted(layouts, key=layouts.get), object_layouts
+
+
+def _check_version(fmt, version):
+    if fmt != FORMAT or version != VERSION:
+        raise PlanSerializationException(
+            "unsupported plan format {f} version {v}".format(
+                f=fmt, v=version))
+
+
+###############################################################################
+# JSON encoding
+#
+# The document lists the layouts, i.e., pairs of a class name and attribute
+# names, and then each object as its layout index followed by its attribute
+# values. Lists, strings, numbers, booleans and null map to themselves;
+# everything else is a single-key object tagged by its type:
+#     {"#": i}    reference to the i-th object of the table
+#     {"t": [..]} tuple, {"s": [..]} set, {"f": [..]} frozenset
+#     {"d": [[k, v], ..]} dict, {"u": ".."} unicode, {"b": ".."} bytes
+###############################################################################
+
+
+def _to_json(value, index):
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            value.decode('utf-8')
+            return value
+        except UnicodeDecodeError:
+            return {'b': base64.b64encode(value)}
+    if isinstance(value, unicode):
+        return {'u': value}
+    if isinstance(value, list):
+        return [_to_json(v, index) for v in value]
+    if isinstance(value, tuple):
+        return {'t': [_to_json(v, index) for v in value]}
+    if isinstance(value, frozenset):
+        return {'f': [_to_json(v, index) for v in value]}
+    if isinstance(value, set):
+        return {'s': [_to_json(v, index) for v in value]}
+    if isinstance(value, dict):
+        return {'d': [[_to_json(k, index), _to_json(v, index)]
+                      for k, v in value.iteritems()]}
+    return {'#': index[id(value)]}
+
+
+def _from_json(value, objects, strings):
+    if isinstance(value, unicode):
+        s = value.encode('utf-8')
+        return strings.setdefault(s, s)
+    if isinstance(value, list):
+        return [_from_json(v, objects, strings) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) != 1:
+        raise PlanSerializationException(
+            "malformed value {v!r}".format(v=value))
+    tag, v = value.items()[0]
+    if tag == '#':
+        return objects[v]
+    if tag == 'u':
+        return v
+    if tag == 'b':
+        return base64.b64decode(v)
+    items = [_from_json(x, objects, strings) for x in v]
+    if tag == 't':
+        return tuple(items)
+    if tag == 'f':
+        return frozenset(items)
+    if tag == 's':
+        return set(items)
+    if tag == 'd':
+        return {k: x for k, x in items}
+    raise PlanSerializationException("unknown tag {t!r}".format(t=tag))
+
+
+def to_json(plan):
+    """Encode a plan as a JSON-compatible dictionary"""
+    order, states, index = _flatten(plan)
+    layouts, object_layouts = _layouts(order, states)
+    objects = []
+    for obj, i in zip(order, object_layouts):
+        state = states[id(obj)]
+        entry = [i]
+        entry.extend(_to_json(state[name], index) for name in layouts[i][1])
+        objects.append(entry)
+    return {'format': FORMAT,
+            'version': VERSION,
+            'layouts': [[_class_name(cls), list(names)]
+                        for cls, names in layouts],
+            'objects': objects,
+            'root': _to_json(plan, index)}
+
+
+def from_json(doc):
+    """Rebuild a plan from the dictionary returned by to_json"""
+    setattr_ = object.__setattr__
+    try:
+        _check_version(doc.get('format'), doc.get('version'))
+        layouts = [(_resolve_class(str(cls)), [str(name) for name in names])
+                   for cls, names in doc['layouts']]
+        objects = []
+        for entry in doc['objects']:
+            cls = layouts[entry[0]][0]
+            objects.append(cls.__new__(cls))
+        strings = {}
+        for obj, entry in zip(objects, doc['objects']):
+            cls, names = layouts[entry[0]]
+            if len(names) != len(entry) - 1:
+                raise ValueError("wrong number of attributes")
+            tracked = isinstance(cls, MemoizingMeta)
+            for name, value in zip(names, entry[1:]):
+                t = type(value)
+                if t is unicode:
+                    value = value.encode('utf-8')
+                    value = strings.setdefault(value, value)
+                elif t is list or t is dict:
+                    value = _from_json(value, objects, strings)
+                    if tracked and t is list:
+                        value = TrackedList(value)
+                setattr_(obj, name, value)
+        return _from_json(doc['root'], objects, strings)
+    except (KeyError, IndexError, TypeError, ValueError,
+            AttributeError) as e:
+        raise PlanSerializationException(
+            "malformed plan: {e!r}".format(e=e))
+
+
+###############################################################################
+# Binary encoding
+#
+# After the magic header and the version byte, the stream is
+#     number of layouts, (class name, number of attributes, attribute names)
+#         per layout,
+#     number of objects, layout index per object,
+#     attribute values per object, in the order of its layout,
+#     root
+# where numbers are unsigned varints and every value is a type byte followed
+# by its payload, as in msgpack. Type bytes from 0x80 up are small ints. A
+# str is written out in full the first time it occurs and afterwards by its
+# index in the string table.
+###############################################################################
+
+_NONE, _FALSE, _TRUE = '\x00', '\x01', '\x02'
+_POS_INT, _NEG_INT, _FLOAT = '\x03', '\x04', '\x05'
+_NEW_STR, _STR, _UNICODE = '\x06', '\x07', '\x08'
+_LIST, _TUPLE, _SET, _FROZENSET, _DICT = '\x09', '\x0a', '\x0b', '\x0c', '\x0d'
+_REF = '\x0e'
+_SMALL_INT = 0x80
+
+# the longest fixed-size prefix of a value: a type byte and a double
+_LOOKAHEAD = 10
+
+_pack_double = struct.Struct('>d').pack
+_unpack_double = struct.Struct('>d').unpack_from
+
+
+def _varint(n, out):
+    if n < 0x80:
+        out.append(chr(n))
+        return
+    while n > 0x7f:
+        out.append(chr(0x80 | (n & 0x7f)))
+        n >>= 7
+    out.append(chr(n))
+
+
+class _BinaryWriter(object):
+    def __init__(self, index):
+        self.index = index
+        self.strings = {}
+        self.out = []
+
+    def write(self, value):
+        out = self.out
+        i = self.index.get(id(value))
+        if i is not None:
+            out.append(_REF)
+            _varint(i, out)
+        elif type(value) is str:
+            i = self.strings.get(value)
+            if i is None:
+                self.strings[value] = len(self.strings)
+                out.append(_NEW_STR)
+                _varint(len(value), out)
+                out.append(value)
+            else:
+                out.append(_STR)
+                _varint(i, out)
+        elif value is None:
+            out.append(_NONE)
+        elif value is True:
+            out.append(_TRUE)
+        elif value is False:
+            out.append(_FALSE)
+        elif isinstance(value, (int, long)):
+            if 0 <= value < _SMALL_INT:
+                out.append(chr(_SMALL_INT + value))
+            elif value >= 0:
+                out.append(_POS_INT)
+                _varint(value, out)
+            else:
+                out.append(_NEG_INT)
+                _varint(-value, out)
+        elif isinstance(value, float):
+            out.append(_FLOAT)
+            out.append(_pack_double(value))
+        elif isinstance(value, str):
+            value = str(value)
+            i = self.strings.get(value)
+            if i is None:
+                self.strings[value] = len(self.strings)
+                out.append(_NEW_STR)
+                _varint(len(value), out)
+                out.append(value)
+            else:
+                out.append(_STR)
+                _varint(i, out)
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+            out.append(_UNICODE)
+            _varint(len(value), out)
+            out.append(value)
+        elif isinstance(value, dict):
+            out.append(_DICT)
+            _varint(len(value), out)
+            for k, v in value.iteritems():
+                self.write(k)
+                self.write(v)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            if isinstance(value, list):
+                out.append(_LIST)
+            elif isinstance(value, tuple):
+                out.append(_TUPLE)
+            elif isinstance(value, frozenset):
+                out.append(_FROZENSET)
+            else:
+                out.append(_SET)
+            _varint(len(value), out)
+            for v in value:
+                self.write(v)
+        else:
+            raise PlanSerializationException(
+                "cannot serialize {v!r}".format(v=value))
+
+
+class _BinaryReader(object):
+    """Decode the values of a binary plan. References and strings, by far
+    the most common values, take the shortest path.
+
+    The input is either a complete string, or a buffer that is refilled from
+    the file object fp whenever fewer than _LOOKAHEAD bytes are left in it.
+    Bytes that have been decoded are dropped at each refill."""
+
+    def __init__(self, data, pos, fp=None, chunk_size=1 << 16):
+        self.data = data
+        self.pos = pos
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.strings = []
+        self.objects = []
+        # read refills the buffer once pos passes limit
+        self.limit = sys.maxint
+        if fp is not None:
+            self.limit = len(data) - _LOOKAHEAD
+
+    def fill(self, n):
+        """Buffer at least n bytes from pos on, unless the input ends
+        first"""
+        if self.fp is None or self.pos + n <= len(self.data):
+            return
+        parts = [self.data[self.pos:]]
+        have = len(parts[0])
+        while have < max(n, _LOOKAHEAD):
+            chunk = self.fp.read(max(n - have, self.chunk_size))
+            if not chunk:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        self.data = ''.join(parts)
+        self.pos = 0
+        self.limit = len(self.data) - _LOOKAHEAD
+
+    def varint(self):
+        if self.pos > self.limit:
+            self.fill(_LOOKAHEAD)
+        data = self.data
+        pos = self.pos
+        b = ord(data[pos])
+        if b < 0x80:
+            self.pos = pos + 1
+            return b
+        result = b & 0x7f
+        shift = 7
+        while True:
+            pos += 1
+            if pos >= len(data) and self.fp is not None:
+                # a varint longer than the lookahead
+                self.pos = pos
+                self.fill(1)
+                data = self.data
+                pos = self.pos
+            b = ord(data[pos])
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.pos = pos + 1
+        return result
+
+    def raw(self, n):
+        self.fill(n)
+        start = self.pos
+        self.pos = start + n
+        if self.pos > len(self.data):
+            raise IndexError("truncated plan")
+        return self.data[start:self.pos]
+
+    def read(self):
+        if self.pos > self.limit:
+            self.fill(_LOOKAHEAD)
+        data = self.data
+        pos = self.pos
+        tag = data[pos]
+        if tag == _REF or tag == _STR:
+            b = ord(data[pos + 1])
+            if b < 0x80:
+                self.pos = pos + 2
+            else:
+                self.pos = pos + 1
+                b = self.varint()
+            if tag == _REF:
+                return self.objects[b]
+            return self.strings[b]
+        self.pos = pos + 1
+        if tag == _NONE:
+            return None
+        if tag >= '\x80':
+            return ord(tag) - _SMALL_INT
+        if tag == _NEW_STR:
+            s = self.raw(self.varint())
+            self.strings.append(s)
+            return s
+        if _LIST <= tag <= _DICT:
+            n = ord(data[pos + 1])
+            if n < 0x80:
+                self.pos = pos + 2
+            else:
+                n = self.varint()
+            if tag == _LIST:
+                return [self.read() for _ in xrange(n)]
+            if tag == _TUPLE:
+                return tuple([self.read() for _ in xrange(n)])
+            if tag == _DICT:
+                d = {}
+                for _ in xrange(n):
+                    k = self.read()
+                    d[k] = self.read()
+                return d
+            if tag == _FROZENSET:
+                return frozenset([self.read() for _ in xrange(n)])
+            return set([self.read() for _ in xrange(n)])
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        if tag == _POS_INT:
+            return self.varint()
+        if tag == _NEG_INT:
+            return -self.varint()
+        if tag == _FLOAT:
+            value, = _unpack_double(data, pos + 1)
+            self.pos = pos + 9
+            return value
+        if tag == _UNICODE:
+            return self.raw(self.varint()).decode('utf-8')
+        raise PlanSerializationException(
+            "unknown type byte {t!r} at offset {p}".format(t=tag, p=pos))
+
+
+def to_binary(plan):
+    """Encode a plan in the binary format"""
+    order, states, index = _flatten(plan)
+    writer = _BinaryWriter(index)
+    out = writer.out
+    out.append(_MAGIC)
+    out.append(chr(VERSION))
+    layouts, object_layouts = _layouts(order, states)
+    _varint(len(layouts), out)
+    for cls, names in layouts:
+        writer.write(_class_name(cls))
+        _varint(len(names), out)
+        for name in names:
+            writer.write(name)
+    _varint(len(order), out)
+    for i in object_layouts:
+        _varint(i, out)
+    for obj, i in zip(order, object_layouts):
+        state = states[id(obj)]
+        for name in layouts[i][1]:
+            writer.write(state[name])
+    writer.write(plan)
+    return ''.join(out)
+
+
+def from_binary(data):
+    """Rebuild a plan from the string returned by to_binary
+
+    The decoder makes a single pass over the data and sets the attributes
+    of each object as soon as they have been read."""
+    if not data.startswith(_MAGIC):
+        raise PlanSerializationException("not a binary raco plan")
+    return _decode_binary(_BinaryReader(data, len(_MAGIC)))
+
+
+def _decode_binary(reader):
+    read = reader.read
+    varint = reader.varint
+    setattr_ = object.__setattr__
+    try:
+        reader.fill(1)
+        _check_version(FORMAT, ord(reader.raw(1)))
+        layouts = []
+        for _ in xrange(varint()):
+            cls = _resolve_class(read())
+            layouts.append((cls, [read() for _ in xrange(varint())]))
+        objects = reader.objects
+        object_layouts = []
+        n = varint()
+        data = reader.data
+        pos = reader.pos
+        limit = reader.limit
+        for _ in xrange(n):
+            if pos > limit:
+                reader.pos = pos
+                reader.fill(_LOOKAHEAD)
+                data = reader.data
+                pos = reader.pos
+                limit = reader.limit
+            b = ord(data[pos])
+            if b < 0x80:
+                pos += 1
+            else:
+                reader.pos = pos
+                b = varint()
+                pos = reader.pos
+            object_layouts.append(layouts[b])
+        reader.pos = pos
+        for cls, _ in object_layouts:
+            objects.append(cls.__new__(cls))
+        for obj, (cls, names) in zip(objects, object_layouts):
+            if isinstance(cls, MemoizingMeta):
+                for name in names:
+                    value = read()
+                    if type(value) is list:
+                        value = TrackedList(value)
+                    setattr_(obj, name, value)
+            else:
+                for name in names:
+                    setattr_(obj, name, read())
+        return read()
+    except (IndexError, TypeError, struct.error) as e:
+        raise PlanSerializationException(
+            "malformed plan: {e!r}".format(e=e))
+
+
+def is_serialized(data):
+    """Does data look like a plan serialized by dumps?"""
+    return data.startswith(_MAGIC) or data.lstrip().startswith('{')
+
+
+def dumps(plan, binary=False):
+    """Serialize a plan to a string, as compact JSON or in binary"""
+    if binary:
+        return to_binary(plan)
+    return json.dumps(to_json(plan), separators=(',', ':'))
+
+
+def loads(data):
+    """Rebuild a plan serialized by dumps, in either encoding"""
+    if data.startswith(_MAGIC):
+        return from_binary(data)
+    try:
+        doc = json.loads(data)
+    except ValueError as e:
+        raise PlanSerializationException(
+            "malformed plan: {e}".format(e=e))
+    if not isinstance(doc, dict):
+        raise PlanSerializationException("malformed plan")
+    return from_json(doc)
+
+
+def dump(plan, fp, binary=False):
+    """Serialize a plan to a file object"""
+    fp.write(dumps(plan, binary=binary))
+
+
+def load(fp):
+    """Rebuild a plan from a file object. A binary plan is decoded while it
+    is read, so that its encoding is never held in memory as a whole."""
+    head = fp.read(len(_MAGIC))
+    if head != _MAGIC:
+        return loads(head + fp.read())
+    return _decode_binary(_BinaryReader('', 0, fp))
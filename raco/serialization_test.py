@@ -0,0 +1,113 @@
+from StringIO import StringIO
+import unittest
+
+from raco import serialization
+from raco.algebra import *
+from raco.backends.myria import MyriaSelect, MyriaScan
+from raco.expression import *
+from raco.from_repr import plan_from_repr
+from raco.relation_key import RelationKey
+from raco.scheme import Scheme
+from raco.serialization import PlanSerializationException
+import raco.types as types
+
+
+class SerializationTest(unittest.TestCase):
+
+    emp_key = RelationKey.from_string("andrew:adhoc:employee")
+    emp_schema = Scheme([("id", types.LONG_TYPE),
+                         ("name", types.STRING_TYPE),
+                         ("salary", types.DOUBLE_TYPE)])
+
+    def plan(self):
+        emp = Scan(self.emp_key, self.emp_schema)
+        cond = AND(GT(UnnamedAttributeRef(2), NumericLiteral(1.5)),
+                   EQ(NamedAttributeRef('name'), StringLiteral(u'Bill')))
+        sel = Select(cond, emp)
+        return Sequence([StoreTemp('A', sel),
+                         Store(RelationKey('OUTPUT'), UnionAll([sel, emp]))])
+
+    def roundtrips(self, plan):
+        for binary in (False, True):
+            yield serialization.loads(serialization.dumps(plan, binary))
+
+    def test_roundtrip(self):
+        plan = self.plan()
+        for other in self.roundtrips(plan):
+            self.assertEqual(other, plan)
+            self.assertEqual(str(other), str(plan))
+            self.assertEqual(other.scheme(), plan.scheme())
+            cond = other.args[0].input.condition
+            self.assertIsInstance(cond.right.right.value, unicode)
+            self.assertEqual(cond.left.right.value, 1.5)
+
+    def test_physical_plan(self):
+        plan = MyriaSelect(GT(UnnamedAttributeRef(0), NumericLiteral(-3)),
+                           MyriaScan(self.emp_key, self.emp_schema))
+        for other in self.roundtrips(plan):
+            self.assertIsInstance(other, MyriaSelect)
+            self.assertEqual(other, plan)
+            self.assertEqual(plan_from_repr(serialization.dumps(plan)),
+                             plan)
+
+    def test_shared_subtrees(self):
+        plan = self.plan()
+        store_a, store_out = plan.args
+        self.assertIs(store_a.input, store_out.input.args[0])
+        for other in self.roundtrips(plan):
+            store_a, store_out = other.args
+            self.assertIs(store_a.input, store_out.input.args[0])
+            self.assertIs(store_a.input.input, store_out.input.args[1])
+
+    def test_parent_pointers(self):
+        plan = self.plan()
+        plan.args[0].parent = plan
+        for other in self.roundtrips(plan):
+            self.assertIs(other.args[0].parent, other)
+
+    def test_load_stream(self):
+        """load decodes a binary plan from a stream as it reads it"""
+        class Pipe(object):
+            """Returns at most 7 bytes per sized read, like a slow pipe"""
+            def __init__(self, data):
+                self.data = StringIO(data)
+                self.read_all = False
+
+            def read(self, size=-1):
+                if size < 0:
+                    self.read_all = True
+                    return self.data.read()
+                return self.data.read(min(size, 7))
+
+        plan = self.plan()
+        plan.args[0].input.condition.right.right.value = u'Bill' * 100
+        plan.args.append(StoreTemp('B', Limit(2 ** 70, plan.args[0].input)))
+        for binary in (False, True):
+            data = serialization.dumps(plan, binary)
+            pipe = Pipe(data)
+            other = serialization.load(pipe)
+            # only JSON is read in one piece
+            self.assertEqual(pipe.read_all, not binary)
+            self.assertEqual(other, plan)
+            self.assertIs(other.args[0].input, other.args[2].input.input)
+            self.assertEqual(other.args[2].input.count, 2 ** 70)
+
+        with self.assertRaises(PlanSerializationException):
+            serialization.load(Pipe(data[:len(data) / 2]))
+
+    def test_invalid_input(self):
+        doc = serialization.to_json(self.plan())
+        doc['layouts'][0][0] = 'os.system'
+        with self.assertRaises(PlanSerializationException):
+            serialization.from_json(doc)
+
+        doc = serialization.to_json(self.plan())
+        doc['version'] = serialization.VERSION + 1
+        with self.assertRaises(PlanSerializationException):
+            serialization.from_json(doc)
+
+        data = serialization.dumps(self.plan(), binary=True)
+        with self.assertRaises(PlanSerializationException):
+            serialization.loads(data[:len(data) / 2])
+        with self.assertRaises(PlanSerializationException):
+            serialization.loads('{"format": "raco-plan"')
@@ -38,6 +38,17 @@ python_type_map = {
 
 reverse_python_type_map = {v: k for k, v in python_type_map.iteritems()}
 
+# Estimated size in bytes of a value of each type, used by cost models
+TYPE_SIZES = {
+    LONG_TYPE: 8,
+    INT_TYPE: 4,
+    BOOLEAN_TYPE: 1,
+    DOUBLE_TYPE: 8,
+    FLOAT_TYPE: 4,
+    STRING_TYPE: 32,
+    DATETIME_TYPE: 8,
+}
+
 
 def map_type(s):
     """Convert an arbitrary type to an internal type."""
@@ -1,4 +1,6 @@
+from abc import ABCMeta
 import collections
+import os
 
 
 def emit(*args):
@@ -44,7 +46,40 @@ def real_str(obj, skip_out=False):
     return str(obj)
 
 
+def iter_preorder(root, children):
+    """Iterate over a tree in preorder, using an explicit stack so that deep
+    trees do not exhaust the recursion limit. children(node) returns the
+    list of children of a node."""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(children(node)))
+
+
+def iter_postorder(root, children, distinct=False):
+    """Iterate over a tree in postorder, using an explicit stack so that
+    deep trees do not exhaust the recursion limit. children(node) returns
+    the list of children of a node. If distinct is True, a node reachable
+    along several paths of a DAG is only visited the first time."""
+    seen = set()
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            yield node
+            continue
+        if distinct:
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+        stack.append((node, True))
+        stack.extend((c, False) for c in reversed(children(node)))
+
+
 class Printable(object):
+    __slots__ = ()
+
     @classmethod
     def opname(cls):
         return str(cls.__name__)
@@ -53,6 +88,278 @@ class Printable(object):
         return self.opname()
 
 
+class PropertyCache(object):
+
+    """Bookkeeping for cached derived properties and structural hashes of
+    operators and expressions, see MemoizingMeta. A cached value is valid
+    until any operator or expression is modified, which starts a new
+    generation. With RACO_VERIFY_PROPERTY_CACHE=1, every cached value is
+    checked against a recomputation. The recomputation itself uses the cached
+    values of the descendants, which are checked when they are looked up
+    directly, so that checking costs time linear in the size of a plan."""
+
+    generation = 0
+    # Number of memoized values being computed, each inside the next
+    depth = 0
+    fill_depth = 50
+    filling = False
+    # True while a cached value is being checked
+    verifying = False
+    verify = os.environ.get('RACO_VERIFY_PROPERTY_CACHE') in \
+        ['true', 'True', 't', 'T', '1', 'yes', 'y']
+
+    @classmethod
+    def invalidate(cls):
+        """Drop all cached values. Attribute assignments and changes to the
+        lists held by operators and expressions call this; call it after
+        modifying an operator in any other way, e.g., by changing a dict or
+        a nested list in place."""
+        cls.generation += 1
+
+    # class -> the names of its slots, other than the cache
+    _slot_names = {}
+
+    @classmethod
+    def getstate(cls, obj):
+        """Return the state of obj for pickle and copy, without its cached
+        values, which are keyed by functions and cannot be pickled."""
+        names = cls._slot_names.get(type(obj))
+        if names is None:
+            names = []
+            for klass in type(obj).__mro__:
+                slots = klass.__dict__.get('__slots__', ())
+                if isinstance(slots, basestring):
+                    slots = (slots,)
+                names.extend(s for s in slots if s not in
+                             ('__dict__', '__weakref__', '_property_cache'))
+            cls._slot_names[type(obj)] = names
+        slots = {}
+        for name in names:
+            try:
+                slots[name] = getattr(obj, name)
+            except AttributeError:
+                pass
+        return getattr(obj, '__dict__', None) or None, slots or None
+
+    @classmethod
+    def fill(cls, root, name, children):
+        """Compute the memoized method name on the descendants of root,
+        deepest first, so that computing it on root only looks up the cached
+        values of its children instead of recursing down the whole tree."""
+        generation = cls.generation
+
+        def cached_children(node):
+            # The subtree of a node with a valid value needs no filling
+            if node is not root:
+                method = getattr(getattr(type(node), name, None),
+                                 'uncached', None)
+                entry = getattr(node, '_property_cache', {}).get(method)
+                if entry is not None and entry[0] == generation:
+                    return []
+            return getattr(node, children)()
+
+        cls.filling = True
+        try:
+            for node in iter_postorder(root, cached_children, distinct=True):
+                if node is root:
+                    continue
+                try:
+                    getattr(node, name)()
+                except Exception:
+                    # root may not depend on this value; if it does, the
+                    # error is raised again when root computes its own
+                    pass
+        finally:
+            cls.filling = False
+
+    @classmethod
+    def memoize(cls, method, children=None):
+        """Cache the value of method until the next invalidation. If
+        children names the method that returns the children of an object,
+        computations nested more than fill_depth deep fill the caches of
+        the descendants first, so that deep trees do not exhaust the
+        recursion limit."""
+        def cached(self):
+            try:
+                cache = self._property_cache
+            except AttributeError:
+                cache = {}
+                object.__setattr__(self, '_property_cache', cache)
+            entry = cache.get(method)
+            if entry is not None and entry[0] == cls.generation:
+                if cls.verify and not cls.verifying:
+                    cls.verifying = True
+                    try:
+                        value = method(self)
+                    finally:
+                        cls.verifying = False
+                    assert value == entry[1], \
+                        "stale {name} of {op}: {old} != {new}".format(
+                            name=method.__name__, op=self, old=entry[1],
+                            new=value)
+                return entry[1]
+
+            if (children is not None and cls.depth >= cls.fill_depth and
+                    not cls.filling):
+                cls.fill(self, method.__name__, children)
+            generation = cls.generation
+            cls.depth += 1
+            try:
+                value = method(self)
+            finally:
+                cls.depth -= 1
+            cache[method] = (generation, value)
+            return value
+
+        cached.__name__ = method.__name__
+        cached.__doc__ = method.__doc__
+        cached.uncached = method
+        return cached
+
+    @classmethod
+    def fast_eq(cls, method):
+        """Wrap an __eq__ method: an object equals itself, and objects of
+        the same kind with different hashes are not equal."""
+        def eq(self, other):
+            if self is other:
+                return True
+            if type(type(other)) is type(type(self)) and \
+                    hash(self) != hash(other):
+                if cls.verify and not cls.verifying:
+                    cls.verifying = True
+                    try:
+                        equal = method(self, other)
+                    finally:
+                        cls.verifying = False
+                    assert not equal, \
+                        "{a} == {b} but their hashes differ".format(
+                            a=self, b=other)
+                return False
+            return method(self, other)
+
+        eq.__name__ = method.__name__
+        eq.__doc__ = method.__doc__
+        return eq
+
+
+class UndoLog(object):
+
+    """Records the modifications of operators, expressions and TrackedLists
+    made while it is active, so that they can be undone. The optimizer uses
+    it to find out which operators a rule modified, see
+    raco.algebra.rewrite_shared. Logs may be nested."""
+
+    # The innermost active log, if any
+    active = None
+    _missing = object()
+
+    def __init__(self):
+        # (obj, attribute name, old value), or (list, None, old items)
+        self.entries = []
+        self.outer = None
+
+    def __enter__(self):
+        self.outer = UndoLog.active
+        UndoLog.active = self
+        return self
+
+    def __exit__(self, *exc_info):
+        UndoLog.active = self.outer
+        self.outer = None
+
+    @classmethod
+    def _record(cls, entry):
+        log = cls.active
+        while log is not None:
+            log.entries.append(entry)
+            log = log.outer
+
+    @classmethod
+    def record_attribute(cls, obj, name):
+        if cls.active is not None:
+            cls._record((obj, name, getattr(obj, name, cls._missing)))
+
+    @classmethod
+    def record_list(cls, lst):
+        if cls.active is not None:
+            cls._record((lst, None, list(lst)))
+
+    def undo(self):
+        """Restore the recorded objects, latest modification first."""
+        assert UndoLog.active is not self
+        for obj, name, old in reversed(self.entries):
+            if name is None:
+                list.__setitem__(obj, slice(None), old)
+            elif old is UndoLog._missing:
+                if hasattr(obj, name):
+                    delattr(obj, name)
+            else:
+                setattr(obj, name, old)
+        PropertyCache.invalidate()
+        self.entries = []
+
+
+def _invalidating(method):
+    def wrapper(self, *args, **kwargs):
+        PropertyCache.invalidate()
+        UndoLog.record_list(self)
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class TrackedList(list):
+
+    """A list that invalidates the PropertyCache when it is modified in
+    place. Operators and expressions store the lists assigned to their
+    attributes as TrackedLists, so that, e.g., op.args.append(child) or
+    apply.emitters[0] = emitter drops stale cached properties."""
+
+    __slots__ = ()
+
+    __setitem__ = _invalidating(list.__setitem__)
+    __delitem__ = _invalidating(list.__delitem__)
+    __setslice__ = _invalidating(list.__setslice__)
+    __delslice__ = _invalidating(list.__delslice__)
+    __iadd__ = _invalidating(list.__iadd__)
+    __imul__ = _invalidating(list.__imul__)
+    append = _invalidating(list.append)
+    extend = _invalidating(list.extend)
+    insert = _invalidating(list.insert)
+    pop = _invalidating(list.pop)
+    remove = _invalidating(list.remove)
+    reverse = _invalidating(list.reverse)
+    sort = _invalidating(list.sort)
+
+    def __reduce_ex__(self, protocol):
+        # rebuild a copy from the items at once, instead of appending them
+        # one by one
+        return type(self), (list(self),)
+
+
+class MemoizingMeta(ABCMeta):
+
+    """Metaclass that memoizes the methods named in memoized, as defined by
+    each class, and adds fast paths to __eq__. Equal objects must have
+    equal hashes. If children_method is set, memoized values are computed
+    bottom-up, so that deep trees do not exhaust the recursion limit."""
+
+    memoized = ()
+    children_method = None
+
+    def __new__(mcs, name, bases, attrs):
+        for prop in mcs.memoized:
+            method = attrs.get(prop)
+            if (method is not None and
+                    not getattr(method, '__isabstractmethod__', False)):
+                attrs[prop] = PropertyCache.memoize(method,
+                                                    mcs.children_method)
+        if attrs.get('__eq__') is not None:
+            attrs['__eq__'] = PropertyCache.fast_eq(attrs['__eq__'])
+        return ABCMeta.__new__(mcs, name, bases, attrs)
+
+
 # Optional raco dependency: termcolor
 # Without it, coloring will not happen
 def colored(s, color):